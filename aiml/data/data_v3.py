@@ -9,6 +9,7 @@ from sklearn.impute import KNNImputer
 import socket
 from sklearn.model_selection import RepeatedStratifiedKFold
 from aiml.utils import get_luke_trop_features
+from aiml.data import feature_store
 import re
 from service.v5.protocol import get_config
 import seaborn as sn
@@ -379,31 +380,36 @@ def main(args):
     df_master['set'] = 'train'
     df_master.to_csv(os.path.join(cache_root, 'data_raw_trop{}_phys_master.csv'.format(args.num_troponins)))
 
+    # the boots only differ in their splits: one int8 row per boot, codes into feature_store.split_names
+    splits = np.full((args.num_boots, len(df_master)), -1, dtype=np.int8)
     np.random.seed(0)
     # boot_rng = np.random.default_rng(seed=args.random_seed)
     for idx in range(args.num_boots):
-        df_features = df_master.copy()
         for dataset_tag in ['data2', 'data_ecg']:
             idx_list = list(df_master.loc[df_master['dataset'] == dataset_tag].index)
-            train_idxs, val_idxs, test_idxs = make_splits(idx_list)
-
-            set_tag = 'set{}'.format(idx)
-            df_features.loc[train_idxs, set_tag] = 'train'
-            df_features.loc[val_idxs, set_tag] = 'val'
-            df_features.loc[test_idxs, set_tag] = 'test'
+            for set_code, set_idxs in enumerate(make_splits(idx_list)):
+                splits[idx, set_idxs] = set_code
 
         idx_list = list(df_master.loc[df_master['dataset'] == 'data3'].index)
-        df_features.loc[idx_list, set_tag] = 'test'
-        assert sum(df_features['set{}'.format(idx)].isna()) == 0
+        splits[idx, idx_list] = feature_store.split_names.index('test')
+        assert np.all(splits[idx] >= 0)
+
+        if args.boot_csvs:
+            # df_features = df_features.loc[pd.notna(df_features['subjectid'])]
+            df_features = df_master.copy()
+            df_features['set{}'.format(idx)] = feature_store.decode_splits(splits[idx])
+            df_features.to_csv(os.path.join(cache_root, 'data_raw_trop{}_phys_{}.csv'.format(args.num_troponins, idx)),
+                               index=False)
 
-        # df_features = df_features.loc[pd.notna(df_features['subjectid'])]
-        df_features.to_csv(os.path.join(cache_root, 'data_raw_trop{}_phys_{}.csv'.format(args.num_troponins, idx)),
-                           index=False)
+            stats.to_csv(os.path.join(cache_root, 'data_raw_trop{}_phys_{}_stats.csv'.format(args.num_troponins, idx)))
 
-        stats.to_csv(os.path.join(cache_root, 'data_raw_trop{}_phys_{}_stats.csv'.format(args.num_troponins, idx)))
+            np.save(os.path.join(cache_root,
+                                 'data_raw_trop{}_phys_{}_onehot_encoding.npy'.format(args.num_troponins, idx)),
+                    onehot_choices)
 
-        np.save(os.path.join(cache_root, 'data_raw_trop{}_phys_{}_onehot_encoding.npy'.format(args.num_troponins, idx)),
-                onehot_choices)
+    store_path = feature_store.get_store_path(cache_root, 'data_raw_trop{}_phys'.format(args.num_troponins))
+    feature_store.write_store(df_master, store_path)
+    feature_store.write_splits(store_path, splits)
 
     return 0
 
@@ -413,6 +419,8 @@ if __name__ == '__main__':
     parser.add_argument('--num_troponins', type=int, default=6, help='Maximum Number of Troponins')
     parser.add_argument('--num_boots', type=int, default=50, help='Number of Boosts')
     parser.add_argument('--random_seed', type=int, default=20201216, help='Random Seed')
+    parser.add_argument('--boot_csvs', type=int, default=0,
+                        help='Also write the per-boot CSV copies of the feature store (1)')
     args = parser.parse_args()
 
     main(args)
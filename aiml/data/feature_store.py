@@ -0,0 +1,136 @@
+import os
+import json
+import numpy as np
+import pandas as pd
+
+# One typed, column-per-file copy of a master feature table plus the (num_boots, num_rows) int8 matrix of its
+# bootstrap splits, replacing the per-boot data_raw_*_{boot}.csv copies that only differ in their set{boot} column:
+#
+#   data_raw_trop6_phys_master.store/
+#       columns.json    {'num_rows', 'columns': [{'name', 'dtype', 'file', 'na_file'}]}
+#       c0000.npy ...   one array per column; strings as fixed-width unicode with a missing mask in na_file, as are
+#                       booleans with missing values
+#       splits.npy      int8 codes into split_names, -1 for rows outside every split
+#
+# Every array is memory-mapped, so reading a few columns or one boot's splits only touches those bytes, and the
+# numeric columns of a frame read back are views over the maps; strings and booleans with missing values are built as
+# object arrays. The stats and onehot files stay next to the store as data_raw_*_master_stats.csv and
+# data_raw_*_master_onehot_encoding.npy, which is where TroponinDataset looks for them given the store path.
+
+split_names = ['train', 'val', 'test']
+# the strings pd.read_csv reads as booleans
+true_values = ['True', 'TRUE', 'true']
+false_values = ['False', 'FALSE', 'false']
+
+
+def get_store_path(data_path, master_csv):
+    return os.path.join(data_path, master_csv + '_master.store')
+
+
+def is_store(path):
+    return os.path.isfile(os.path.join(path, 'columns.json'))
+
+
+def get_boot_path(data_path, master_csv, boot_no=None):
+    """
+    The deploy CSV for boot_no None, as before the store; else the feature store if data_v3 wrote one, or the
+    per-boot CSV.
+    """
+    if boot_no is None:
+        return os.path.join(data_path, master_csv + '.csv')
+    store_path = get_store_path(data_path, master_csv)
+    if is_store(store_path):
+        return store_path
+    return os.path.join(data_path, master_csv + '_{}.csv'.format(boot_no))
+
+
+def write_store(df, path):
+    os.makedirs(path, exist_ok=True)
+    columns = list()
+    for c_idx, name in enumerate(df.columns):
+        values = df[name]
+        column = {'name': str(name), 'file': 'c{:04d}.npy'.format(c_idx)}
+        na = values.isna().values
+        if values.dtype.kind in 'biuf':
+            array = values.values
+        else:
+            # as pd.read_csv would have it: booleans if every value reads as one, else numbers if every value
+            # parses, else strings; booleans and strings keep their missing values in na_file
+            present = values[~na].astype(str)
+            numeric = pd.to_numeric(values, errors='coerce')
+            if len(present) > 0 and present.isin(true_values + false_values).all():
+                array = np.isin(values.astype(str).values, true_values)
+            elif (numeric.notna() == values.notna()).all():
+                array = numeric.values
+            else:
+                array = np.where(na, '', values.astype(str).values).astype(str)
+            if array.dtype.kind == 'U' or (array.dtype.kind == 'b' and na.any()):
+                column['na_file'] = 'c{:04d}_na.npy'.format(c_idx)
+                np.save(os.path.join(path, column['na_file']), na)
+        np.save(os.path.join(path, column['file']), array)
+        column['dtype'] = array.dtype.str
+        columns.append(column)
+
+    with open(os.path.join(path, 'columns.json'), 'w') as handle:
+        json.dump({'num_rows': len(df), 'columns': columns}, handle, indent=2)
+
+
+def write_splits(path, splits):
+    np.save(os.path.join(path, 'splits.npy'), np.asarray(splits, dtype=np.int8))
+
+
+def read_splits(path):
+    # (num_boots, num_rows) int8, memory-mapped
+    return np.load(os.path.join(path, 'splits.npy'), mmap_mode='r')
+
+
+def decode_splits(codes):
+    return np.array(split_names + [np.nan], dtype=object)[np.asarray(codes, dtype=np.int64)]
+
+
+def read_store(path, columns=None):
+    with open(os.path.join(path, 'columns.json'), 'r') as handle:
+        schema = json.load(handle)
+    entries = {column['name']: column for column in schema['columns']}
+    names = list(entries) if columns is None else columns
+    for name in names:
+        if name not in entries:
+            raise ValueError('{} has no column {}.'.format(path, name))
+
+    data = dict()
+    for name in names:
+        # copy-on-write maps: the frames are modified in place downstream, which never reaches the files
+        array = np.load(os.path.join(path, entries[name]['file']), mmap_mode='c').view(np.ndarray)
+        if 'na_file' in entries[name]:
+            array = array.astype(object)
+            array[np.load(os.path.join(path, entries[name]['na_file']))] = np.nan
+        data[name] = array
+    return pd.DataFrame(data, columns=names, index=pd.RangeIndex(schema['num_rows']), copy=False)
+
+
+def read_frame(path, boot_no=None, columns=None):
+    """
+    The frame a data_raw_*_{boot_no}.csv would give: the store's columns plus set{boot_no}, or the CSV at path.
+    columns: subset to read, may include set{boot_no}.
+    """
+    if not is_store(path):
+        return pd.read_csv(path, usecols=columns, low_memory=False)
+
+    set_key = None if boot_no is None else 'set{}'.format(boot_no)
+    df = read_store(path, None if columns is None else [c for c in columns if c != set_key])
+    if set_key is not None and (columns is None or set_key in columns):
+        df[set_key] = decode_splits(read_splits(path)[boot_no])
+        if columns is not None:
+            df = df[columns]
+    return df
+
+
+def read_boot(data_path, master_csv, boot_no, columns=None):
+    # data_raw_*_{boot_no}.csv, or its columns, from the store if there is one
+    return read_frame(get_boot_path(data_path, master_csv, boot_no), boot_no, columns)
+
+
+def read_set(data_path, master_csv, boot_no):
+    # the set{boot_no} column alone, 'train', 'val' or 'test' per row of the master table
+    set_key = 'set{}'.format(boot_no)
+    return read_boot(data_path, master_csv, boot_no, columns=[set_key])[set_key]
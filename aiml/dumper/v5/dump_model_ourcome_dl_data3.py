@@ -6,6 +6,7 @@ import torch
 from aiml.pytorch.outcome_data3.model import get_network
 from aiml.pytorch.outcome_data3.data_loader import get_loader_from_dataset
 from aiml.pytorch import utils
+from aiml.data.feature_store import get_boot_path
 from torchvision import transforms
 import numpy as np
 
@@ -29,12 +30,12 @@ def load_model(seed, target_info, args):
 
 def get_data_loader(target_info, args):
     if args.deploy:
+        boot_no = None
         set_key = 'set'
-        csv_path = os.path.join(args.data_path, args.master_csv + '.csv')
     else:
         boot_no = args.seed
         set_key = 'set{}'.format(boot_no)
-        csv_path = os.path.join(args.data_path, args.master_csv + '_{}.csv'.format(boot_no))
+    csv_path = get_boot_path(args.data_path, args.master_csv, boot_no)
 
     train_sets = {'train'}
 
@@ -58,6 +59,7 @@ def get_data_loader(target_info, args):
                                                 set_scope=train_sets,
                                                 use_random_crop=True,
                                                 prefill_feature=args.prefill_feature,
+                                                boot_no=boot_no,
                                                 data_cohort=args.data_cohort,
                                                 shuffle=True, num_workers=0, drop_last=True)
 
@@ -70,6 +72,7 @@ def get_data_loader(target_info, args):
                                                           set_scope=train_sets,
                                                           use_random_crop=True,
                                                           prefill_feature=args.prefill_feature,
+                                                          boot_no=boot_no,
                                                           data_cohort=args.data_cohort,
                                                           shuffle=False, num_workers=0, drop_last=False)
 
@@ -82,6 +85,7 @@ def get_data_loader(target_info, args):
                                               set_scope=val_sets,
                                               use_random_crop=False,
                                               prefill_feature=args.prefill_feature,
+                                              boot_no=boot_no,
                                               data_cohort=args.data_cohort,
                                               shuffle=False, num_workers=0, drop_last=False)
 
@@ -94,6 +98,7 @@ def get_data_loader(target_info, args):
                                                set_scope=test_sets,
                                                use_random_crop=False,
                                                prefill_feature=args.prefill_feature,
+                                               boot_no=boot_no,
                                                data_cohort=args.data_cohort,
                                                shuffle=False, num_workers=0, drop_last=False)
 
@@ -101,6 +106,12 @@ def get_data_loader(target_info, args):
             'train_val_style': train_val_style_data_loader}
 
 
+def get_shap_background(dataset, num_background, seed):
+    # a fixed sample of normalised training features for the service explainer, see service/v5/explainer.py
+    order = np.random.RandomState(seed).permutation(len(dataset))[:num_background]
+    return np.stack([dataset[i][0].numpy().reshape(-1) for i in order]).astype(np.float32)
+
+
 def main(args):
     target_info = {
         'luke_multiplier': args.lm,
@@ -117,7 +128,10 @@ def main(args):
     else:
         angio_or_ecg = 'none'
 
-    package = {'models': list(), 'data_loader': get_data_loader(target_info, args)['val']}
+    data_loaders = get_data_loader(target_info, args)
+    package = {'models': list(), 'data_loader': data_loaders['val'],
+               'shap_background': get_shap_background(data_loaders['train_val_style'].dataset, args.num_background,
+                                                      args.seed)}
     package['data_loader'].dataset.df = None
     for seed in range(0, 5):
         thresholds = (dict(), dict())
@@ -155,6 +169,7 @@ if __name__ == '__main__':
     # parser.add_argument('--use_derived_threshold', type=utils.str2bool, default='False')
     # parser.add_argument('--threshold_method', type=str, default='tpr')
     parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--num_background', type=int, default=500)
     parser.add_argument('--deploy', type=utils.str2bool, default='False')
     parser.add_argument('--lm', type=int, default=1)
     parser.add_argument('--master_csv', type=str, default='data_raw_trop6_phys')
@@ -0,0 +1,111 @@
+import os
+import pickle
+import argparse
+import numpy as np
+import torch
+from path_utils import model_root
+from aiml.pytorch.outcome_data3.model import FoldedTroponinNet, get_fused_ensemble
+from service.v5.model_package import write_package, load_dl_package, layer_names
+
+
+def to_json(value):
+    # keep the plain settings of the dump arguments, drop anything that is not json-serialisable
+    if isinstance(value, (bool, int, float, str)) or value is None:
+        return value
+    if isinstance(value, (list, tuple)):
+        return [to_json(v) for v in value]
+    if isinstance(value, np.generic):
+        return value.item()
+    return str(value)
+
+
+def get_tensors(nets, dataset):
+    folded = [FoldedTroponinNet(net.eval()) for net in nets]
+    modules = {'fc0': [f.net[0] for f in folded], 'fc1': [f.net[2] for f in folded],
+               'cls': [f.classifier for f in folded]}
+
+    tensors = dict()
+    for name in layer_names:
+        tensors[name + '_weight'] = torch.stack([m.weight.detach().t() for m in modules[name]]).numpy()
+        tensors[name + '_bias'] = torch.stack([m.bias.detach() for m in modules[name]]).unsqueeze(1).numpy()
+
+    # same layout as TroponinDataset.get_feature: phys, bio, bin (not normalised), luke
+    num_bins = len(dataset.binary_keys)
+    tensors['feature_mean'] = torch.cat([dataset.phys_mean.view(-1), dataset.bio_mean.view(-1),
+                                         torch.zeros(num_bins), dataset.luke_mean.view(-1)]).numpy()
+    tensors['feature_std'] = torch.cat([dataset.phys_std.view(-1), dataset.bio_std.view(-1),
+                                        torch.ones(num_bins), dataset.luke_std.view(-1)]).numpy()
+
+    return tensors
+
+
+def get_manifest(package):
+    dataset = package['data_loader'].dataset
+    translator = dataset.target_translator['adjudicatorDiagnosis']
+    classes = [str(c) for c, _ in sorted(translator.items(), key=lambda item: int(item[1]))]
+
+    thresholds = {l_name: {m: [float(t[l][m]) for _, t in package['models']] for m in package['models'][0][1][l]}
+                  for l, l_name in enumerate(['l1', 'l2'])}
+
+    return {
+        'model': 'outcome_dl_data3',
+        'num_members': len(package['models']),
+        'feature_keys': list(dataset.phys_keys) + list(dataset.bio_keys) + list(dataset.binary_keys) +
+                        list(dataset.luke_trop_keys),
+        'feature_groups': {'phys': len(dataset.phys_keys), 'bio': len(dataset.bio_keys),
+                           'bin': len(dataset.binary_keys), 'luke': len(dataset.luke_trop_keys)},
+        'ignore_value': float(dataset.ignore_value),
+        'classes': classes,
+        'thresholds': thresholds,
+        'args': {k: to_json(v) for k, v in vars(package['args']).items()} if package.get('args') is not None else {},
+    }
+
+
+def check_equivalence(nets, compact, num_samples=1024, tol=1e-5, seed=0):
+    input_len = int(sum(nets[0].feature_len.values()))
+
+    generator = torch.Generator().manual_seed(seed)
+    x = torch.randn(num_samples, input_len, generator=generator)
+    x[torch.rand(num_samples, input_len, generator=generator) < 0.3] = 0
+
+    with torch.no_grad():
+        expected, _ = get_fused_ensemble(nets)(x)
+    probs, _ = compact(x.numpy())
+
+    max_delta = float(np.abs(probs - expected.numpy()).max())
+    print('Compact vs original, max absolute probability delta over {} samples: {:.3e}'.format(num_samples,
+                                                                                              max_delta))
+    if max_delta > tol:
+        raise ValueError('Compact package deviates from the original: {:.3e} > {:.3e}'.format(max_delta, tol))
+
+    return max_delta
+
+
+def main(args):
+    package_path = os.path.join(model_root, args.service_version, 'outcome_models_dl_data3.pickle')
+    with open(package_path, 'rb') as handle:
+        package = pickle.load(handle)
+    nets = [net for net, _ in package['models']]
+
+    dump_path = os.path.join(model_root, args.service_version, 'outcome_models_dl_data3')
+    tensors = get_tensors(nets, package['data_loader'].dataset)
+    if package.get('shap_background') is not None:
+        tensors['shap_background'] = package['shap_background']
+    write_package(dump_path, tensors, get_manifest(package))
+    print('saved to: {}'.format(dump_path))
+
+    # check the package as it will be loaded by the server
+    check_equivalence(nets, load_dl_package(dump_path), num_samples=args.num_samples, tol=args.tol)
+
+    return 0
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--service_version', type=str, default='v5')
+    parser.add_argument('--num_samples', type=int, default=1024)
+    parser.add_argument('--tol', type=float, default=1e-5)
+
+    args = parser.parse_args()
+    print(args)
+    main(args)
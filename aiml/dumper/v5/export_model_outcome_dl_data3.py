@@ -0,0 +1,68 @@
+import os
+import pickle
+import argparse
+import torch
+from path_utils import model_root
+from aiml.pytorch.outcome_data3.model import get_folded_ensemble, TroponinShell
+
+
+def export(nets):
+    # fold luke_multiplier and BatchNorm1d into the Linear layers, then script and freeze
+    ensemble = get_folded_ensemble(nets)
+    with torch.no_grad():
+        exported = torch.jit.freeze(torch.jit.script(ensemble))
+    return exported
+
+
+def check_equivalence(nets, exported, num_samples=1024, tol=1e-5, seed=0):
+    input_len = int(sum(nets[0].feature_len.values()))
+
+    # normalised features are roughly N(0, 1) and missing features are set to 0 by the data loader
+    generator = torch.Generator().manual_seed(seed)
+    x = torch.randn(num_samples, input_len, generator=generator)
+    x[torch.rand(num_samples, input_len, generator=generator) < 0.3] = 0
+
+    with torch.no_grad():
+        expected = torch.stack([TroponinShell(net.eval())(x) for net in nets])
+        probs, probs_mean = exported(x)
+        single_probs, _ = exported(x[:1])
+
+    max_delta = max((probs - expected).abs().max().item(),
+                    (probs_mean - expected.mean(dim=0)).abs().max().item(),
+                    (single_probs - expected[:, :1]).abs().max().item())
+    print('Exported vs original, max absolute probability delta over {} samples: {:.3e}'.format(num_samples,
+                                                                                               max_delta))
+    if max_delta > tol:
+        raise ValueError('Exported model deviates from the original: {:.3e} > {:.3e}'.format(max_delta, tol))
+
+    return max_delta
+
+
+def main(args):
+    package_path = os.path.join(model_root, args.service_version, 'outcome_models_dl_data3.pickle')
+    with open(package_path, 'rb') as handle:
+        package = pickle.load(handle)
+    nets = [net for net, _ in package['models']]
+
+    exported = export(nets)
+    check_equivalence(nets, exported, num_samples=args.num_samples, tol=args.tol)
+
+    export_path = os.path.join(model_root, args.service_version, 'outcome_models_dl_data3.pt')
+    torch.jit.save(exported, export_path)
+    print('saved to: {}'.format(export_path))
+
+    # check the artefact as it will be loaded by the server
+    check_equivalence(nets, torch.jit.load(export_path), num_samples=args.num_samples, tol=args.tol)
+
+    return 0
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--service_version', type=str, default='v5')
+    parser.add_argument('--num_samples', type=int, default=1024)
+    parser.add_argument('--tol', type=float, default=1e-5)
+
+    args = parser.parse_args()
+    print(args)
+    main(args)
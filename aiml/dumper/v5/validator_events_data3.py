@@ -9,6 +9,7 @@ from aiml.xgboost.main_event_data3 import get_label, get_val_label, get_model
 from aiml.utils import optimize_threshold
 from service.v5.protocol import prefiller, get_config
 from aiml.dumper.utils import str2bool
+from aiml.data.feature_store import read_boot, read_set
 # needed for libomp problem on mac (https://github.com/dmlc/xgboost/issues/1715#issuecomment-420305786)
 os.environ['KMP_DUPLICATE_LIB_OK'] = 'True'
 
@@ -30,7 +31,7 @@ def load_model(args):
     # TODO why do the test tpr go below the levels chosen?
     train_kwargs = dict(n_boots=50, n_repeats=1, n_folds=10, tpr1=args.tpr1, seed=20201216)
 
-    df = pd.read_csv(os.path.join(cache_root, 'data_raw_trop6_phys_0.csv'), low_memory=False)
+    df = read_boot(cache_root, 'data_raw_trop6_phys', 0)
 
     # exclude Ehsan's picked features
     df = df.drop(columns=config['features']['exclude']['data3'])
@@ -67,8 +68,7 @@ def load_model(args):
         df = df[df['adjudicatorDiagnosis'].isin(['Normal', 'Chronic'])]
 
     for boot in range(train_kwargs['n_boots']):
-        df_settag = pd.read_csv(os.path.join(cache_root, f'data_raw_trop6_phys_{boot}.csv'), usecols=[f'set{boot}'])
-        df['set0'] = df_settag[f'set{boot}']
+        df['set0'] = read_set(cache_root, 'data_raw_trop6_phys', boot)
         args.set_label = 'set0'
         inbag_idxs, outbag_idxs = list(df.index[(df[args.set_label] == 'train') | (df[args.set_label] == 'val')]), \
                                   list(df.index[df[args.set_label] == 'test'])
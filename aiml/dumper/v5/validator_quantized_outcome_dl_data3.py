@@ -0,0 +1,164 @@
+import io
+import os
+import json
+import time
+import pickle
+import argparse
+import numpy as np
+import pandas as pd
+import torch
+from path_utils import model_root, cache_root_d3 as cache_root
+from aiml.pytorch import utils
+from aiml.pytorch.outcome_data3.model import get_fused_ensemble, get_quantized_ensemble
+from service.v5.protocol import get_config
+from service.v5.input_schema import PrefillVector
+from aiml.data.feature_store import read_boot
+
+# Agreement and calibration of the int8 DL runtime (dl_runtime='quantized' in service/v5/batch_predictor.py)
+# against the float ensemble, over the out-of-bag cases of sample.npy written by
+# aiml/pytorch/outcome_data3/result_extractor.py. The report is saved next to the model package.
+
+config = get_config()
+
+
+def get_outbag_features(dataset, model_folder, prefill_feature):
+    # normalised features of the out-of-bag cases as TroponinDataset.get_feature builds them, and their labels
+    saved_data = np.load(os.path.join(cache_root, model_folder, 'sample.npy'), allow_pickle=True).item()
+    df = read_boot(cache_root, 'data_raw_trop6_phys', 0)
+    df = df.iloc[saved_data['outbag_idxs']].reset_index(drop=True)
+    if prefill_feature:
+        df = PrefillVector(df.columns, config['prefill']['all']).apply_frame(df)
+    labels = df['adjudicatorDiagnosis'].values
+    df = df.fillna(dataset.ignore_value)
+
+    x = torch.stack([dataset.get_feature(row) for _, row in df.iterrows()]).view(len(df), -1)
+    return x, labels, saved_data
+
+
+def get_levels(probs, class_idx):
+    # member-average l1 and l2 as in OutcomeDLBatchModel.inference
+    probs = probs.mean(dim=0).numpy().astype(float)
+    l1 = 1 - (probs[:, class_idx['Chronic']] + probs[:, class_idx['Normal']])
+    l2 = probs[:, class_idx['T1MI']]
+    return probs, l1, l2
+
+
+def expected_calibration_error(y, prob, num_bins=10):
+    bins = np.minimum((prob * num_bins).astype(int), num_bins - 1)
+    ece = 0.
+    for b in range(num_bins):
+        selected = bins == b
+        if selected.any():
+            ece += selected.mean() * abs(y[selected].mean() - prob[selected].mean())
+    return float(ece)
+
+
+def get_latency(model, x, batch_size, repeats=200):
+    x = x[:batch_size]
+    with torch.no_grad():
+        model(x)
+        start = time.perf_counter()
+        for _ in range(repeats):
+            model(x)
+    return (time.perf_counter() - start) / repeats * 1000
+
+
+def get_size(model):
+    buffer = io.BytesIO()
+    torch.save(model.state_dict(), buffer)
+    return len(buffer.getvalue())
+
+
+def get_report(package, x, labels, saved_data):
+    nets = [net.eval() for net, _ in package['models']]
+    translator = package['data_loader'].dataset.target_translator['adjudicatorDiagnosis']
+    class_idx = {k: int(v) for k, v in translator.items()}
+
+    models = {'float': get_fused_ensemble(nets), 'int8': get_quantized_ensemble(nets)}
+    with torch.no_grad():
+        outputs = {k: m(x)[0] for k, m in models.items()}
+    levels = {k: get_levels(o, class_idx) for k, o in outputs.items()}
+    (p_float, l1_float, l2_float), (p_int8, l1_int8, l2_int8) = levels['float'], levels['int8']
+
+    report = {'num_cases': len(x),
+              'max_prob_delta': {'member_p5': float((outputs['int8'] - outputs['float']).abs().max()),
+                                 'p5': float(np.abs(p_int8 - p_float).max()),
+                                 'l1': float(np.abs(l1_int8 - l1_float).max()),
+                                 'l2': float(np.abs(l2_int8 - l2_float).max())},
+              'flip_rate': {'p5': float((p_int8.argmax(axis=1) != p_float.argmax(axis=1)).mean())}}
+
+    # activations are quantised per batch: a case scored alone against the same case scored with all the others
+    with torch.no_grad():
+        single = torch.cat([models['int8'](x[i:i + 1])[0] for i in range(len(x))], dim=1)
+    report['max_prob_delta']['single_vs_batch'] = float((single - outputs['int8']).abs().max())
+
+    # level decisions as served with model_idx -1: mean probability against the mean threshold
+    for l, (s_float, s_int8) in enumerate([(l1_float, l1_int8), (l2_float, l2_int8)]):
+        for m in package['models'][0][1][l]:
+            threshold = np.mean([t[l][m] for _, t in package['models']])
+            report['flip_rate']['l{}_{}'.format(l + 1, m)] = float(((s_float >= threshold) !=
+                                                                   (s_int8 >= threshold)).mean())
+
+    # the float member 0 must reproduce the saved out-of-bag scores, otherwise the features are wrong
+    member0 = get_levels(outputs['float'][:1], class_idx)
+    report['float_vs_sample'] = {'l1': float(np.abs(member0[1] - saved_data['y1_prob']).max()),
+                                 'l2': float(np.abs(member0[2] - saved_data['y2_prob']).max())}
+
+    known = pd.notna(labels)
+    y1 = np.isin(labels[known], ['Acute', 'T2MI', 'T1MI']).astype(float)
+    y2 = (labels[known] == 'T1MI').astype(float)
+    report['calibration'] = {k: {'ece_l1': expected_calibration_error(y1, l1[known]),
+                                 'ece_l2': expected_calibration_error(y2, l2[known]),
+                                 'brier_l1': float(np.mean((l1[known] - y1) ** 2)),
+                                 'brier_l2': float(np.mean((l2[known] - y2) ** 2))}
+                             for k, (_, l1, l2) in levels.items()}
+
+    torch.set_num_threads(1)
+    report['latency_ms'] = {k: {'batch_{}'.format(b): get_latency(m, x, b) for b in [1, 64]}
+                            for k, m in models.items()}
+    report['size_bytes'] = {k: get_size(m) for k, m in models.items()}
+    return report
+
+
+def main(args):
+    package_path = os.path.join(model_root, args.service_version, 'outcome_models_dl_data3.pickle')
+    with open(package_path, 'rb') as handle:
+        package = pickle.load(handle)
+
+    package_args = package.get('args')
+    use_ecg = package_args.use_ecg if package_args is not None else args.use_ecg
+    prefill_feature = package_args.prefill_feature if package_args is not None else True
+    x, labels, saved_data = get_outbag_features(package['data_loader'].dataset, args.model_folder.format(use_ecg),
+                                                prefill_feature)
+
+    report = get_report(package, x, labels, saved_data)
+    print(json.dumps(report, indent=2))
+
+    report_path = os.path.join(model_root, args.service_version, 'outcome_models_dl_data3_int8_report.json')
+    with open(report_path, 'w') as handle:
+        json.dump(report, handle, indent=2)
+    print('saved to: {}'.format(report_path))
+
+    # the served probabilities, single cases scored alone and every thresholded decision (p5 and each l1/l2
+    # threshold method) must all stay within the tolerances
+    failures = ['max_prob_delta {}: {:.3e} > {:.3e}'.format(k, report['max_prob_delta'][k], args.tol)
+                for k in ['member_p5', 'single_vs_batch'] if report['max_prob_delta'][k] > args.tol]
+    failures += ['flip_rate {}: {:.4f} > {:.4f}'.format(k, v, args.max_flip_rate)
+                 for k, v in report['flip_rate'].items() if v > args.max_flip_rate]
+    if len(failures) > 0:
+        raise ValueError('Quantised model deviates from the float model: {}'.format('; '.join(failures)))
+
+    return 0
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--service_version', type=str, default='v5')
+    parser.add_argument('--model_folder', type=str, default='outcome_data3_lm1_lr5e-3_use_ecg_{}_b128_v5.1.1')
+    parser.add_argument('--use_ecg', type=utils.str2bool, default='True')
+    parser.add_argument('--tol', type=float, default=0.02)
+    parser.add_argument('--max_flip_rate', type=float, default=0.01)
+
+    args = parser.parse_args()
+    print(args)
+    main(args)
@@ -179,3 +179,279 @@ class TroponinShell(nn.Module):
     def forward(self, input_feature):
         output = self.model(input_feature)
         return torch.softmax(output[2][0], dim=1)
+
+
+class FusedTroponinEnsemble(nn.Module):
+    """
+    Inference-only fusion of K trained TroponinNet members (e.g. the 5 deployed seeds). The Linear, BatchNorm1d
+    (eval statistics) and classifier weights are stacked along a member dimension, so one batched matmul per layer
+    evaluates every member on the same input.
+
+    forward returns the per-member softmax (K, N, C) and the member average (N, C).
+    """
+
+    def __init__(self, nets):
+        super(FusedTroponinEnsemble, self).__init__()
+
+        net = nets[0]
+        self.num_members = len(nets)
+
+        # the luke block is repeated luke_multiplier times in front of phys, bio and bin, see TroponinNet.forward
+        feature_names = ['luke'] * net.luke_multiplier + ['phys', 'bio', 'bin']
+        input_index = np.concatenate([np.arange(*net.feature_arrangement[k]) for k in feature_names])
+        self.register_buffer('input_index', torch.tensor(input_index, dtype=torch.long))
+
+        cls_name = list(net.target_info['cls_cols_dict'])[0]
+        layers = list()
+        for linear_idx, bn_idx in [(0, 1), (4, 5)]:
+            linears = [n.net[linear_idx] for n in nets]
+            bns = [n.net[bn_idx] for n in nets]
+            weight = torch.stack([l.weight.detach().t() for l in linears])
+            bias = torch.stack([l.bias.detach() for l in linears]).unsqueeze(1)
+            bn_scale = torch.stack([b.weight.detach() / torch.sqrt(b.running_var + b.eps) for b in bns])
+            bn_shift = torch.stack([b.bias.detach() - b.running_mean * s for b, s in zip(bns, bn_scale)])
+            layers.append((weight, bias, bn_scale.unsqueeze(1), bn_shift.unsqueeze(1)))
+
+        for l_idx, (weight, bias, bn_scale, bn_shift) in enumerate(layers):
+            self.register_buffer('weight{}'.format(l_idx), weight)
+            self.register_buffer('bias{}'.format(l_idx), bias)
+            self.register_buffer('bn_scale{}'.format(l_idx), bn_scale)
+            self.register_buffer('bn_shift{}'.format(l_idx), bn_shift)
+
+        classifiers = [n.classifiers[cls_name][0] for n in nets]
+        self.register_buffer('cls_weight', torch.stack([c.weight.detach().t() for c in classifiers]))
+        self.register_buffer('cls_bias', torch.stack([c.bias.detach() for c in classifiers]).unsqueeze(1))
+
+    def forward(self, input_feature):
+        x = input_feature.view(input_feature.size()[0], -1)[:, self.input_index]
+        x = x.unsqueeze(0).expand(self.num_members, -1, -1)
+
+        x = torch.baddbmm(self.bias0, x, self.weight0)
+        x = torch.relu(x * self.bn_scale0 + self.bn_shift0)
+        x = torch.baddbmm(self.bias1, x, self.weight1)
+        x = torch.relu(x * self.bn_scale1 + self.bn_shift1)
+        logits = torch.baddbmm(self.cls_bias, x, self.cls_weight)
+
+        probs = torch.softmax(logits, dim=2)
+        return probs, probs.mean(dim=0)
+
+
+def get_fused_ensemble(nets):
+    return FusedTroponinEnsemble(nets).eval()
+
+
+class FoldedTroponinNet(nn.Module):
+    """
+    Eval-mode equivalent of a trained TroponinNet with two folds applied:
+      - luke_multiplier: the repeated luke block is the same as summing the first Linear's column blocks, and the
+        column blocks are re-ordered to the raw (phys, bio, bin, luke) input layout, so no slicing or cat is needed.
+      - BatchNorm1d: the running statistics and affine parameters are folded into the preceding Linear.
+    forward takes the raw (N, F) or (N, F, 1, 1) feature and returns the softmax of the first classification head.
+    """
+
+    def __init__(self, net):
+        super(FoldedTroponinNet, self).__init__()
+
+        input_len = int(sum(net.feature_len.values()))
+        feature_names = ['luke'] * net.luke_multiplier + ['phys', 'bio', 'bin']
+
+        linear = net.net[0]
+        weight = torch.zeros(linear.out_features, input_len, dtype=linear.weight.dtype)
+        offset = 0
+        for k in feature_names:
+            start, end = [int(v) for v in net.feature_arrangement[k]]
+            weight[:, start:end] += linear.weight.detach()[:, offset:offset + end - start]
+            offset += end - start
+
+        modules = list()
+        for (linear_idx, bn_idx), w in zip([(0, 1), (4, 5)], [weight, net.net[4].weight.detach()]):
+            linear = net.net[linear_idx]
+            bn = net.net[bn_idx]
+            scale = bn.weight.detach() / torch.sqrt(bn.running_var + bn.eps)
+            folded = nn.Linear(w.shape[1], w.shape[0])
+            folded.weight.data = w * scale.view(-1, 1)
+            folded.bias.data = (linear.bias.detach() - bn.running_mean) * scale + bn.bias.detach()
+            modules.append(folded)
+            modules.append(nn.ReLU())
+        self.net = nn.Sequential(*modules)
+
+        cls_name = list(net.target_info['cls_cols_dict'])[0]
+        classifier = net.classifiers[cls_name][0]
+        self.classifier = nn.Linear(classifier.in_features, classifier.out_features)
+        self.classifier.weight.data = classifier.weight.detach().clone()
+        self.classifier.bias.data = classifier.bias.detach().clone()
+
+    def forward(self, input_feature):
+        x = input_feature.view(input_feature.size()[0], -1)
+        return torch.softmax(self.classifier(self.net(x)), dim=1)
+
+
+class TroponinEnsembleShell(nn.Module):
+    """
+    Runs a list of single-member networks (e.g. FoldedTroponinNet) and returns, like FusedTroponinEnsemble, the
+    per-member softmax (K, N, C) and the member average (N, C).
+    """
+
+    def __init__(self, members):
+        super(TroponinEnsembleShell, self).__init__()
+        self.members = nn.ModuleList(members)
+
+    def forward(self, input_feature):
+        probs = torch.stack([m(input_feature) for m in self.members])
+        return probs, probs.mean(dim=0)
+
+
+def get_folded_ensemble(nets):
+    return TroponinEnsembleShell([FoldedTroponinNet(n.eval()) for n in nets]).eval()
+
+
+class QuantizableTroponinEnsemble(nn.Module):
+    """
+    Float FoldedTroponinNet members laid out for dynamic int8 quantisation: the first Linear of every member reads
+    the same input, so the members are concatenated into one wide fc0; the 512-wide fc1 stays one Linear per member
+    and the small classifiers run float as one batched matmul. forward returns, like FusedTroponinEnsemble, the
+    per-member softmax (K, N, C) and the member average (N, C).
+    """
+
+    def __init__(self, nets):
+        super(QuantizableTroponinEnsemble, self).__init__()
+        folded = [FoldedTroponinNet(net.eval()) for net in nets]
+        self.num_members = len(folded)
+
+        first = [f.net[0] for f in folded]
+        self.fc0 = nn.Linear(first[0].in_features, sum(l.out_features for l in first))
+        self.fc0.weight.data = torch.cat([l.weight.detach() for l in first])
+        self.fc0.bias.data = torch.cat([l.bias.detach() for l in first])
+        self.fc1 = nn.ModuleList([f.net[2] for f in folded])
+
+        self.register_buffer('cls_weight', torch.stack([f.classifier.weight.detach().t() for f in folded]))
+        self.register_buffer('cls_bias', torch.stack([f.classifier.bias.detach() for f in folded]).unsqueeze(1))
+
+    def forward(self, input_feature):
+        x = input_feature.view(input_feature.size()[0], -1)
+        x = torch.relu(self.fc0(x)).view(x.size()[0], self.num_members, -1)
+        x = torch.stack([torch.relu(fc(x[:, m_idx])) for m_idx, fc in enumerate(self.fc1)])
+        logits = torch.baddbmm(self.cls_bias, x, self.cls_weight)
+
+        probs = torch.softmax(logits, dim=2)
+        return probs, probs.mean(dim=0)
+
+
+def get_quantized_ensemble(nets):
+    """
+    int8 weights per output channel, CPU only. The activations are quantised at run time over the whole batch input
+    of a layer, so a row can move by about the quantisation error with the rest of its batch; a static activation
+    range would clip the heavy-tailed troponin features instead.
+    """
+    qconfig = torch.quantization.per_channel_dynamic_qconfig
+    return torch.quantization.quantize_dynamic(QuantizableTroponinEnsemble(nets).eval(),
+                                               {'fc0': qconfig, 'fc1': qconfig}, dtype=torch.qint8)
+
+
+class BatchedTroponinNet(nn.Module):
+    """
+    K TroponinNet replicas trained as one model: every Linear is a (K, in, out) parameter applied with baddbmm, and
+    BatchNorm1d keeps per-replica batch and running statistics, so replica k sees only its own rows. forward takes
+    (K, N, F) or (K, N, F, 1, 1), one batch per replica, and returns TroponinNet's outputs with a leading replica
+    dimension. SGD and Adam are element-wise, so one optimizer over the stacked parameters is K independent ones.
+    """
+
+    def __init__(self, nets):
+        super(BatchedTroponinNet, self).__init__()
+
+        net = nets[0]
+        self.num_replicas = len(nets)
+        self.target_info = net.target_info
+        self.dropout = net.net[3].p
+        self.bn_momentum = net.net[1].momentum
+        self.bn_eps = net.net[1].eps
+
+        feature_names = ['luke'] * net.luke_multiplier + ['phys', 'bio', 'bin']
+        input_index = np.concatenate([np.arange(*net.feature_arrangement[k]) for k in feature_names])
+        self.register_buffer('input_index', torch.tensor(input_index, dtype=torch.long))
+
+        # TroponinNet modules in state_dict order: net.0, net.1, net.4, net.5, regressor, binary_classifier, classifiers
+        self.linear_names = ['net.0', 'net.4']
+        self.bn_names = ['net.1', 'net.5']
+        self.head_names = ['regressor.0', 'binary_classifier.0'] + \
+                          ['{}.0'.format(t_name) for t_name in self.target_info['cls_cols_dict']]
+        self.load_state_dicts([n.state_dict() for n in nets])
+
+    @staticmethod
+    def get_parameter_name(name, key):
+        return '{}_{}'.format(name.replace('.', '_'), key)
+
+    def load_state_dicts(self, state_dicts):
+        for name in self.linear_names + self.head_names:
+            weight = torch.stack([s['{}.weight'.format(name)].t() for s in state_dicts])
+            bias = torch.stack([s['{}.bias'.format(name)] for s in state_dicts]).unsqueeze(1)
+            setattr(self, self.get_parameter_name(name, 'weight'), nn.Parameter(weight.clone()))
+            setattr(self, self.get_parameter_name(name, 'bias'), nn.Parameter(bias.clone()))
+
+        for name in self.bn_names:
+            for key in ['weight', 'bias']:
+                value = torch.stack([s['{}.{}'.format(name, key)] for s in state_dicts])
+                setattr(self, self.get_parameter_name(name, key), nn.Parameter(value.clone()))
+            for key in ['running_mean', 'running_var', 'num_batches_tracked']:
+                value = torch.stack([s['{}.{}'.format(name, key)] for s in state_dicts])
+                self.register_buffer(self.get_parameter_name(name, key), value.clone())
+
+    def get_state_dicts(self, template):
+        """
+        The K replicas as TroponinNet state dicts, laid out like template (a TroponinNet state_dict).
+        """
+        state_dicts = list()
+        for r_idx in range(self.num_replicas):
+            state_dict = dict()
+            for key, value in template.items():
+                name, sub_key = key.rsplit('.', 1)
+                stacked = getattr(self, self.get_parameter_name(name, sub_key)).detach()[r_idx]
+                if name in self.linear_names + self.head_names:
+                    stacked = stacked.t() if sub_key == 'weight' else stacked.squeeze(0)
+                state_dict[key] = stacked.clone().view(value.shape).type(value.dtype)
+            state_dicts.append(state_dict)
+        return state_dicts
+
+    def linear(self, name, x):
+        return torch.baddbmm(getattr(self, self.get_parameter_name(name, 'bias')), x,
+                             getattr(self, self.get_parameter_name(name, 'weight')))
+
+    def batch_norm(self, name, x):
+        # nn.BatchNorm1d over dim 1 of (K, N, C), per replica
+        running_mean = getattr(self, self.get_parameter_name(name, 'running_mean'))
+        running_var = getattr(self, self.get_parameter_name(name, 'running_var'))
+        if self.training:
+            mean = x.mean(dim=1)
+            var = x.var(dim=1, unbiased=False)
+            with torch.no_grad():
+                n = x.shape[1]
+                running_mean.mul_(1 - self.bn_momentum).add_(self.bn_momentum * mean)
+                running_var.mul_(1 - self.bn_momentum).add_(self.bn_momentum * var * n / max(n - 1, 1))
+                getattr(self, self.get_parameter_name(name, 'num_batches_tracked')).add_(1)
+        else:
+            mean, var = running_mean, running_var
+        x = (x - mean.unsqueeze(1)) / torch.sqrt(var.unsqueeze(1) + self.bn_eps)
+        return x * getattr(self, self.get_parameter_name(name, 'weight')).unsqueeze(1) + \
+            getattr(self, self.get_parameter_name(name, 'bias')).unsqueeze(1)
+
+    def forward(self, input_feature):
+        x = input_feature.view(input_feature.size()[0], input_feature.size()[1], -1)[:, :, self.input_index]
+        for linear_name, bn_name in zip(self.linear_names, self.bn_names):
+            x = torch.relu(self.batch_norm(bn_name, self.linear(linear_name, x)))
+            x = F.dropout(x, p=self.dropout, training=self.training)
+
+        regression_logits = self.linear(self.head_names[0], x)
+        binary_cls_logits = self.linear(self.head_names[1], x)
+        cls_logits = [self.linear(name, x) for name in self.head_names[2:]]
+        return regression_logits, binary_cls_logits, cls_logits
+
+
+def get_batched_network(target_info, seeds):
+    """
+    A BatchedTroponinNet of get_network(target_info) replicas, replica k initialised as train.py --seed seeds[k] does.
+    """
+    nets = list()
+    for seed in seeds:
+        torch.manual_seed(seed)
+        nets.append(get_network(target_info))
+    return BatchedTroponinNet(nets)
@@ -11,6 +11,7 @@ from aiml.pytorch.save_utils import save_mat, save_cam_map
 from aiml.pytorch.recorder import Recorder
 from aiml.pytorch.outcome_data3.model import get_network
 from path_utils import cache_root_de as cache_root
+from aiml.data.feature_store import get_boot_path
 from torchvision import transforms
 from apex import amp
 from path_utils import pytorch_data_root, pytorch_data_server_root
@@ -165,12 +166,12 @@ def main(args):
     target_info['loss_weights'] = {'loss_{}'.format(k): float(v) for k, v in target_info['loss_weights'].items()}
 
     if args.deploy:
+        boot_no = None
         set_key = 'set'
-        csv_path = os.path.join(args.data_path, args.master_csv + '.csv')
     else:
         boot_no = args.seed
         set_key = 'set{}'.format(boot_no)
-        csv_path = os.path.join(args.data_path, args.master_csv + '_{}.csv'.format(boot_no))
+    csv_path = get_boot_path(args.data_path, args.master_csv, boot_no)
 
     print(csv_path)
 
@@ -185,6 +186,7 @@ def main(args):
                                           set_scope=train_sets,
                                           use_random_crop=True,
                                           prefill_feature=args.prefill_feature,
+                                          boot_no=boot_no,
                                           data_cohort=args.data_cohort,
                                           shuffle=False, num_workers=args.num_workers, drop_last=False)
 
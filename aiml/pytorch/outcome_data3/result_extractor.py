@@ -13,6 +13,7 @@ from sklearn.metrics import roc_curve, precision_recall_curve
 from path_utils import pytorch_data_root, pytorch_data_server_root, model_root, cache_root_d3 as cache_root
 from aiml.record.result_recorder import Recorder
 from aiml.pytorch.outcome_data3 import protocol
+from aiml.data.feature_store import read_boot
 
 
 np.set_printoptions(precision=3, suppress=True)
@@ -47,8 +48,7 @@ def main(args):
         if args.recompute_info:
             recompute_info(boot_no=boot_no, use_ecg=args.use_ecg, data_cohort=args.data_cohort, exp_path=exp_path)
 
-        df_set = pd.read_csv(os.path.join(cache_root, f'data_raw_trop6_phys_{boot_no}.csv'),
-                             usecols=[f'set{boot_no}', 'dataset'])
+        df_set = read_boot(cache_root, 'data_raw_trop6_phys', boot_no, columns=[f'set{boot_no}', 'dataset'])
         inbag_dataset = df_set.loc[df_set[f'set{boot_no}'] == 'train', 'dataset'].reset_index(drop=True)
         outbag_dataset = df_set.loc[df_set[f'set{boot_no}'] == 'test', 'dataset'].reset_index(drop=True)
 
@@ -11,6 +11,7 @@ from aiml.pytorch.save_utils import save_mat, save_cam_map
 from aiml.pytorch.recorder import Recorder
 from aiml.pytorch.outcome_data3.model import get_network
 from path_utils import cache_root_d3 as cache_root
+from aiml.data.feature_store import get_boot_path
 from torchvision import transforms
 # from apex import amp
 
@@ -235,12 +236,12 @@ def main(args):
     target_info['loss_weights'] = {'loss_{}'.format(k): float(v) for k, v in target_info['loss_weights'].items()}
 
     if args.deploy:
+        boot_no = None
         set_key = 'set'
-        csv_path = os.path.join(args.data_path, args.master_csv + '.csv')
     else:
         boot_no = args.seed
         set_key = 'set{}'.format(boot_no)
-        csv_path = os.path.join(args.data_path, args.master_csv + '_{}.csv'.format(boot_no))
+    csv_path = get_boot_path(args.data_path, args.master_csv, boot_no)
 
     print(csv_path)
 
@@ -262,8 +263,10 @@ def main(args):
                                                 set_scope=train_sets,
                                                 use_random_crop=True,
                                                 prefill_feature=args.prefill_feature,
+                                                boot_no=boot_no,
                                                 data_cohort=args.data_cohort,
-                                                shuffle=True, num_workers=args.num_workers, drop_last=True)
+                                                shuffle=True, num_workers=args.num_workers, drop_last=True,
+                                                pretensorise=args.pretensorise)
 
     val_data_loader = get_loader_from_dataset(csv_path=csv_path,
                                               target_info=target_info,
@@ -274,8 +277,10 @@ def main(args):
                                               set_scope=val_sets,
                                               use_random_crop=False,
                                               prefill_feature=args.prefill_feature,
+                                              boot_no=boot_no,
                                               data_cohort=args.data_cohort,
-                                              shuffle=False, num_workers=args.num_workers, drop_last=False)
+                                              shuffle=False, num_workers=args.num_workers, drop_last=False,
+                                              pretensorise=args.pretensorise)
 
     test_data_loader = get_loader_from_dataset(csv_path=csv_path,
                                                target_info=target_info,
@@ -286,8 +291,10 @@ def main(args):
                                                set_scope=test_sets,
                                                use_random_crop=False,
                                                prefill_feature=args.prefill_feature,
+                                               boot_no=boot_no,
                                                data_cohort=args.data_cohort,
-                                               shuffle=False, num_workers=args.num_workers, drop_last=False)
+                                               shuffle=False, num_workers=args.num_workers, drop_last=False,
+                                               pretensorise=args.pretensorise)
 
     print(train_data_loader.dataset.target_translator)
 
@@ -365,6 +372,8 @@ if __name__ == '__main__':
     parser.add_argument('--prefill_feature', type=utils.str2bool, default='True')
     parser.add_argument('--use_ecg', type=utils.str2bool, default='True')
     parser.add_argument('--data_cohort', type=str, default='f')
+    parser.add_argument('--pretensorise', type=utils.str2bool, default='False',
+                        help='batches as slices of tensors built once, instead of per-sample collation')
 
     args = parser.parse_args()
 
@@ -0,0 +1,261 @@
+import argparse
+import os
+import time
+import datetime
+import numpy as np
+import torch
+import aiml.pytorch.utils as utils
+from aiml.pytorch.save_utils import save_mat
+from aiml.pytorch.recorder import Recorder
+from aiml.pytorch.outcome_data3.model import get_network, get_batched_network
+from aiml.pytorch.outcome_data3.data_loader import TroponinDataset
+from aiml.data import feature_store
+from path_utils import cache_root_d3 as cache_root
+
+# The bootstraps of run_data3.sh in one process: the K boots are replicas of one BatchedTroponinNet, each with its
+# own initialisation (train.py --seed boot), its own train/val/test split from the feature store's split matrix and
+# its own shuffling, stepped together with batched matmuls. Every boot is written as a train.py run would be:
+#   python3 -u train_boots.py --boots 0-49 --save_path ../data/v5.1.1/outcome_data3_lm1_lr5e-3_use_ecg_True_b128
+# gives ../data/v5.1.1/outcome_data3_lm1_lr5e-3_use_ecg_True_b128_s{boot}/net_e{N}.ckpt and the recorder mat files.
+
+device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+
+
+def get_boots(text):
+    # '0-49' or '0,3,7'
+    boots = list()
+    for part in text.split(','):
+        if '-' in part:
+            start, end = part.split('-')
+            boots.extend(range(int(start), int(end) + 1))
+        else:
+            boots.append(int(part))
+    return boots
+
+
+def get_split_idxs(splits, set_name):
+    # (K, n) row positions of set_name per boot; make_splits gives every boot the same set sizes
+    idxs = [np.flatnonzero(s == feature_store.split_names.index(set_name)) for s in splits]
+    if len(set(len(i) for i in idxs)) > 1:
+        raise ValueError('The boots have different {} set sizes, train them separately.'.format(set_name))
+    return torch.tensor(np.stack(idxs), dtype=torch.long)
+
+
+def get_cls_ranges(target_info):
+    # target_maker's column ranges of the classification targets
+    start = len(target_info['regression_cols']) + len(target_info['binary_cls_cols'])
+    ranges = list()
+    for t_name in target_info['cls_cols_dict']:
+        ranges.append((start, start + target_info['cls_cols_dict'][t_name]))
+        start += target_info['cls_cols_dict'][t_name]
+    return ranges
+
+
+def get_batched_info(cls_logits, cls_targets, target_info, ignore_value):
+    """
+    loss_maker, accuracy_maker and prediction_maker of train_utils for the classification targets, over a leading
+    replica dimension: logits and targets (K, N, C) give losses, accus and num_valid_cases (K, 1), preds and targets
+    (K, N, 1) and probs (K, N, C).
+    """
+    losses, accus, num_valid_cases, preds, probs, targets = [dict() for _ in range(6)]
+    for c_name, l, t in zip(target_info['cls_cols_dict'], cls_logits, cls_targets):
+        k = c_name[:max(4, len(c_name))]
+        valid = (t[:, :, 0:1] != ignore_value).type(torch.float)
+
+        # weighting_maker(t, 'cls'): inverse class frequency over the valid cases, over the number of present classes
+        valid_t = t * valid
+        counts = valid_t.sum(dim=1, keepdim=True)
+        weighting = (valid_t / torch.clamp(counts, min=1.)).sum(dim=2, keepdim=True)
+        weighting = weighting / torch.clamp((counts > 0.).type(torch.float).sum(dim=2, keepdim=True), min=1.)
+        loss = - (t * torch.log_softmax(l, dim=2)).sum(dim=2, keepdim=True)
+        losses['loss_' + k] = (loss * weighting).sum(dim=1) / torch.clamp(weighting.sum(dim=1), 1.)
+
+        max_value, max_cls = l.max(dim=2, keepdim=True)
+        max_v, max_idx = t.max(dim=2, keepdim=True)
+        accus['accu_' + k] = (((max_cls == max_idx).type(torch.float) * valid).sum(dim=1) /
+                              torch.clamp(valid.sum(dim=1), 1.))
+        num_valid_cases['nvac_' + k] = valid.sum(dim=1)
+
+        preds['pred_' + k] = max_cls.float()
+        probs['prob_' + k] = l
+        max_idx[max_v == ignore_value] = ignore_value
+        targets['tar_' + k] = max_idx.float()
+
+    return losses, accus, num_valid_cases, preds, probs, targets
+
+
+def add_info(recorders, epoch_no, tag, infos, batch_size):
+    # one Recorder.add_info per boot, as train.py records a batch
+    infos = [{k: v.detach().cpu().numpy() for k, v in info.items()} for info in infos]
+    for r_idx, recorder in enumerate(recorders):
+        for info in infos:
+            recorder.add_info(epoch_no, tag, {k: v[r_idx] for k, v in info.items()})
+        recorder.add_info(epoch_no, tag, {'batch_size': [batch_size]})
+
+
+def get_batch_loss(losses, target_info):
+    # (K,) train.py loss of every replica
+    if 'loss_weights' in target_info:
+        return torch.stack([target_info['loss_weights'][k] * losses[k].view(-1) for k in losses]).sum(dim=0)
+    return torch.stack([v.view(-1) for v in losses.values()]).sum(dim=0)
+
+
+def print_progress(tag, epoch_no, batch_no, num_batches, start_time, loss, accus):
+    elapsed_time = str(datetime.timedelta(seconds=round(time.time() - start_time)))
+    current_time = datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+    disp_str = '[{} Elapsed: {}] [{}] [epoch{} {}/{}] mean over boots loss: {:.3f} '.format(
+        current_time, elapsed_time, tag, epoch_no + 1, batch_no + 1, num_batches, loss)
+    print(disp_str + ' '.join(['{}: {:.3f}'.format(k, v.mean().item()) for k, v in accus.items()]))
+
+
+def train(net, optimizer, dataset, train_idxs, generators, recorders, epoch_no):
+    net.train(mode=True)
+    target_info = dataset.target_info
+
+    # every replica shuffles its own train rows, the batches of a step are stacked on the replica dimension
+    perms = torch.stack([idxs[torch.randperm(len(idxs), generator=g)] for idxs, g in zip(train_idxs, generators)])
+    num_batches = perms.shape[1] // args.batch_size
+    start_time = time.time()
+    for batch_no in range(num_batches):
+        batch_idxs = perms[:, batch_no * args.batch_size:(batch_no + 1) * args.batch_size]
+        features = dataset.features[batch_idxs].to(device)
+        targets = dataset.targets[batch_idxs].to(device)
+
+        _, _, cls_logits = net(features)
+        cls_targets = [targets[:, :, s:e] for s, e in get_cls_ranges(target_info)]
+        infos = get_batched_info(cls_logits, cls_targets, target_info, dataset.ignore_value)
+        train_loss = get_batch_loss(infos[0], target_info)
+
+        net.zero_grad()
+        # the sum, so that replica k gets the gradient of its own loss
+        train_loss.sum().backward()
+        optimizer.step()
+
+        add_info(recorders, epoch_no, 'tra', infos, batch_idxs.shape[1])
+        if np.mod(batch_no + 1, args.display_interval) == 0 or batch_no + 1 == num_batches:
+            print_progress('tra', epoch_no, batch_no, num_batches, start_time, train_loss.mean().item(), infos[1])
+
+    return 0
+
+
+def val(net, dataset, set_idxs, recorders, epoch_no, tag='val'):
+    net.eval()
+    target_info = dataset.target_info
+
+    num_batches = int(np.ceil(set_idxs.shape[1] / args.batch_size))
+    start_time = time.time()
+    for batch_no in range(num_batches):
+        batch_idxs = set_idxs[:, batch_no * args.batch_size:(batch_no + 1) * args.batch_size]
+        features = dataset.features[batch_idxs].to(device)
+        targets = dataset.targets[batch_idxs].to(device)
+
+        with torch.no_grad():
+            _, _, cls_logits = net(features)
+            cls_targets = [targets[:, :, s:e] for s, e in get_cls_ranges(target_info)]
+            infos = get_batched_info(cls_logits, cls_targets, target_info, dataset.ignore_value)
+            val_loss = get_batch_loss(infos[0], target_info)
+
+        add_info(recorders, epoch_no, tag, infos, batch_idxs.shape[1])
+        if np.mod(batch_no + 1, args.display_interval) == 0 or batch_no + 1 == num_batches:
+            print_progress(tag, epoch_no, batch_no, num_batches, start_time, val_loss.mean().item(), infos[1])
+
+    return 0
+
+
+def main(args):
+    boots = get_boots(args.boots)
+    if args.num_threads > 0:
+        torch.set_num_threads(args.num_threads)
+
+    store_path = feature_store.get_store_path(args.data_path, args.master_csv)
+    if not feature_store.is_store(store_path):
+        raise ValueError('{} not found, train_boots reads the feature store written by data_v3.'.format(store_path))
+
+    target_info = {
+        'luke_multiplier': args.lm,
+        'data_cohort': args.data_cohort,
+        'use_ecg': args.use_ecg,
+        'regression_cols': [],
+        'binary_cls_cols': [],
+        'cls_cols_dict': {'adjudicatorDiagnosis': 5},
+        'loss_weights': {'adjudicatorDiagnosis': 1.}
+    }
+    target_info['loss_weights'] = {'loss_{}'.format(k): float(v) for k, v in target_info['loss_weights'].items()}
+
+    # every row of the master table once; the 'set' column of the store is 'train' throughout
+    dataset = TroponinDataset(csv_path=store_path, target_info=target_info, set_key='set', set_scope={'train'},
+                              use_random_crop=False, prefill_feature=args.prefill_feature,
+                              data_cohort=args.data_cohort, pretensorise=True)
+    splits = np.asarray(feature_store.read_splits(store_path)[boots])
+    if splits.shape[1] != len(dataset):
+        raise ValueError('{} has {} rows for {} split columns.'.format(store_path, len(dataset), splits.shape[1]))
+    train_idxs, val_idxs, test_idxs = [get_split_idxs(splits, s) for s in ['train', 'val', 'test']]
+    print('{} boots, {} train, {} val and {} test cases each'.format(
+        len(boots), train_idxs.shape[1], val_idxs.shape[1], test_idxs.shape[1]))
+
+    net = get_batched_network(target_info, boots).to(device)
+    template = get_network(target_info).state_dict()
+    generators = [torch.Generator().manual_seed(boot) for boot in boots]
+    torch.manual_seed(boots[0])
+
+    params = list(net.parameters())
+    if args.optimizer == 'sgd':
+        optimizer = torch.optim.SGD(params, lr=args.learning_rate, weight_decay=5e-4, momentum=0.9)
+    elif args.optimizer == 'adam':
+        optimizer = torch.optim.Adam(params, lr=args.learning_rate, weight_decay=0)
+    else:
+        raise ValueError('Unexpected optimizer: {}'.format(args.optimizer))
+
+    save_paths = ['{}_s{}'.format(args.save_path, boot) for boot in boots]
+    for save_path in save_paths:
+        os.makedirs(save_path, exist_ok=True)
+    recorders = [Recorder() for _ in boots]
+
+    for epoch_no in range(args.num_epochs):
+
+        utils.set_learning_rate(optimizer, epoch_no, args)
+        train(net, optimizer, dataset, train_idxs, generators, recorders, epoch_no)
+        val(net, dataset, val_idxs, recorders, epoch_no)
+        val(net, dataset, test_idxs, recorders, epoch_no, tag='tes')
+        for recorder in recorders:
+            recorder.cat_info(epoch_no)
+
+        disp_epoch_no = epoch_no + 1
+        if np.mod(disp_epoch_no, args.save_interval) == 0:
+            for state_dict, save_path, recorder in zip(net.get_state_dicts(template), save_paths, recorders):
+                torch.save(state_dict, os.path.join(save_path, 'net_e{}.ckpt'.format(disp_epoch_no)))
+                recorder.plot(path=save_path)
+                save_mat(save_path, recorder.master_dict)
+
+    for save_path, recorder in zip(save_paths, recorders):
+        save_mat(save_path, recorder.master_dict)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument('--boots', type=str, default='0-49', help='e.g. 0-49 or 0,3,7')
+    parser.add_argument('--batch_size', type=int, default=128)
+    parser.add_argument('--num_threads', type=int, default=0, help='torch threads, 0 for the torch default')
+    parser.add_argument('--num_epochs', type=int, default=100)
+    parser.add_argument('--save_path', type=str, default='../data/outcome_data3_exp_no1',
+                        help='boot b is saved to <save_path>_s<b>')
+    parser.add_argument('--save_interval', type=int, default=10, help='#epochs')
+    parser.add_argument('--display_interval', type=int, default=50, help='#batches')
+    parser.add_argument('--master_csv', type=str, default='data_raw_trop6_phys')
+
+    parser.add_argument('--learning_rate', type=float, default=1e-3)
+    parser.add_argument('--learning_rate_end', type=float, default=1e-5)
+    parser.add_argument('--optimizer', type=str, default='sgd')
+    parser.add_argument('--lr_decay_policy', type=str, default='linear', choices=['exp', 'linear'])
+
+    parser.add_argument('--lm', type=int, default=1)
+    parser.add_argument('--data_path', type=str, default=cache_root)
+    parser.add_argument('--prefill_feature', type=utils.str2bool, default='True')
+    parser.add_argument('--use_ecg', type=utils.str2bool, default='True')
+    parser.add_argument('--data_cohort', type=str, default='f')
+
+    args = parser.parse_args()
+
+    print(args)
+    main(args)
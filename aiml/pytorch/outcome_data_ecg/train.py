@@ -260,7 +260,8 @@ def main(args):
                                                 set_scope=train_sets,
                                                 use_random_crop=True,
                                                 prefill_feature=args.prefill_feature,
-                                                shuffle=True, num_workers=args.num_workers, drop_last=True)
+                                                shuffle=True, num_workers=args.num_workers, drop_last=True,
+                                                pretensorise=args.pretensorise)
 
     val_data_loader = get_loader_from_dataset(csv_path=csv_path,
                                               target_info=target_info,
@@ -271,7 +272,8 @@ def main(args):
                                               set_scope=val_sets,
                                               use_random_crop=False,
                                               prefill_feature=args.prefill_feature,
-                                              shuffle=False, num_workers=args.num_workers, drop_last=False)
+                                              shuffle=False, num_workers=args.num_workers, drop_last=False,
+                                              pretensorise=args.pretensorise)
 
     test_data_loader = get_loader_from_dataset(csv_path=csv_path,
                                                target_info=target_info,
@@ -282,7 +284,8 @@ def main(args):
                                                set_scope=test_sets,
                                                use_random_crop=False,
                                                prefill_feature=args.prefill_feature,
-                                               shuffle=False, num_workers=args.num_workers, drop_last=False)
+                                               shuffle=False, num_workers=args.num_workers, drop_last=False,
+                                               pretensorise=args.pretensorise)
 
     print(train_data_loader.dataset.target_translator)
 
@@ -358,6 +361,8 @@ if __name__ == '__main__':
     parser.add_argument('--lm', type=int, default=1)
     parser.add_argument('--data_path', type=str, default=cache_root)
     parser.add_argument('--prefill_feature', type=utils.str2bool, default='1')
+    parser.add_argument('--pretensorise', type=utils.str2bool, default='False',
+                        help='batches as slices of tensors built once, instead of per-sample collation')
 
     args = parser.parse_args()
 
@@ -12,7 +12,7 @@ class TroponinDataset(data.Dataset):
     def __init__(self, csv_path,
                  target_info, target_translator=None,
                  set_key=None, set_scope=None,
-                 use_random_crop=None, transform=None):
+                 use_random_crop=None, transform=None, pretensorise=False):
         super(TroponinDataset, self).__init__()
 
         self.use_random_crop = use_random_crop
@@ -78,6 +78,12 @@ class TroponinDataset(data.Dataset):
 
         self.df.reset_index(drop=True)
 
+        # all features and targets as contiguous tensors, so that a batch is a single index into them
+        self.features, self.targets = None, None
+        if pretensorise:
+            self.features = self.get_feature_matrix(self.df)
+            self.targets = self.get_target_matrix(self.df)
+
     def _class2index(self, target_translator):
 
         compute_translator = False
@@ -128,11 +134,13 @@ class TroponinDataset(data.Dataset):
     def __getitem__(self, index):
         """
         Args:
-            index (int): Index
+            index (int): Index, or a list of indices if pretensorised
 
         Returns:
             tuple: Tuple (image, target). target is the object returned by ``coco.loadAnns``.
         """
+        if self.features is not None:
+            return self.features[index], self.targets[index]
         info = self.df.iloc[index]
         return self.get_item(info)
 
@@ -186,6 +194,37 @@ class TroponinDataset(data.Dataset):
 
         return feature, targets
 
+    def get_feature_matrix(self, df):
+        # the features of get_item for every row of df, (N, F, 1, 1), with the same float32 operations
+        features = [torch.tensor(df[self.trop_keys].values.astype(float), dtype=torch.float),
+                    torch.tensor(df[['time_{}'.format(k) for k in self.trop_keys]].values.astype(float),
+                                 dtype=torch.float)]
+        for keys, mean, std in [(self.phys_keys, self.phys_mean, self.phys_std),
+                                (self.bio_keys, self.bio_mean, self.bio_std),
+                                (self.luke_trop_keys, self.luke_mean, self.luke_std)]:
+            feature = torch.tensor(df[keys].values.astype(float), dtype=torch.float)
+            selector = feature == self.ignore_value
+            if mean is not None:
+                feature = (feature - mean.view(1, -1)) / std.view(1, -1)
+            feature[selector] = 0
+            features.append(feature)
+
+        return torch.cat(features, dim=1).view(len(df), -1, 1, 1).contiguous()
+
+    def get_target_matrix(self, df):
+        # the targets of get_item for every row of df, (N, T)
+        targets = [torch.tensor(df[c].values.astype(float), dtype=torch.float).view(-1, 1)
+                   for c in self.target_info['regression_cols'] + self.target_info['binary_cls_cols']]
+        for c, size in self.target_info['cls_cols_dict'].items():
+            v = df[c].values.astype(float).astype(np.int64)
+            ignored = v == self.ignore_value
+            output = torch.zeros(len(df), size, dtype=torch.float)
+            output[torch.tensor(ignored)] += self.ignore_value
+            output[np.flatnonzero(~ignored), v[~ignored]] = 1
+            targets.append(output)
+
+        return torch.cat(targets, 1).contiguous()
+
     def onehot(self, c, v):
         size = self.target_info['cls_cols_dict'][c]
         output = torch.zeros(size, dtype=torch.float)
@@ -223,14 +262,18 @@ def collate_fn(data):
 
 
 def get_loader_from_dataset(csv_path, target_info, target_translator, batch_size, transform, set_key, set_scope,
-                            use_random_crop, shuffle, num_workers, drop_last):
+                            use_random_crop, shuffle, num_workers, drop_last, pretensorise=False):
     dataset = TroponinDataset(
                               csv_path=csv_path,
                               target_info=target_info, target_translator=target_translator,
                               set_key=set_key, set_scope=set_scope,
                               use_random_crop=use_random_crop, transform=transform,
+                              pretensorise=pretensorise
                               )
 
+    if pretensorise:
+        return get_tensor_loader(dataset, batch_size, shuffle, num_workers, drop_last)
+
     # Data loader for wsi dataset
     # This will return (images, captions, lengths) for each iteration.
     # images: a tensor of shape (batch_size, 3, 224, 224).
@@ -244,3 +287,16 @@ def get_loader_from_dataset(csv_path, target_info, target_translator, batch_size
                                               collate_fn=collate_fn)
 
     return data_loader
+
+
+def get_tensor_loader(dataset, batch_size, shuffle, num_workers, drop_last):
+    """
+    Loader of a pretensorised dataset: the batch sampler hands whole index lists to the dataset, which returns the
+    batch as one slice of its tensors, so there is no per-sample work and no collate. The samplers are those
+    DataLoader builds for shuffle, so the batches and their order are the same as with get_loader_from_dataset.
+    """
+    sampler = torch.utils.data.RandomSampler(dataset) if shuffle else torch.utils.data.SequentialSampler(dataset)
+    return torch.utils.data.DataLoader(dataset=dataset,
+                                       sampler=torch.utils.data.BatchSampler(sampler, batch_size, drop_last),
+                                       batch_size=None,
+                                       num_workers=num_workers)
@@ -0,0 +1,226 @@
+import os
+import sys
+import json
+import time
+import queue
+import argparse
+import itertools
+import subprocess
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from aiml.yaml_utils import load_yaml
+from aiml.pytorch.utils import str2bool
+
+# Runs the training sweeps of the run*.sh loops concurrently on one machine:
+#   python aiml/pytorch/sweep.py --config aiml/pytorch/sweep.yaml --threads_per_job 2 --log_path sweep_log
+# Every (script, seed, grid point) of the config is one job, run as its own `python -u <script> --<arg> <value> ...`
+# process from the script's folder. At most num_slots jobs run at a time, each limited to threads_per_job threads
+# (OMP/MKL, which torch takes as its default) and, with --pin_cores, to its own cores, so that the jobs do not
+# oversubscribe the machine. Every finished job is appended to <log_path>/ledger.jsonl; a rerun skips the jobs the
+# ledger has as done with the same command, so a crashed sweep resumes where it stopped.
+
+repo_root = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+thread_env_keys = ['OMP_NUM_THREADS', 'MKL_NUM_THREADS', 'OPENBLAS_NUM_THREADS']
+
+# pins itself to the cores of argv[1] and execs the job in argv[2:]; the jobs are started from the pool's threads,
+# where a preexec_fn is not safe to run between fork and exec
+pin_script = 'import os, sys; os.sched_setaffinity(0, map(int, sys.argv[1].split(","))); ' \
+             'os.execv(sys.argv[2], sys.argv[2:])'
+
+
+def get_seeds(value):
+    # 7, [0, 3, 7] or '0-49'
+    if isinstance(value, int):
+        return [value]
+    if isinstance(value, str):
+        seeds = list()
+        for part in value.split(','):
+            if '-' in part:
+                start, end = part.split('-')
+                seeds.extend(range(int(start), int(end) + 1))
+            else:
+                seeds.append(int(part))
+        return seeds
+    return [int(v) for v in value]
+
+
+def get_jobs(config):
+    """
+    The jobs of a sweep config, {'name', 'group', 'script', 'command', 'num_epochs'} each. A config is a list of
+    groups:
+      - group: outcome_data3
+        script: aiml/pytorch/outcome_data3/train.py
+        name: outcome_data3_lm1_lr{learning_rate}_use_ecg_{use_ecg}_b128_s{seed}
+        seeds: 0-49
+        grid:  # every combination; a dict value sets several args together
+          lr: [{learning_rate: 5e-3, learning_rate_end: 5e-5}]
+          use_ecg: [True, False]
+        args:  # the same for every job, string values can use {name}, {seed} and the grid args
+          save_path: ../data/v5.1.1/{name}
+    """
+    jobs = list()
+    for group in config:
+        grid = group.get('grid') or dict()
+        for seed in get_seeds(group.get('seeds', 0)):
+            for point in itertools.product(*grid.values()):
+                params = {'seed': seed}
+                for axis, value in zip(grid, point):
+                    if isinstance(value, dict):
+                        params.update(value)
+                    else:
+                        params[axis] = value
+                args = dict(group.get('args') or dict())
+                args.update(params)
+                name = group['name'].format(**args)
+                command = [sys.executable, '-u', os.path.basename(group['script'])]
+                for k, v in args.items():
+                    v = v.format(name=name, **args) if isinstance(v, str) else v
+                    command += ['--{}'.format(k), str(v)]
+                jobs.append({'name': name, 'group': group.get('group', group['script']),
+                             'script': os.path.join(repo_root, group['script']), 'command': command,
+                             'num_epochs': int(args['num_epochs']) if 'num_epochs' in args else None})
+
+    names = [j['name'] for j in jobs]
+    if len(set(names)) < len(names):
+        duplicates = sorted(set(n for n in names if names.count(n) > 1))
+        raise ValueError('Duplicate job names, add the varying args to name: {}'.format(duplicates[:5]))
+    return jobs
+
+
+def read_ledger(ledger_path):
+    # the last record of every job name
+    records = dict()
+    if os.path.exists(ledger_path):
+        with open(ledger_path, 'r') as handle:
+            for line in handle:
+                # a line cut off by a crash is skipped, that job runs again
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    continue
+                records[record['name']] = record
+    return records
+
+
+def append_ledger(ledger_path, record):
+    with open(ledger_path, 'ab+') as handle:
+        # after a line cut off by a crash, start a new one
+        handle.seek(0, os.SEEK_END)
+        if handle.tell() > 0:
+            handle.seek(-1, os.SEEK_END)
+            if handle.read(1) != b'\n':
+                handle.write(b'\n')
+        handle.write((json.dumps(record) + '\n').encode())
+        handle.flush()
+        os.fsync(handle.fileno())
+
+
+def get_slot_cores(num_slots, threads_per_job):
+    # disjoint core sets of threads_per_job cores, one per slot
+    cores = sorted(os.sched_getaffinity(0))
+    if num_slots * threads_per_job > len(cores):
+        raise ValueError('{} slots of {} cores need {} cores, {} are available.'.format(
+            num_slots, threads_per_job, num_slots * threads_per_job, len(cores)))
+    return [cores[s_idx * threads_per_job:(s_idx + 1) * threads_per_job] for s_idx in range(num_slots)]
+
+
+def run_job(job, slots, slot_cores, threads_per_job, log_path):
+    """
+    Runs one job in a free slot and returns its ledger record.
+    """
+    slot = slots.get()
+    try:
+        env = dict(os.environ)
+        env.update({k: str(threads_per_job) for k in thread_env_keys})
+        env['PYTHONPATH'] = os.pathsep.join([p for p in [env.get('PYTHONPATH'), repo_root] if p])
+        cores = None if slot_cores is None else slot_cores[slot]
+        command = job['command']
+        if cores is not None:
+            command = [sys.executable, '-c', pin_script, ','.join(str(c) for c in cores)] + command
+
+        start = time.time()
+        with open(os.path.join(log_path, '{}.txt'.format(job['name'])), 'w') as log_file:
+            returncode = subprocess.call(command, cwd=os.path.dirname(job['script']), env=env,
+                                         stdout=log_file, stderr=subprocess.STDOUT)
+        seconds = time.time() - start
+    finally:
+        slots.put(slot)
+
+    return {'name': job['name'], 'group': job['group'], 'status': 'done' if returncode == 0 else 'failed',
+            'returncode': returncode, 'start': start, 'seconds': seconds, 'slot': slot, 'cores': cores,
+            'threads': threads_per_job, 'epochs_per_second': None if job['num_epochs'] is None or seconds <= 0
+            else job['num_epochs'] / seconds, 'command': job['command'][1:]}
+
+
+def print_summary(records, wall_seconds):
+    print('{:<60} {:>8} {:>10} {:>10}'.format('job', 'status', 'seconds', 'epochs/s'))
+    for r in records:
+        print('{:<60} {:>8} {:>10.1f} {:>10}'.format(
+            r['name'][:60], r['status'], r['seconds'],
+            '' if r['epochs_per_second'] is None else '{:.3f}'.format(r['epochs_per_second'])))
+
+    groups = sorted(set(r['group'] for r in records))
+    for group in groups:
+        seconds = [r['seconds'] for r in records if r['group'] == group and r['status'] == 'done']
+        if len(seconds) > 0:
+            print('{}: {} done, {:.1f}s mean, {:.1f}s max per job'.format(
+                group, len(seconds), sum(seconds) / len(seconds), max(seconds)))
+    job_seconds = sum(r['seconds'] for r in records)
+    print('{} jobs ({} failed) in {:.1f}s wall: {:.1f} jobs/hour, {:.2f} jobs running on average'.format(
+        len(records), sum(r['status'] != 'done' for r in records), wall_seconds,
+        len(records) / max(wall_seconds, 1e-9) * 3600, job_seconds / max(wall_seconds, 1e-9)))
+
+
+def main(args):
+    jobs = get_jobs(load_yaml(args.config))
+    if args.groups is not None:
+        jobs = [j for j in jobs if j['group'] in args.groups.split(',')]
+
+    os.makedirs(args.log_path, exist_ok=True)
+    ledger_path = os.path.join(args.log_path, 'ledger.jsonl')
+    ledger = read_ledger(ledger_path)
+    pending = [j for j in jobs if not (j['name'] in ledger and ledger[j['name']]['status'] == 'done' and
+                                       ledger[j['name']]['command'] == j['command'][1:])]
+    print('{} jobs, {} already done, {} to run'.format(len(jobs), len(jobs) - len(pending), len(pending)))
+    if args.dry_run:
+        for job in pending:
+            print('[{}] cd {} && {}'.format(job['name'], os.path.dirname(job['script']), ' '.join(job['command'])))
+        return 0
+
+    num_slots = args.num_slots or max(1, len(os.sched_getaffinity(0)) // args.threads_per_job)
+    slot_cores = get_slot_cores(num_slots, args.threads_per_job) if args.pin_cores else None
+    slots = queue.Queue()
+    for s_idx in range(num_slots):
+        slots.put(s_idx)
+    print('{} slots of {} threads{}'.format(num_slots, args.threads_per_job, ', pinned' if args.pin_cores else ''))
+
+    start = time.time()
+    records = list()
+    with ThreadPoolExecutor(max_workers=num_slots) as pool:
+        # the threads only wait on the job processes
+        futures = [pool.submit(run_job, job, slots, slot_cores, args.threads_per_job, args.log_path)
+                   for job in pending]
+        for future in as_completed(futures):
+            record = future.result()
+            append_ledger(ledger_path, record)
+            records.append(record)
+            print('[{}/{}] {} {} in {:.1f}s'.format(len(records), len(pending), record['name'], record['status'],
+                                                    record['seconds']))
+
+    print_summary(records, time.time() - start)
+    return 0
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--config', type=str, required=True, help='sweep yaml, see get_jobs')
+    parser.add_argument('--log_path', type=str, default='sweep_log', help='job logs and ledger.jsonl')
+    parser.add_argument('--threads_per_job', type=int, default=1)
+    parser.add_argument('--num_slots', type=int, default=None, help='concurrent jobs, #cores / threads_per_job')
+    parser.add_argument('--pin_cores', type=str2bool, default='False', help='give every slot its own cores')
+    parser.add_argument('--groups', type=str, default=None, help='comma separated groups to run, default all')
+    parser.add_argument('--dry_run', type=str2bool, default='False')
+
+    args = parser.parse_args()
+    print(args)
+    main(args)
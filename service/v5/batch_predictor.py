@@ -0,0 +1,792 @@
+import os
+import pickle
+import warnings
+import numpy as np
+import torch
+from path_utils import model_root
+from aiml.utils import get_luke_trop_features
+from service.v5.protocol import get_config
+from service.v5.model_package import load_dl_package
+from service.v5.tree_ensemble import compile_models
+from service.v5.response_cache import ResponseCache, get_cache_key
+from service.v5.recomm_index import RecommIndex
+from service.v5.input_schema import InputSchema, PrefillVector
+from service.v5.query_matcher import QueryMatcher
+from service.v5.metrics import Metrics, StageTimer, null_timer
+from service.v5.explainer import ExpectedGradientsExplainer, get_compact_forward
+
+config = get_config()
+
+day_milliseconds = 24 * 60 * 60 * 1000
+max_ntrop = 6
+
+threshold_methods = ['roc', 'tpr', 'default', 'pr']
+
+control_variable_defaults = {
+    'recomm_outcome_model_type_dl': 'dl', 'recomm_outcome_version_dl': 'v5',
+    'recomm_outcome_model_type_xgb': 'xgb', 'recomm_outcome_version_xgb': 'v5',
+    'recomm_event_model_type': 'xgb', 'recomm_event_version': 'v5',
+    'outcome_model_thld_method_dl': 'tpr',
+    'outcome_model_thld_method_xgb': 'tpr',
+    'event_model_thld_method_xgb': 'tpr',
+    'model_idx': -1,
+    'return_threshold_variants': False,
+    'return_stage_timings': False,
+    'return_explanation': False,
+}
+boolean_control_variables = ['return_threshold_variants', 'return_stage_timings', 'return_explanation']
+
+recomm_versions = ['v3', 'v4', 'v5']
+# the allowed values of the control variables that choose between fixed alternatives
+control_variable_options = {
+    'recomm_outcome_model_type_dl': ['dl'], 'recomm_outcome_version_dl': recomm_versions,
+    'recomm_outcome_model_type_xgb': ['xgb'], 'recomm_outcome_version_xgb': recomm_versions,
+    'recomm_event_model_type': ['xgb'], 'recomm_event_version': recomm_versions,
+    'outcome_model_thld_method_dl': threshold_methods,
+    'outcome_model_thld_method_xgb': threshold_methods,
+    'event_model_thld_method_xgb': threshold_methods,
+}
+
+recomm_feature_keys = ['lhn', 'heart_score']
+
+# model families behind each prediction endpoint, all served from one FeatureRecord per request
+endpoint_families = {
+    '/predict': ('outcome_dl', 'outcome_xgb', 'event_xgb'),
+    '/predict/outcome/dl': ('outcome_dl',),
+    '/predict/outcome/xgb': ('outcome_xgb',),
+    '/predict/event/xgb': ('event_xgb',),
+}
+
+# the 5-class order used in the responses, see reorder() in outcome_data3/result_extractor.py
+p5_order = ['Normal', 'Chronic', 'Acute', 'T2MI', 'T1MI']
+
+
+def get_feature_keys():
+    phys_keys = sorted(config['features']['phys']['data2'])
+    bio_keys = ['gender', 'age', 'angiogram', 'mdrd_gfr']
+    return phys_keys + config['features']['prior']['data3'] + config['features']['ecg']['data3'] + bio_keys
+
+
+def load_package(file_name, model_path=None):
+    if model_path is None:
+        model_path = os.path.join(model_root, 'v5')
+    with open(os.path.join(model_path, file_name), 'rb') as handle:
+        package = pickle.load(handle)
+    return package
+
+
+# lhn is the only string feature
+query_matcher = QueryMatcher(numeric_keys=get_feature_keys() + [k for k in recomm_feature_keys if k != 'lhn'],
+                             string_keys=['lhn'], control_keys=control_variable_defaults,
+                             trop_regex=config['features']['trop_regex'],
+                             time_trop_regex=config['features']['time_trop_regex'])
+
+
+def get_troponin_series(trops, time_trops):
+    if set(trops) != set(time_trops):
+        raise ValueError('Troponin and troponin time keys do not match: [{}] vs [{}].'.format(
+            ', '.join(sorted(trops)), ', '.join(sorted(time_trops))))
+
+    return {i: (time_trops[i] / day_milliseconds, trops[i]) for i in trops}
+
+
+def parse_troponins(query):
+    """
+    Returns the troponin series of a payload as {index: (time in days, value)}, in payload order.
+    """
+    _, _, _, trops, time_trops, _ = query_matcher.match(query)
+    return get_troponin_series(trops, time_trops)
+
+
+def parse_control_variables(query, control_variables):
+    for k, v in query.items():
+        if k in control_variables:
+            control_variables[k] = v
+
+    for k in boolean_control_variables:
+        if control_variables[k] not in [True, False, 'True', 'False', 'true', 'false']:
+            raise ValueError('Control variable {} must be a boolean: {}.'.format(k, control_variables[k]))
+        control_variables[k] = control_variables[k] in [True, 'True', 'true']
+
+    try:
+        control_variables['model_idx'] = int(control_variables['model_idx'])
+    except (TypeError, ValueError):
+        raise ValueError('Control variable model_idx must be an integer: {}.'.format(control_variables['model_idx']))
+    for k, options in control_variable_options.items():
+        if control_variables[k] not in options:
+            raise ValueError('Control variable {} must be one of [{}]: {}.'.format(
+                k, ', '.join(options), control_variables[k]))
+
+    return control_variables
+
+
+def get_control_message(query):
+    # the defaults taken for the control variables a query does not give; the return_* flags are optional
+    defaulted = [k for k in control_variable_defaults if k not in boolean_control_variables and k not in query]
+    if len(defaulted) == 0:
+        return None
+    return 'Control variables not given, defaults used: {}.'.format(
+        ', '.join('{}={}'.format(k, control_variable_defaults[k]) for k in defaulted))
+
+
+def parse_query(query, matched=None):
+    """
+    Splits a single /predict payload into control variables, troponin series and the remaining features.
+    All values may arrive as strings; a failed cast raises ValueError. matched: the query_matcher.match() result
+    of the query if it is already known.
+    """
+    if matched is None:
+        matched = query_matcher.match(query)
+    values, slots, strings, trops, time_trops, _ = matched
+    values = values.tolist()
+    features = {query_matcher.numeric_keys[s]: values[s] for s in slots}
+    features.update(strings)
+
+    series = list(get_troponin_series(trops, time_trops).values())
+    control_variables = parse_control_variables(query, dict(control_variable_defaults))
+    return control_variables, features, series
+
+
+def get_raw_series_arrays(series_list):
+    # (N x T) troponin values and times in days in payload order, nan padded, T at least 6
+    n = len(series_list)
+    n_trop = max([max_ntrop] + [len(s) for s in series_list])
+    trops = np.full([n, n_trop], np.nan)
+    time_hrs = np.full([n, n_trop], np.nan)
+    for r_idx, series in enumerate(series_list):
+        for t_idx, (t, v) in enumerate(series):
+            time_hrs[r_idx, t_idx] = t
+            trops[r_idx, t_idx] = v
+    return trops, time_hrs
+
+
+def get_series_arrays(series_list):
+    """
+    (N x 6) troponin values and times in days, as used for training: troponins beyond 24 hours dropped, the rest
+    ordered by time (nans last), truncated to the first six and clipped below at 3.
+    """
+    trops, time_hrs = get_raw_series_arrays(series_list)
+
+    # troponins beyond 24 hours are not used, as in training
+    selector = time_hrs > 1
+    trops[selector] = np.nan
+    time_hrs[selector] = np.nan
+
+    # order each series by time, nans go last
+    order = np.argsort(time_hrs, axis=1, kind='stable')
+    trops = np.take_along_axis(trops, order, axis=1)[:, :max_ntrop]
+    time_hrs = np.take_along_axis(time_hrs, order, axis=1)[:, :max_ntrop]
+    trops = np.maximum(trops, 3.0)
+    return trops, time_hrs
+
+
+def get_static_matrix(features_list):
+    # the (N x get_feature_keys()) non-troponin features, physiology logged as in aiml/data/data_v3.py
+    keys = get_feature_keys()
+    x = np.array([[f.get(k, np.nan) for k in keys] for f in features_list], dtype=float).reshape(
+        len(features_list), len(keys))
+    log_idx = [keys.index(k) for k in sorted(config['features']['phys']['data2'])
+               if k not in config['features']['phys_no_log']]
+    with np.errstate(all='ignore'):
+        x[:, log_idx] = np.log(x[:, log_idx])
+    return x
+
+
+prefill_vectors = dict()
+
+
+def get_prefill_vector(columns):
+    # prefiller compiled once per frame layout
+    key = tuple(columns)
+    if key not in prefill_vectors:
+        prefill_vectors[key] = PrefillVector(columns, config['prefill']['all'])
+    return prefill_vectors[key]
+
+
+def build_feature_record(trops, time_hrs, luke, luke_names, static):
+    columns = ['trop{}'.format(i) for i in range(max_ntrop)] + ['time_trop{}'.format(i) for i in range(max_ntrop)] + \
+        luke_names + get_feature_keys()
+    data = np.c_[trops, time_hrs, luke, static]
+    return FeatureRecord(columns, get_prefill_vector(columns).apply(data))
+
+
+class FeatureRecord:
+    """
+    Canonical engineered features of a batch in the data_raw_trop6_phys schema, assembled once and shared by every
+    model family. The features are kept as one float matrix; families take typed views of it (column subset,
+    dtype, optional normalisation), which are memoised so that families with the same inputs share one array.
+    """
+
+    def __init__(self, keys, values):
+        self.keys = list(keys)
+        self.key_idx = {k: i for i, k in enumerate(self.keys)}
+        self.values = np.asarray(values, dtype=float)
+        self.views = dict()
+
+    @property
+    def frame(self):
+        # as a DataFrame, for the xgboost runtime only
+        import pandas as pd
+        return pd.DataFrame(self.values, columns=self.keys)
+
+    def __len__(self):
+        return len(self.values)
+
+    def get_view(self, keys, dtype=np.float32, transform=None, name=None):
+        # name identifies the transform, views without a transform are shared by column subset and dtype
+        view_key = (tuple(keys), np.dtype(dtype).str, name)
+        if view_key not in self.views:
+            x = self.values[:, [self.key_idx[k] for k in keys]].astype(dtype)
+            if transform is not None:
+                x = transform(x)
+            self.views[view_key] = x
+        return self.views[view_key]
+
+
+def get_row_key(features, series):
+    # model outputs do not depend on the recommendation features
+    return get_cache_key({k: v for k, v in features.items() if k not in recomm_feature_keys}, series)
+
+
+def assemble_features(features_list, series_list, timer=null_timer):
+    """
+    Builds the FeatureRecord of a batch of parsed queries, following the feature engineering in
+    aiml/data/data_v3.py. timer: a StageTimer for the series, luke and prefill stages.
+    """
+    with timer('series'):
+        trops, time_hrs = get_series_arrays(series_list)
+
+    with timer('luke'), warnings.catch_warnings(), np.errstate(all='ignore'):
+        warnings.simplefilter('ignore', category=RuntimeWarning)
+        luke, luke_names = get_luke_trop_features(trops, time_hrs)
+
+    with timer('prefill'):
+        return build_feature_record(trops, time_hrs, luke, luke_names, get_static_matrix(features_list))
+
+
+def take_row(outputs, r_idx):
+    # (n_models, N, ...) family outputs -> the same structure for the single row r_idx, N = 1
+    if isinstance(outputs, tuple):
+        return tuple(take_row(o, r_idx) for o in outputs)
+    return np.array(outputs[:, r_idx:r_idx + 1])
+
+
+def stack_thresholds(thresholds):
+    # {method: (n_models,)} -> (n_methods, n_models) in threshold_methods order
+    return np.stack([np.asarray(thresholds[m], dtype=float) for m in threshold_methods])
+
+
+def select_models_all(values, thresholds, model_idx):
+    """
+    select_models for several threshold methods at once: thresholds is (n_methods, n_models) and the
+    predictions of all methods come from one vectorised comparison. Returns the response values, the per-method
+    response thresholds and the per-method binary predictions.
+    """
+    if model_idx == -1:
+        return values.tolist(), thresholds.tolist(), (values.mean() >= thresholds.mean(axis=1)).astype(int).tolist()
+    return float(values[model_idx]), thresholds[:, model_idx].tolist(), \
+        (values[model_idx] >= thresholds[:, model_idx]).astype(int).tolist()
+
+
+class OutcomeDLBatchModel:
+    method_key = 'outcome_model_thld_method_dl'
+
+    def __init__(self, package, runtime='fused', torchscript_path=None):
+        self.runtime = runtime
+        if runtime == 'compact':
+            # memory-mapped CompactDLPackage from aiml/dumper/v5/dump_model_package_dl_data3.py
+            self.nets = None
+            self.ensemble = package
+            self.thresholds = package.thresholds
+            self.feature_keys = package.feature_keys
+            self.mean = package.mean
+            self.std = package.std
+            self.ignore_value = package.ignore_value
+            self.class_idx = package.class_idx
+            self.num_models = len(package)
+            self.threshold_matrix = [stack_thresholds(t) for t in self.thresholds]
+            self.background = package.background
+            return
+
+        # the pickled packages and their runtimes need the training code (and torchvision), the compact one does not
+        from aiml.pytorch.outcome_data3.model import get_fused_ensemble, get_quantized_ensemble
+        dataset = package['data_loader'].dataset
+        self.nets = [net.eval() for net, _ in package['models']]
+        if runtime == 'fused':
+            # all seeds in one batched forward pass, see FusedTroponinEnsemble
+            self.ensemble = get_fused_ensemble(self.nets)
+        elif runtime == 'quantized':
+            # int8 hidden layers, see aiml/dumper/v5/validator_quantized_outcome_dl_data3.py for the accuracy impact
+            self.ensemble = get_quantized_ensemble(self.nets)
+        elif runtime == 'torchscript':
+            # folded and frozen artefact from aiml/dumper/v5/export_model_outcome_dl_data3.py
+            self.ensemble = torch.jit.load(torchscript_path)
+        elif runtime == 'sequential':
+            self.ensemble = None
+        else:
+            raise ValueError('Unknown DL runtime: {}'.format(runtime))
+        self.thresholds = [{m: np.array([t[l][m] for _, t in package['models']]) for m in threshold_methods}
+                           for l in range(2)]
+
+        self.feature_keys = dataset.phys_keys + dataset.bio_keys + dataset.binary_keys + dataset.luke_trop_keys
+        num_bins = len(dataset.binary_keys)
+        self.mean = torch.cat([dataset.phys_mean.view(-1), dataset.bio_mean.view(-1), torch.zeros(num_bins),
+                               dataset.luke_mean.view(-1)]).view(1, -1).numpy()
+        self.std = torch.cat([dataset.phys_std.view(-1), dataset.bio_std.view(-1), torch.ones(num_bins),
+                              dataset.luke_std.view(-1)]).view(1, -1).numpy()
+        self.ignore_value = dataset.ignore_value
+
+        translator = dataset.target_translator['adjudicatorDiagnosis']
+        self.class_idx = {k: int(v) for k, v in translator.items()}
+        self.num_models = len(self.nets)
+        self.threshold_matrix = [stack_thresholds(t) for t in self.thresholds]
+        # normalised training rows for the explainer, in packages dumped with one
+        self.background = package.get('shap_background')
+
+    def __len__(self):
+        return self.num_models
+
+    def normalise(self, x):
+        # TroponinDataset.get_feature over the batch: missing features are 0 after normalisation
+        selector = np.isnan(x)
+        x = (x - self.mean) / self.std
+        x[selector] = 0
+        return x
+
+    def get_features(self, record):
+        return record.get_view(self.feature_keys, np.float32, self.normalise, name='outcome_dl')
+
+    def infer_torch(self, x):
+        with torch.no_grad():
+            if self.ensemble is not None:
+                probs, _ = self.ensemble(x)
+                return probs.numpy().astype(float)
+            probs = list()
+            for net in self.nets:
+                _, _, cls_logits = net(x)
+                probs.append(torch.softmax(cls_logits[0], dim=1).numpy().astype(float))
+            return np.stack(probs)
+
+    def get_torch_forward(self):
+        # member-average l1 and l2 (N, 2) of the normalised features, differentiable for the explainer; the
+        # quantised runtime has no gradients, its float members are explained instead
+        if self.nets is None:
+            probs = get_compact_forward(self.ensemble)
+        elif self.ensemble is not None and self.runtime != 'quantized':
+            probs = lambda x: self.ensemble(x)[1]
+        else:
+            probs = lambda x: torch.stack([torch.softmax(net(x)[2][0], dim=1) for net in self.nets]).mean(dim=0)
+
+        # as in inference(), the softmax sums to one so l1 and l2 are linear in the probabilities
+        c = self.class_idx
+
+        def forward(x):
+            p = probs(x)
+            return torch.stack([1 - p[:, c['Chronic']] - p[:, c['Normal']], p[:, c['T1MI']]], dim=1)
+
+        return forward
+
+    def get_explanation(self, phi, expected_value):
+        # (2, F) attributions of l1 and l2 by feature key
+        return {'shap_l1_dl': dict(zip(self.feature_keys, phi[0].tolist())),
+                'shap_l2_dl': dict(zip(self.feature_keys, phi[1].tolist())),
+                'shap_base_l1_dl': float(expected_value[0]), 'shap_base_l2_dl': float(expected_value[1])}
+
+    def inference(self, record):
+        x = self.get_features(record)
+        if self.nets is None:
+            probs, _ = self.ensemble(x)
+            probs = probs.astype(float)
+        else:
+            probs = self.infer_torch(torch.from_numpy(x))
+
+        c = self.class_idx
+        prob_3c0 = probs[..., c['Chronic']] + probs[..., c['Normal']]
+        prob_3c1 = probs[..., c['Acute']] + probs[..., c['T2MI']]
+        prob_3c2 = probs[..., c['T1MI']]
+        normalizer = prob_3c0 + prob_3c1 + prob_3c2
+        l1 = 1 - prob_3c0 / normalizer
+        l2 = 1 - (prob_3c0 + prob_3c1) / normalizer
+        p5 = probs[..., [c[k] for k in p5_order]]
+
+        # (n_models, N), (n_models, N), (n_models, N, 5)
+        return l1, l2, p5
+
+    def get_responses(self, outputs, r_idx, control_variables, methods):
+        # {method: response} for each of the given threshold methods
+        l1, l2, p5 = outputs
+        model_idx = control_variables['model_idx']
+        m_idx = [threshold_methods.index(m) for m in methods]
+        l1_prob, l1_thld, l1_pred = select_models_all(l1[:, r_idx], self.threshold_matrix[0][m_idx], model_idx)
+        l2_prob, l2_thld, l2_pred = select_models_all(l2[:, r_idx], self.threshold_matrix[1][m_idx], model_idx)
+        p5_prob = p5[:, r_idx].mean(axis=0) if model_idx == -1 else p5[model_idx, r_idx]
+        return {m: {'l1_prob_dl': l1_prob, 'l2_prob_dl': l2_prob,
+                    'l1_thld_dl': l1_thld[i], 'l2_thld_dl': l2_thld[i],
+                    'l1_pred_dl': l1_pred[i], 'l2_pred_dl': l2_pred[i],
+                    'p3_pred_dl': l1_pred[i] + l1_pred[i] * l2_pred[i],
+                    'p5_prob_dl': p5_prob.tolist(), 'p5_pred_dl': int(np.argmax(p5_prob)),
+                    'outcome_threshold_method_dl': m} for i, m in enumerate(methods)}
+
+    def get_response(self, outputs, r_idx, control_variables):
+        method = control_variables[self.method_key]
+        return self.get_responses(outputs, r_idx, control_variables, [method])[method]
+
+
+def booster_predict(model, df):
+    import xgboost as xgb
+    if isinstance(model, xgb.XGBModel):
+        return model.predict_proba(df[model.get_booster().feature_names])[:, 1]
+    return model.predict(xgb.DMatrix(df[model.feature_names]))
+
+
+class OutcomeXGBBatchModel:
+    method_key = 'outcome_model_thld_method_xgb'
+
+    def __init__(self, package, runtime='compiled'):
+        self.models = [(m1, m2) for (m1, _), (m2, _) in package['models']]
+        self.thresholds = [{m: np.array([t[l][1][m] for t in package['models']]) for m in threshold_methods}
+                           for l in range(2)]
+        self.threshold_matrix = [stack_thresholds(t) for t in self.thresholds]
+        if runtime == 'compiled':
+            # level-1 and level-2 models of every bootstrap in one flattened tree ensemble
+            self.ensemble = compile_models([m1 for m1, _ in self.models] + [m2 for _, m2 in self.models])
+        elif runtime == 'xgboost':
+            self.ensemble = None
+        else:
+            raise ValueError('Unknown XGB runtime: {}'.format(runtime))
+
+    def __len__(self):
+        return len(self.models)
+
+    def inference(self, record):
+        if self.ensemble is not None:
+            s = self.ensemble.predict(record.get_view(self.ensemble.feature_names))
+            return s[:len(self.models)], s[len(self.models):]
+        s1 = np.stack([booster_predict(m1, record.frame) for m1, _ in self.models]).astype(float)
+        s2 = np.stack([booster_predict(m2, record.frame) for _, m2 in self.models]).astype(float)
+        return s1, s2
+
+    def get_responses(self, outputs, r_idx, control_variables, methods):
+        s1, s2 = outputs
+        model_idx = control_variables['model_idx']
+        m_idx = [threshold_methods.index(m) for m in methods]
+        l1_prob, l1_thld, l1_pred = select_models_all(s1[:, r_idx], self.threshold_matrix[0][m_idx], model_idx)
+        l2_prob, l2_thld, l2_pred = select_models_all(s2[:, r_idx], self.threshold_matrix[1][m_idx], model_idx)
+        return {m: {'l1_prob_xgb': l1_prob, 'l2_prob_xgb': l2_prob,
+                    'l1_thld_xgb': l1_thld[i], 'l2_thld_xgb': l2_thld[i],
+                    'l1_pred_xgb': l1_pred[i], 'l2_pred_xgb': l2_pred[i],
+                    'p3_pred_xgb': l1_pred[i] + l1_pred[i] * l2_pred[i],
+                    'outcome_threshold_method_xgb': m} for i, m in enumerate(methods)}
+
+    def get_response(self, outputs, r_idx, control_variables):
+        method = control_variables[self.method_key]
+        return self.get_responses(outputs, r_idx, control_variables, [method])[method]
+
+
+class EventXGBBatchModel:
+    method_key = 'event_model_thld_method_xgb'
+
+    def __init__(self, package, label_name='event_dmi30d', runtime='compiled'):
+        self.label_name = label_name
+        self.models = [m1 for m1, _ in package['models']]
+        self.thresholds = {m: np.array([t[m] for _, t in package['models']]) for m in threshold_methods}
+        self.threshold_matrix = stack_thresholds(self.thresholds)
+        if runtime == 'compiled':
+            self.ensemble = compile_models(self.models)
+        elif runtime == 'xgboost':
+            self.ensemble = None
+        else:
+            raise ValueError('Unknown XGB runtime: {}'.format(runtime))
+
+    def __len__(self):
+        return len(self.models)
+
+    def inference(self, record):
+        if self.ensemble is not None:
+            return self.ensemble.predict(record.get_view(self.ensemble.feature_names))
+        return np.stack([booster_predict(m1, record.frame) for m1 in self.models]).astype(float)
+
+    def get_responses(self, outputs, r_idx, control_variables, methods):
+        model_idx = control_variables['model_idx']
+        m_idx = [threshold_methods.index(m) for m in methods]
+        prob, thld, pred = select_models_all(outputs[:, r_idx], self.threshold_matrix[m_idx], model_idx)
+        above_1pc = int(np.mean(prob) > 0.01)
+        return {m: {'{}_prob_xgb'.format(self.label_name): prob,
+                    '{}_thld_xgb'.format(self.label_name): thld[i],
+                    '{}_pred_xgb'.format(self.label_name): pred[i],
+                    '{}_above_1pc_pred_xgb'.format(self.label_name): above_1pc,
+                    '{}_threshold_method'.format(self.label_name): m} for i, m in enumerate(methods)}
+
+    def get_response(self, outputs, r_idx, control_variables):
+        method = control_variables[self.method_key]
+        return self.get_responses(outputs, r_idx, control_variables, [method])[method]
+
+
+class BatchPredictor:
+    """
+    Scores N encounters at once: one feature frame is built for the whole batch and every model family is
+    evaluated once on it. A single /predict call is the batch of one, so the two always agree.
+    Model outputs are cached per (feature hash, family) for cache_ttl seconds, up to cache_size entries.
+    Under dl_runtime='quantized' the DL outputs are not batch-invariant (activations are quantised per batch), so
+    a cached DL output is the one of the batch that first scored the row: repeating a query can give a slightly
+    different answer than scoring it afresh, within the single_vs_batch delta of the validator report.
+    Every batch is timed per stage into self.metrics, see metrics_text(). return_explanation adds the DL
+    attributions of explain_samples expected-gradient samples, with an explainer built once at startup.
+    """
+
+    def __init__(self, model_path=None, dl_runtime='fused', xgb_runtime='compiled', cache_size=4096, cache_ttl=300.,
+                 explain_samples=64):
+        if model_path is None:
+            model_path = os.path.join(model_root, 'v5')
+        if dl_runtime == 'compact':
+            dl_package = load_dl_package(os.path.join(model_path, 'outcome_models_dl_data3'))
+        else:
+            dl_package = load_package('outcome_models_dl_data3.pickle', model_path)
+        self.outcome_dl = OutcomeDLBatchModel(dl_package, runtime=dl_runtime,
+                                              torchscript_path=os.path.join(model_path, 'outcome_models_dl_data3.pt'))
+        self.outcome_xgb = OutcomeXGBBatchModel(load_package('outcome_models_xgb_data3.pickle', model_path),
+                                                runtime=xgb_runtime)
+        self.event_xgb = EventXGBBatchModel(load_package('event_dmi30d_models_data3.pickle', model_path),
+                                            runtime=xgb_runtime)
+        self.recomm = RecommIndex(
+            recomm_path=os.path.join(model_path, 'rapidx_recommendations_v4.csv'),
+            conv_path=os.path.join(model_path, 'outcome_conversion.csv'),
+            lhn_path=os.path.join(model_path, 'lhn_classification.csv'))
+        self.num_models = min(len(self.outcome_dl), len(self.outcome_xgb), len(self.event_xgb))
+        self.schema = InputSchema(query_matcher.numeric_keys)
+        # model outputs of repeated queries, the threshold and recommendation stage is always recomputed
+        self.cache = ResponseCache(max_size=cache_size, ttl=cache_ttl)
+        self.metrics = Metrics()
+        self.explainer = None
+        if explain_samples > 0 and self.outcome_dl.background is not None:
+            self.explainer = ExpectedGradientsExplainer(self.outcome_dl.get_torch_forward(),
+                                                        self.outcome_dl.background, num_samples=explain_samples)
+
+    def check_control_variables(self, control_variables):
+        if not -1 <= control_variables['model_idx'] < self.num_models:
+            raise ValueError('Control variable model_idx out of range [-1, {}): {}.'.format(
+                self.num_models, control_variables['model_idx']))
+        if control_variables['return_explanation'] and self.explainer is None:
+            raise ValueError('Explanations are not available, the DL package has no background sample.')
+
+    def parse(self, queries, timer=null_timer):
+        # extras: response fields of the accepted rows besides the model outputs (key summary, warnings)
+        parsed = list()
+        errors = dict()
+        extras = dict()
+        with timer('parse'):
+            for q_idx, query in enumerate(queries):
+                if not isinstance(query, dict):
+                    errors[q_idx] = {'error_message': 'Queries must be JSON objects: {}.'.format(query)}
+                    continue
+                try:
+                    matched = query_matcher.match(query)
+                    control_variables, features, series = parse_query(query, matched)
+                    self.check_control_variables(control_variables)
+                    parsed.append((q_idx, control_variables, features, series))
+                    extras[q_idx] = query_matcher.summarise(query, matched)
+                    control_message = get_control_message(query)
+                    if control_message is not None:
+                        extras[q_idx]['control_message'] = control_message
+                except (TypeError, ValueError) as e:
+                    errors[q_idx] = {'error_message': str(e)}
+        if len(parsed) == 0:
+            return parsed, errors, extras
+
+        with timer('validate'):
+            input_errors, warning_messages = self.validate_inputs([features for _, _, features, _ in parsed],
+                                                                  [series for _, _, _, series in parsed])
+        for r_idx, message in input_errors.items():
+            errors[parsed[r_idx][0]] = {'error_message': message}
+            extras.pop(parsed[r_idx][0])
+        for r_idx, message in warning_messages.items():
+            extras[parsed[r_idx][0]]['warning_message'] = message
+        return [p for r_idx, p in enumerate(parsed) if r_idx not in input_errors], errors, extras
+
+    def validate_inputs(self, features_list, series_list):
+        """
+        Bound checks of a whole batch at once. Features dropped as missing are removed from their dicts; returns
+        the error and the warning messages by row.
+        """
+        x = self.schema.get_matrix(features_list)
+        given = ~np.isnan(x)
+        x, error_mask, warning_mask = self.schema.validate(x, *get_raw_series_arrays(series_list))
+        for r_idx, k_idx in zip(*np.nonzero(given & np.isnan(x))):
+            features_list[r_idx].pop(self.schema.feature_keys[k_idx])
+
+        failed = error_mask.any(axis=1)
+        errors = {r_idx: 'Input {}'.format(self.schema.get_message(error_mask[r_idx]))
+                  for r_idx in np.nonzero(failed)[0]}
+        warning_messages = {r_idx: 'Input {}'.format(self.schema.get_message(warning_mask[r_idx]))
+                            for r_idx in np.nonzero(warning_mask.any(axis=1) & ~failed)[0]}
+        return errors, warning_messages
+
+    def check_inputs(self, features, series):
+        # validate_inputs for one encounter: raises the error, returns the warning (or None)
+        errors, warning_messages = self.validate_inputs([features], [series])
+        if 0 in errors:
+            raise ValueError(errors[0])
+        return warning_messages.get(0)
+
+    def inference_outputs(self, parsed, families, timer=null_timer):
+        # model outputs per parsed row, from the cache or from one batched pass over the rows that missed it
+        with timer('cache'):
+            keys = [get_row_key(features, series) for _, _, features, series in parsed]
+            row_outputs = [dict() for _ in parsed]
+            for r_idx, key in enumerate(keys):
+                for f in families:
+                    output = self.cache.get((key, f))
+                    if output is not None:
+                        row_outputs[r_idx][f] = output
+
+        missed = [r_idx for r_idx in range(len(parsed)) if len(row_outputs[r_idx]) < len(families)]
+        if len(missed) == 0:
+            return row_outputs
+
+        record = assemble_features([parsed[r_idx][2] for r_idx in missed], [parsed[r_idx][3] for r_idx in missed],
+                                   timer)
+        for f in families:
+            if all(f in row_outputs[r_idx] for r_idx in missed):
+                continue
+            with timer(f):
+                outputs = getattr(self, f).inference(record)
+            for m_idx, r_idx in enumerate(missed):
+                if f not in row_outputs[r_idx]:
+                    row_outputs[r_idx][f] = take_row(outputs, m_idx)
+                    self.cache.put((keys[r_idx], f), row_outputs[r_idx][f])
+
+        return row_outputs
+
+    def explain(self, parsed):
+        # DL attributions of the parsed rows, cached by feature hash like the model outputs
+        keys = [get_row_key(features, series) for _, _, features, series in parsed]
+        phi = [self.cache.get((key, 'explain_dl')) for key in keys]
+        missed = [r_idx for r_idx, p in enumerate(phi) if p is None]
+        if len(missed) > 0:
+            record = assemble_features([parsed[r_idx][2] for r_idx in missed], [parsed[r_idx][3] for r_idx in missed])
+            values = self.explainer.shap_values(self.outcome_dl.get_features(record))
+            for m_idx, r_idx in enumerate(missed):
+                phi[r_idx] = values[m_idx]
+                self.cache.put((keys[r_idx], 'explain_dl'), phi[r_idx])
+        return [self.outcome_dl.get_explanation(p, self.explainer.expected_value) for p in phi]
+
+    def get_recommendation(self, features, control_variables, family_responses):
+        return self.recomm.inference_single(
+            features={k: features[k] for k in recomm_feature_keys if k in features},
+            control_variables=control_variables,
+            response_outcome_dl=family_responses['outcome_dl'],
+            response_outcome_xgb=family_responses['outcome_xgb'],
+            response_event=family_responses['event_xgb'])
+
+    def get_recommendations(self, features_list, control_variables_list, responses):
+        # one vectorised rule lookup for all rows, a merged response carries every family's predictions
+        return self.recomm.inference_batch(
+            features=[{k: f[k] for k in recomm_feature_keys if k in f} for f in features_list],
+            control_variables=control_variables_list,
+            response_outcome_dl=responses, response_outcome_xgb=responses, response_event=responses)
+
+    def get_response(self, outputs, control_variables, features, families, recommend=True):
+        # outputs: {family: single row outputs}, thresholds and recommendations are applied here
+        variants = control_variables['return_threshold_variants']
+        family_variants = dict()
+        for f in families:
+            family = getattr(self, f)
+            methods = threshold_methods if variants else [control_variables[family.method_key]]
+            family_variants[f] = family.get_responses(outputs[f], 0, control_variables, methods)
+
+        family_responses = {f: family_variants[f][control_variables[getattr(self, f).method_key]]
+                            for f in families}
+        response = dict()
+        for f in families:
+            response.update(family_responses[f])
+        if len(families) == 3 and recommend:
+            response.update(self.get_recommendation(features, control_variables, family_responses))
+
+        if variants:
+            # every method applied to the same probabilities, the recommendation follows the xgb outcome method
+            response['threshold_variants'] = dict()
+            for m in threshold_methods:
+                variant = dict()
+                for f in families:
+                    variant.update({k: v for k, v in family_variants[f][m].items() if 'prob' not in k})
+                if len(families) == 3:
+                    variant_control_variables = dict(control_variables)
+                    variant_control_variables.update({getattr(self, f).method_key: m for f in families})
+                    variant.update(self.get_recommendation(features, variant_control_variables,
+                                                           {f: family_variants[f][m] for f in families}))
+                response['threshold_variants'][m] = variant
+        return response
+
+    def score(self, parsed, families, responses, timer=null_timer):
+        # model outputs, thresholds and recommendations of the parsed rows, written to responses by query index
+        row_outputs = self.inference_outputs(parsed, families, timer)
+        with timer('thresholds'):
+            for r_idx, (q_idx, control_variables, features, _) in enumerate(parsed):
+                responses[q_idx] = self.get_response(row_outputs[r_idx], control_variables, features, families,
+                                                     recommend=False)
+        if len(families) == 3:
+            with timer('recommendation'):
+                rows = [responses[q_idx] for q_idx, _, _, _ in parsed]
+                for response, recommendation in zip(rows, self.get_recommendations(
+                        [features for _, _, features, _ in parsed], [cvs for _, cvs, _, _ in parsed], rows)):
+                    response.update(recommendation)
+
+        explained = [p for p in parsed if p[1]['return_explanation']]
+        if 'outcome_dl' in families and len(explained) > 0:
+            with timer('explain'):
+                for (q_idx, _, _, _), explanation in zip(explained, self.explain(explained)):
+                    responses[q_idx].update(explanation)
+        return responses
+
+    def inference_batch(self, queries, families=('outcome_dl', 'outcome_xgb', 'event_xgb')):
+        timer = StageTimer()
+        parsed, errors, extras = self.parse(queries, timer)
+        responses = [errors.get(q_idx) for q_idx in range(len(queries))]
+        if len(parsed) > 0:
+            self.score(parsed, families, responses, timer)
+        for q_idx, extra in extras.items():
+            responses[q_idx].update(extra)
+        self.metrics.observe(timer, len(queries), len(errors))
+
+        # the stage timings of the whole batch, for the rows that asked for them
+        for q_idx, control_variables, _, _ in parsed:
+            if control_variables['return_stage_timings']:
+                responses[q_idx]['stage_timings'] = {'batch_size': len(queries), 'stage_ms': timer.get_ms()}
+        return responses
+
+    def inference_single(self, query, families=('outcome_dl', 'outcome_xgb', 'event_xgb')):
+        return self.inference_batch([query], families=families)[0]
+
+    def cache_stats(self):
+        return self.cache.stats()
+
+    def metrics_text(self, histograms=None, labels=None):
+        # histograms and labels of the server in front of the predictor, see Metrics.render
+        cache = self.cache.stats()
+        return self.metrics.render({'cache_hits': cache['hits'], 'cache_misses': cache['misses'],
+                                    'cache_evictions': cache['evictions'], 'cache_expirations': cache['expirations']},
+                                   histograms, labels)
+
+
+def predict_batch_post(predictor, post_data):
+    """
+    Handler body for POST /predict/batch. post_data is {'queries': [query, ...]} where each query is the
+    payload of a single /predict call; the responses come back in the same order.
+    """
+    if not isinstance(post_data, dict) or not isinstance(post_data.get('queries'), list):
+        return {'error_message': 'Batch requests must provide a list of queries under the key "queries".'}
+
+    return {'responses': predictor.inference_batch(post_data['queries']), 'batch_size': len(post_data['queries'])}
+
+
+def parse_variables_post(post_data):
+    """
+    Handler body for POST /tools/parse_variables: how the keys of a /predict payload are read, see
+    QueryMatcher.summarise.
+    """
+    if not isinstance(post_data, dict):
+        return {'error_message': 'Queries must be JSON objects: {}.'.format(post_data)}
+    try:
+        return query_matcher.classify(post_data)
+    except (TypeError, ValueError) as e:
+        return {'error_message': str(e)}
@@ -0,0 +1,215 @@
+import os
+import json
+import time
+import argparse
+import multiprocessing
+import numpy as np
+import pandas as pd
+import torch
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+from service.v5.batch_predictor import BatchPredictor
+from service.v5.prefork import freeze_predictor
+
+# Back-scoring of encounter files through the deployed pipeline, in process:
+#   python -m service.v5.bulk_score --input data_v3.csv --output scores_v3 --num_workers 8
+# Every input row is the body of one /predict call (its non-empty columns, as test_development_deployment_consistency
+# sends them). The input is read in chunks of --chunk_size rows, scored by forked workers that share the model
+# weights like the pre-fork server, and each chunk is written to its own part file in the output folder, so at most
+# 2 * num_workers chunks are held at any time. A chunk that fails is reported and the others carry on; it has no part
+# file, so a rerun with the same output folder scores it again and skips the chunks already written.
+
+predictor = None
+
+default_drop_keys = 'matched_query_dict,unmatched_query_keys,unused_query_keys,control_message'
+
+
+def check_parquet():
+    try:
+        import pyarrow.parquet
+    except ImportError:
+        raise ValueError('Parquet files need pyarrow, which is not installed; use CSV instead.')
+
+
+def read_chunks(input_path, chunk_size):
+    # DataFrames of chunk_size rows, without reading the whole file
+    if input_path.endswith('.parquet'):
+        check_parquet()
+        import pyarrow.parquet
+        for batch in pyarrow.parquet.ParquetFile(input_path).iter_batches(batch_size=chunk_size):
+            yield batch.to_pandas()
+    else:
+        for chunk in pd.read_csv(input_path, chunksize=chunk_size):
+            yield chunk
+
+
+def get_queries(chunk):
+    return [{k: v for k, v in row.items() if not pd.isna(v)} for row in chunk.to_dict('records')]
+
+
+def flatten_response(response, drop_keys):
+    # one table row: per-seed lists as <key>_<seed>, dicts of numbers as <key>_<name>, anything else as JSON text
+    flat = dict()
+    for k, v in response.items():
+        if k in drop_keys:
+            continue
+        if isinstance(v, list) and all(isinstance(e, (int, float)) for e in v):
+            flat.update({'{}_{}'.format(k, i): e for i, e in enumerate(v)})
+        elif isinstance(v, dict) and all(isinstance(e, (int, float)) for e in v.values()):
+            flat.update({'{}_{}'.format(k, n): e for n, e in v.items()})
+        elif isinstance(v, (list, dict)):
+            flat[k] = json.dumps(v)
+        else:
+            flat[k] = v
+    return flat
+
+
+def get_columns(drop_keys):
+    # the columns of every part file, from the response of a plain query, so that all parts share one schema
+    response = predictor.inference_single({'age': 50, 'gender': 0})
+    return ['error_message', 'warning_message'] + [k for k in flatten_response(response, drop_keys)
+                                                   if k not in ['error_message', 'warning_message']]
+
+
+def get_part_path(output_path, chunk_idx, output_format):
+    return os.path.join(output_path, 'part-{:05d}.{}'.format(chunk_idx, output_format))
+
+
+def score_chunk(chunk_idx, chunk, config):
+    """
+    Scores one chunk in a worker and writes its part file; returns (chunk_idx, rows, errors, seconds).
+    """
+    start = time.perf_counter()
+    queries = get_queries(chunk)
+    responses = list()
+    for b_idx in range(0, len(queries), config['batch_size']):
+        responses += predictor.inference_batch(queries[b_idx:b_idx + config['batch_size']])
+
+    rows = [flatten_response(r, config['drop_keys']) for r in responses]
+    # the part files share the manifest columns, a response with other keys fails the chunk instead of losing them
+    extra = sorted({k for row in rows for k in row} - set(config['columns']))
+    if len(extra) > 0:
+        raise ValueError('Chunk {} has response keys that are not in the manifest columns: [{}]; add them to '
+                         '--drop_keys or score these rows separately.'.format(chunk_idx, ', '.join(extra)))
+    frame = pd.DataFrame(rows, columns=config['columns'])
+    frame.insert(0, 'row', np.arange(len(chunk)) + chunk_idx * config['chunk_size'])
+    for c_idx, column in enumerate([c for c in config['id_columns'] if c in chunk.columns]):
+        frame.insert(c_idx + 1, column, chunk[column].values)
+
+    # written under a temporary name first, a part file that exists is complete
+    part_path = get_part_path(config['output_path'], chunk_idx, config['output_format'])
+    temp_path = part_path + '.tmp'
+    if config['output_format'] == 'parquet':
+        frame.to_parquet(temp_path, index=False)
+    else:
+        frame.to_csv(temp_path, index=False)
+    os.replace(temp_path, part_path)
+    return chunk_idx, len(chunk), int(frame['error_message'].notna().sum()), time.perf_counter() - start
+
+
+def init_worker(threads_per_worker):
+    torch.set_num_threads(threads_per_worker)
+
+
+def check_manifest(output_path, manifest):
+    # a resumed run must cut the input into the same chunks and write the same columns
+    manifest_path = os.path.join(output_path, 'manifest.json')
+    if os.path.exists(manifest_path):
+        with open(manifest_path, 'r') as handle:
+            saved = json.load(handle)
+        for k in ['input', 'chunk_size', 'output_format', 'columns', 'id_columns', 'drop_keys']:
+            if saved.get(k) != manifest[k]:
+                raise ValueError('{} was written with a different {}, use a new output folder.'.format(
+                    output_path, k))
+    else:
+        with open(manifest_path, 'w') as handle:
+            json.dump(manifest, handle, indent=2)
+
+
+def main(args):
+    global predictor
+    if args.output_format not in ['parquet', 'csv']:
+        raise ValueError('Unknown output format: {}'.format(args.output_format))
+    if args.output_format == 'parquet':
+        check_parquet()
+    os.makedirs(args.output, exist_ok=True)
+
+    # loaded once and shared copy-on-write with the forked workers, see service/v5/prefork.py
+    torch.set_num_threads(1)
+    predictor = BatchPredictor(model_path=args.model_path, dl_runtime=args.dl_runtime, xgb_runtime=args.xgb_runtime,
+                               cache_size=0, explain_samples=0)
+    drop_keys = args.drop_keys.split(',') if args.drop_keys else list()
+    config = {'columns': get_columns(drop_keys), 'drop_keys': drop_keys, 'chunk_size': args.chunk_size,
+              'batch_size': args.batch_size, 'output_path': args.output, 'output_format': args.output_format,
+              'id_columns': args.id_columns.split(',') if args.id_columns else list()}
+    check_manifest(args.output, {'input': os.path.abspath(args.input), 'chunk_size': args.chunk_size,
+                                 'output_format': args.output_format, 'columns': config['columns'],
+                                 'id_columns': config['id_columns'], 'drop_keys': drop_keys})
+    freeze_predictor(predictor)
+
+    num_workers = args.num_workers or max(1, (os.cpu_count() or 1) // args.threads_per_worker)
+    start = time.perf_counter()
+    num_rows, num_errors, num_skipped = 0, 0, 0
+    pending = set()
+    chunk_indices = dict()
+    failed = list()
+    with ProcessPoolExecutor(max_workers=num_workers, mp_context=multiprocessing.get_context('fork'),
+                             initializer=init_worker, initargs=(args.threads_per_worker,)) as pool:
+
+        def collect(block):
+            # reports the finished chunks, waiting for one if block
+            nonlocal pending, num_rows, num_errors
+            done, pending = wait(pending, timeout=None if block else 0, return_when=FIRST_COMPLETED)
+            for future in sorted(done, key=lambda f: chunk_indices[f]):
+                try:
+                    chunk_idx, rows, errors, seconds = future.result()
+                except Exception as e:
+                    failed.append(chunk_indices[future])
+                    print('chunk {} failed, it is scored again on a rerun: {!r}'.format(chunk_indices[future], e))
+                    continue
+                num_rows += rows
+                num_errors += errors
+                elapsed = time.perf_counter() - start
+                print('chunk {}: {} rows, {} errors in {:.1f}s; {} rows in {:.1f}s, {:.1f} rows/s'.format(
+                    chunk_idx, rows, errors, seconds, num_rows, elapsed, num_rows / elapsed))
+
+        for chunk_idx, chunk in enumerate(read_chunks(args.input, args.chunk_size)):
+            if os.path.exists(get_part_path(args.output, chunk_idx, args.output_format)):
+                num_skipped += 1
+                continue
+            while len(pending) >= 2 * num_workers:
+                collect(True)
+            future = pool.submit(score_chunk, chunk_idx, chunk, config)
+            chunk_indices[future] = chunk_idx
+            pending.add(future)
+            collect(False)
+        while len(pending) > 0:
+            collect(True)
+
+    elapsed = time.perf_counter() - start
+    print('scored {} rows ({} errors) in {:.1f}s, {:.1f} rows/s; {} chunks already done'.format(
+        num_rows, num_errors, elapsed, num_rows / max(elapsed, 1e-9), num_skipped))
+    if len(failed) > 0:
+        print('{} chunks failed: {}; rerun with the same output folder to score them'.format(
+            len(failed), sorted(failed)))
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--input', type=str, required=True, help='.csv or .parquet')
+    parser.add_argument('--output', type=str, required=True, help='folder of part files')
+    parser.add_argument('--output_format', type=str, default='csv', help='csv or parquet (needs pyarrow)')
+    parser.add_argument('--chunk_size', type=int, default=10000)
+    parser.add_argument('--batch_size', type=int, default=512)
+    parser.add_argument('--num_workers', type=int, default=None)
+    parser.add_argument('--threads_per_worker', type=int, default=1)
+    parser.add_argument('--id_columns', type=str, default='idPatient', help='input columns copied to the output')
+    parser.add_argument('--drop_keys', type=str, default=default_drop_keys, help='response keys not written')
+    parser.add_argument('--model_path', type=str, default=None)
+    parser.add_argument('--dl_runtime', type=str, default='fused')
+    parser.add_argument('--xgb_runtime', type=str, default='compiled')
+
+    args = parser.parse_args()
+    print(args)
+    main(args)
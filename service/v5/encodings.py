@@ -0,0 +1,223 @@
+import json
+import math
+import struct
+import numpy as np
+
+# Response encodings of the v5 service, chosen by the Accept header of the request. JSON is the default; batch
+# clients can ask for the columnar encoding, where every response key is one packed array over the rows, e.g.
+# l1_prob_dl becomes a float32 (num_rows, num_seeds) matrix instead of a list of per-seed lists:
+#
+#   magic b'RPDX', uint32 version, uint32 header length, the JSON header, zero padding to a multiple of 8 bytes, then
+#   the column buffers, each padded to a multiple of 8 bytes; all little endian.
+#
+# The header is {'num_rows', 'fields': {non-row values such as batch_size}, 'columns': [...]}, one entry
+# {'name', 'kind', 'dtype', 'shape', 'offset', 'nbytes', 'valid_offset', 'valid_nbytes'} per column, offsets
+# counted from the end of the header padding (plus 'keys' for the 'matrix' kind and 'data_offset'/'data_nbytes' for
+# strings). The valid buffer is a bitmap (least significant bit first) of the rows that have the key, so every value
+# a row has, -1, '', NaN or null included, is sent as it is. Only probabilities are packed as float32, every other
+# number keeps its JSON precision as int64 or float64. decode_columnar reads it back with numpy only.
+
+json_content_type = 'application/json'
+columnar_content_type = 'application/vnd.rapidx.columnar'
+
+columnar_magic = b'RPDX'
+columnar_version = 2
+
+
+def get_encoding(accept):
+    """
+    'json' or 'columnar' for an Accept header, by q-value and then order; anything else is answered with JSON.
+    """
+    best, best_q = 'json', 0.
+    for part in (accept or '').split(','):
+        items = [s.strip() for s in part.split(';')]
+        q = 1.
+        for item in items[1:]:
+            if item.startswith('q='):
+                try:
+                    q = float(item[2:])
+                except ValueError:
+                    q = 0.
+        if items[0] == columnar_content_type and q > best_q:
+            best, best_q = 'columnar', q
+        elif items[0] in [json_content_type, 'application/*', '*/*'] and q > best_q:
+            best, best_q = 'json', q
+    return best
+
+
+def replace_non_finite(obj):
+    # NaN and inf are not JSON, they are sent as null
+    if isinstance(obj, float):
+        return obj if math.isfinite(obj) else None
+    if isinstance(obj, dict):
+        return {k: replace_non_finite(v) for k, v in obj.items()}
+    if isinstance(obj, (list, tuple)):
+        return [replace_non_finite(v) for v in obj]
+    return obj
+
+
+def encode_json(response):
+    # strict JSON (double quotes, no NaN) without whitespace; the responses are trees, so no cycle check
+    try:
+        text = json.dumps(response, separators=(',', ':'), allow_nan=False, check_circular=False)
+    except ValueError:
+        text = json.dumps(replace_non_finite(response), separators=(',', ':'), allow_nan=False)
+    return text.encode('utf-8')
+
+
+def is_probability(name, array):
+    # probabilities are sent as float32, any other float keeps float64
+    return '_prob' in name and bool(np.all((array >= 0) & (array <= 1) | np.isnan(array)))
+
+
+def get_column_kind(values):
+    """
+    (kind, array or None) of how a response key is packed, from its values over the rows that have it:
+    int (int64), float, vector (non-empty equal length lists of numbers, (N, K)), matrix (non-empty dicts of
+    numbers with the same keys, (N, len(keys))), string and json (anything else, one JSON text per row).
+    """
+    types = set(type(v) for v in values)
+    if types <= {int}:
+        if all(-2 ** 63 <= v < 2 ** 63 for v in values):
+            return 'int', None
+    elif types <= {int, float}:
+        return 'float', None
+    if types == {str}:
+        return 'string', None
+    if types == {list} and len(set(len(v) for v in values)) == 1:
+        array = np.asarray(values)
+        if array.dtype.kind in 'iuf' and array.ndim == 2 and array.shape[1] > 0:
+            return 'vector', array
+    if types == {dict} and len(set(tuple(v) for v in values)) == 1:
+        array = np.asarray([list(v.values()) for v in values])
+        if array.dtype.kind in 'iuf' and array.ndim == 2 and array.shape[1] > 0:
+            return 'matrix', array
+    return 'json', None
+
+
+def get_column(rows, name):
+    # (column description, [(buffer prefix, buffer), ...]) of one response key
+    present = [(r_idx, row[name]) for r_idx, row in enumerate(rows) if name in row]
+    values = [v for _, v in present]
+    idx = [r_idx for r_idx, _ in present]
+    kind, packed = get_column_kind(values)
+    column = {'name': name, 'kind': kind}
+    valid = np.zeros(len(rows), dtype=bool)
+    valid[idx] = True
+    valid = ('valid_', np.packbits(valid, bitorder='little').tobytes())
+
+    if kind == 'int':
+        array = np.zeros(len(rows), dtype='<i8')
+        array[idx] = values
+    elif kind == 'float':
+        array = np.full(len(rows), np.nan, dtype='<f8')
+        array[idx] = values
+    elif kind in ['vector', 'matrix']:
+        if kind == 'matrix':
+            column['keys'] = list(values[0])
+        array = np.full((len(rows), packed.shape[1]), np.nan, dtype='<f8')
+        array[idx] = packed
+    else:
+        # arrow-style strings: int32 offsets (N + 1) into one utf-8 buffer
+        texts = [''] * len(rows)
+        for r_idx, v in present:
+            texts[r_idx] = v if kind == 'string' else encode_json(v).decode('utf-8')
+        encoded = [t.encode('utf-8') for t in texts]
+        array = np.zeros(len(rows) + 1, dtype='<i4')
+        np.cumsum([len(e) for e in encoded], out=array[1:])
+        column.update({'dtype': '<i4', 'shape': [len(rows) + 1]})
+        return column, [('', array.tobytes()), ('data_', b''.join(encoded)), valid]
+
+    if kind != 'int' and is_probability(name, array):
+        array = array.astype('<f4')
+    column.update({'dtype': array.dtype.str, 'shape': list(array.shape)})
+    return column, [('', array.tobytes()), valid]
+
+
+def pad(n, alignment=8):
+    return -n % alignment
+
+
+def encode_columnar(rows, fields=None):
+    """
+    rows: the per-query response dicts; fields: values of the whole response, e.g. {'batch_size': 64}.
+    """
+    names = dict()
+    for row in rows:
+        names.update(dict.fromkeys(row))
+
+    columns, buffers = list(), list()
+    for name in names:
+        column, column_buffers = get_column(rows, name)
+        columns.append(column)
+        buffers.append(column_buffers)
+
+    position = 0
+    for column, column_buffers in zip(columns, buffers):
+        for prefix, buffer in column_buffers:
+            column[prefix + 'offset'], column[prefix + 'nbytes'] = position, len(buffer)
+            position += len(buffer) + pad(len(buffer))
+    header_bytes = encode_json({'num_rows': len(rows), 'fields': fields or dict(), 'columns': columns})
+
+    parts = [columnar_magic, struct.pack('<II', columnar_version, len(header_bytes)), header_bytes,
+             b'\0' * pad(12 + len(header_bytes))]
+    for column_buffers in buffers:
+        for _, buffer in column_buffers:
+            parts += [buffer, b'\0' * pad(len(buffer))]
+    return b''.join(parts)
+
+
+def decode_columnar(body):
+    """
+    The header of a columnar body with 'columns' as {name: values}, numpy arrays for the numeric kinds (views into
+    body, no copy) and lists for string and json, 'valid' as {name: bool array of the rows that have the key} and
+    'schema' as {name: column entry of the header}.
+    """
+    if body[:4] != columnar_magic:
+        raise ValueError('Not a columnar response body.')
+    version, header_length = struct.unpack('<II', body[4:12])
+    if version != columnar_version:
+        raise ValueError('Unsupported columnar version: {}.'.format(version))
+    header = json.loads(body[12:12 + header_length].decode('utf-8'))
+    start = 12 + header_length + pad(12 + header_length)
+
+    columns, valid = dict(), dict()
+    for column in header['columns']:
+        array = np.frombuffer(body, dtype=column['dtype'], count=int(np.prod(column['shape'])),
+                              offset=start + column['offset']).reshape(column['shape'])
+        bitmap = np.frombuffer(body, dtype=np.uint8, count=column['valid_nbytes'],
+                               offset=start + column['valid_offset'])
+        valid[column['name']] = np.unpackbits(bitmap, count=header['num_rows'], bitorder='little').astype(bool)
+        if column['kind'] in ['string', 'json']:
+            data = body[start + column['data_offset']:start + column['data_offset'] + column['data_nbytes']]
+            texts = [data[array[i]:array[i + 1]].decode('utf-8') for i in range(len(array) - 1)]
+            array = texts if column['kind'] == 'string' else [json.loads(t) if t else None for t in texts]
+        columns[column['name']] = array
+    header['schema'] = {column['name']: column for column in header['columns']}
+    header['columns'] = columns
+    header['valid'] = valid
+    return header
+
+
+def columnar_to_rows(decoded):
+    """
+    Per-row dicts like the JSON responses (probabilities at float32 precision, NaN where JSON has null), with
+    exactly the keys each row had.
+    """
+    rows = [dict() for _ in range(decoded['num_rows'])]
+    for name, values in decoded['columns'].items():
+        kind = decoded['schema'][name]['kind']
+        for row, v, valid in zip(rows, values, decoded['valid'][name]):
+            if not valid:
+                continue
+            if kind == 'int':
+                row[name] = int(v)
+            elif kind == 'float':
+                row[name] = float(v)
+            elif kind == 'vector':
+                row[name] = v.tolist()
+            elif kind == 'matrix':
+                row[name] = dict(zip(decoded['schema'][name]['keys'], v.tolist()))
+            else:
+                row[name] = v
+    return rows
@@ -0,0 +1,67 @@
+import numpy as np
+import torch
+
+# Per-request attributions for the DL outcome ensemble. The estimator is the expected-gradients one of
+# shap.GradientExplainer (used offline in aiml/pytorch/outcome_data3/shap_utils.py), written against torch directly so
+# that the service does not need shap. The background sample is fixed and stored in the model package, see
+# aiml/dumper/v5/dump_model_ourcome_dl_data3.py.
+
+
+def get_compact_forward(package):
+    # CompactDLPackage.forward in torch, the member-average probabilities (N, C) of the normalised features
+    tensors = {k: torch.tensor(np.array(v, dtype=np.float32)) for k, v in package.tensors.items()
+               if k.endswith('_weight') or k.endswith('_bias')}
+
+    def forward(x):
+        x = x.unsqueeze(0).expand(package.num_members, -1, -1)
+        for name in ['fc0', 'fc1']:
+            x = torch.relu(torch.baddbmm(tensors[name + '_bias'], x, tensors[name + '_weight']))
+        logits = torch.baddbmm(tensors['cls_bias'], x, tensors['cls_weight'])
+        return torch.softmax(logits, dim=2).mean(dim=0)
+
+    return forward
+
+
+class ExpectedGradientsExplainer:
+    """
+    Attributions phi of a differentiable forward (N, F) -> (N, K) relative to a background sample: for each of
+    num_samples draws of a background row b and t in [0, 1], the gradient at b + t (x - b) times (x - b), averaged.
+    phi sums to forward(x) - expected_value up to the sampling error. The draws are fixed at construction and shared
+    by every row, so an attribution depends on its own row only and repeated requests get the same answer.
+    The cost is num_samples forward passes plus one backward pass per output, so forward should return only the
+    outputs to be explained.
+    """
+
+    def __init__(self, forward, background, num_samples=64, seed=0, max_chunk=16384):
+        self.forward = forward
+        self.background = torch.tensor(np.array(background, dtype=np.float32))
+        self.num_samples = num_samples
+        self.max_chunk = max_chunk
+
+        generator = torch.Generator().manual_seed(seed)
+        self.b_idx = torch.randint(len(self.background), (num_samples,), generator=generator)
+        self.t = torch.rand(num_samples, 1, generator=generator)
+        with torch.no_grad():
+            self.expected_value = self.forward(self.background).mean(dim=0).numpy().astype(float)
+
+    def shap_values(self, x):
+        """
+        x: (N, F) normalised features; returns the (N, K, F) attributions.
+        """
+        x = torch.as_tensor(np.asarray(x, dtype=np.float32))
+        rows_per_chunk = max(1, self.max_chunk // self.num_samples)
+        phi = [self.explain_chunk(x[i:i + rows_per_chunk]) for i in range(0, len(x), rows_per_chunk)]
+        return np.concatenate(phi, axis=0) if len(phi) > 0 else np.zeros((0, len(self.expected_value), x.shape[1]))
+
+    def explain_chunk(self, x):
+        n, s = len(x), self.num_samples
+        b = self.background[self.b_idx].unsqueeze(0)
+        delta = x.unsqueeze(1) - b
+        # rows are independent in eval mode, so the gradient of a column sum is the per-row gradient
+        inputs = (b + self.t.unsqueeze(0) * delta).reshape(n * s, -1).requires_grad_(True)
+        with torch.enable_grad():
+            outputs = self.forward(inputs)
+            grads = [torch.autograd.grad(outputs[:, c].sum(), inputs, retain_graph=c < outputs.shape[1] - 1)[0]
+                     for c in range(outputs.shape[1])]
+        grads = torch.stack(grads, dim=1).reshape(n, s, outputs.shape[1], -1)
+        return (grads * delta.unsqueeze(2)).mean(dim=1).detach().numpy().astype(float)
@@ -0,0 +1,162 @@
+import numpy as np
+from service.v5.protocol import get_config
+
+config = get_config()
+
+# Input bounds per key, used when the config has no 'bounds' section. Every rule is an allowed range (or a set of
+# options); a value outside it triggers the action: 'error' rejects the query, 'warning' keeps the value and
+# 'missing' drops it (prefilled or imputed later) with a warning. Bounds are inclusive unless stated otherwise, and
+# 'message' replaces the generated description. 'trop' and 'time_trop' (in days) apply to every troponin.
+default_bounds = {
+    'age': [{'low': 18, 'action': 'error'}, {'high': 115, 'action': 'warning'}],
+    'gender': [{'options': [0, 1], 'action': 'error'}],
+    'heart_score': [{'low': 0, 'high': 10, 'low_inclusive': False, 'action': 'error'}],
+    'phys_bnp': [{'low': 50, 'action': 'missing', 'message': 'phys_bnp below 50 is treated as missing'}],
+    'trop': [{'low': 0, 'action': 'error', 'message': 'troponins must not be negative'},
+             {'low': 3, 'action': 'warning', 'message': 'troponins below 3 are treated as 3'}],
+    'time_trop': [{'low': 0, 'action': 'error', 'message': 'troponin times must not be negative'},
+                  {'high': 1, 'action': 'warning', 'message': 'troponins after 24 hours are not used'}],
+}
+
+
+def get_bounds(bounds=None):
+    """
+    The given bounds, else the config 'bounds' section, else default_bounds; physiology is logged, so
+    non-positive values of a logged phys key without its own rules are treated as missing.
+    """
+    if bounds is None:
+        bounds = config.get('bounds', default_bounds)
+    bounds = dict(bounds)
+    bounds.update({k: [{'low': 0, 'low_inclusive': False, 'action': 'missing'}]
+                   for k in config['features']['phys']['data2']
+                   if k not in config['features']['phys_no_log'] and k not in bounds})
+    return bounds
+
+
+actions = ['error', 'warning', 'missing']
+series_keys = ['trop', 'time_trop']
+
+
+def describe_rule(key, rule):
+    if 'message' in rule:
+        return rule['message']
+    if 'options' in rule:
+        return '{} must be one of {}'.format(key, rule['options'])
+    low = '{}{}'.format('[' if rule.get('low_inclusive', True) else '(', rule.get('low', -np.inf))
+    high = '{}{}'.format(rule.get('high', np.inf), ']' if rule.get('high_inclusive', True) else ')')
+    return '{} out of bound {}, {}'.format(key, low, high)
+
+
+class RuleTable:
+    """
+    K bound rules as arrays: the column each rule reads, its range, inclusiveness, options and action.
+    """
+
+    def __init__(self, columns, bounds):
+        self.col, self.messages, rules = [], [], []
+        for key, key_rules in bounds.items():
+            if key not in columns:
+                continue
+            for rule in key_rules:
+                if rule['action'] not in actions:
+                    raise ValueError('Unknown bound action for {}: {}'.format(key, rule['action']))
+                self.col.append(columns.index(key))
+                self.messages.append(describe_rule(key, rule))
+                rules.append(rule)
+
+        self.col = np.array(self.col, dtype=int)
+        self.low = np.array([r.get('low', -np.inf) for r in rules], dtype=float)
+        self.high = np.array([r.get('high', np.inf) for r in rules], dtype=float)
+        self.low_inclusive = np.array([r.get('low_inclusive', True) for r in rules], dtype=bool)
+        self.high_inclusive = np.array([r.get('high_inclusive', True) for r in rules], dtype=bool)
+        self.action = np.array([actions.index(r['action']) for r in rules], dtype=int)
+        self.options = [(k, np.array(r['options'], dtype=float)) for k, r in enumerate(rules) if 'options' in r]
+
+    def evaluate(self, values):
+        """
+        values: (N, K, ...) the column of each rule; returns the (N, K, ...) mask of present values breaking it.
+        """
+        shape = (1, -1) + (1,) * (values.ndim - 2)
+        low, high = self.low.reshape(shape), self.high.reshape(shape)
+        with np.errstate(invalid='ignore'):
+            inside = ((values > low) | (self.low_inclusive.reshape(shape) & (values == low))) & \
+                     ((values < high) | (self.high_inclusive.reshape(shape) & (values == high)))
+        for k, options in self.options:
+            inside[:, k] &= np.isin(values[:, k], options)
+        return ~inside & ~np.isnan(values)
+
+
+class PrefillVector:
+    """
+    prefiller() compiled for a fixed column layout: the prefilled column indices and their fill values, applied
+    to a whole (N x columns) array with one masked assignment.
+    """
+
+    def __init__(self, columns, prefill_value_dict):
+        columns = list(columns)
+        self.keys = [k for k in prefill_value_dict if k in columns]
+        self.col_idx = np.array([columns.index(k) for k in self.keys], dtype=int)
+        self.values = np.array([prefill_value_dict[k] for k in self.keys], dtype=float)
+
+    def apply(self, x):
+        # x: float (N x columns), filled in place
+        if len(self.col_idx) > 0:
+            block = x[:, self.col_idx]
+            x[:, self.col_idx] = np.where(np.isnan(block), self.values, block)
+        return x
+
+    def apply_frame(self, df):
+        df = df.copy()
+        if len(self.keys) > 0:
+            block = df[self.keys].values.astype(float)
+            df[self.keys] = np.where(np.isnan(block), self.values, block)
+        return df
+
+
+class InputSchema:
+    """
+    Bounds compiled once into rule arrays. A batch, as an (N x features) matrix plus (N x T) troponin values and
+    times, is checked against all rules in a few array operations, giving (N x checks) error and warning masks;
+    features breaking a 'missing' rule are set to nan.
+    """
+
+    def __init__(self, feature_keys, bounds=None):
+        bounds = get_bounds(bounds)
+        self.feature_keys = list(feature_keys)
+        self.feature_rules = RuleTable(self.feature_keys, bounds)
+        self.series_rules = RuleTable(series_keys, bounds)
+        self.messages = self.feature_rules.messages + self.series_rules.messages + \
+            ['no troponin within 24 hours', 'missing features are prefilled or imputed']
+
+    def get_matrix(self, features_list):
+        return np.array([[f.get(k, np.nan) for k in self.feature_keys] for f in features_list],
+                        dtype=float).reshape(len(features_list), len(self.feature_keys))
+
+    def validate(self, x, trops, time_days):
+        """
+        x: (N x features), cleaned in place; trops and time_days: (N x T) with nan padding, as in
+        get_series_arrays before any troponin is dropped. Returns (x, errors, warnings).
+        """
+        feature_broken = self.feature_rules.evaluate(x[:, self.feature_rules.col])
+        series = np.stack([trops, time_days], axis=1)
+        series_broken = self.series_rules.evaluate(series[:, self.series_rules.col]).any(axis=2)
+
+        missing = feature_broken & (self.feature_rules.action == actions.index('missing'))
+        if missing.any():
+            r_idx, k_idx = np.nonzero(missing)
+            x[r_idx, self.feature_rules.col[k_idx]] = np.nan
+
+        with np.errstate(invalid='ignore'):
+            given = ~np.isnan(trops)
+            no_trop_left = given.any(axis=1) & ~(given & (time_days <= 1)).any(axis=1)
+        features_missing = np.isnan(x).any(axis=1)
+
+        broken = np.c_[feature_broken, series_broken]
+        action = np.r_[self.feature_rules.action, self.series_rules.action]
+        empty = np.zeros(len(x), dtype=bool)
+        errors = np.c_[broken & (action == actions.index('error')), no_trop_left, empty]
+        warnings = np.c_[broken & (action != actions.index('error')), empty, features_missing]
+        return x, errors, warnings
+
+    def get_message(self, mask_row):
+        return '; '.join(self.messages[i] for i in np.nonzero(mask_row)[0]) + '.'
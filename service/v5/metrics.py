@@ -0,0 +1,195 @@
+import time
+import threading
+
+# In-process request metrics: stage latencies in HDR-style histograms plus counters, rendered as plain text for
+# GET /metrics. Every process keeps its own metrics: under run_prefork a GET /metrics only reports the worker that
+# answers it, with every sample labelled worker="<pid>", and service totals are sums over the worker labels.
+
+
+class CountHistogram:
+    """
+    Counts of non-negative integer observations in power-of-two buckets: [0], [1], [2, 3], [4, 7], ...
+    """
+
+    def __init__(self):
+        self.counts = dict()
+        self.total = 0
+        self.sum = 0
+
+    def add(self, value):
+        bucket = 0 if value <= 0 else 1 << (int(value).bit_length() - 1)
+        self.counts[bucket] = self.counts.get(bucket, 0) + 1
+        self.total += 1
+        self.sum += value
+
+    def stats(self):
+        buckets = {('{}'.format(b) if b <= 1 else '{}-{}'.format(b, 2 * b - 1)): self.counts[b]
+                   for b in sorted(self.counts)}
+        return {'count': self.total, 'mean': self.sum / self.total if self.total > 0 else 0., 'buckets': buckets}
+
+
+class LatencyHistogram:
+    """
+    HDR-style histogram of durations in nanoseconds: power-of-two magnitudes, each split into 2 ** sub_bucket_bits
+    linear buckets. A value falls in a bucket at least 2 ** (sub_bucket_bits - 1) bucket widths above zero and is
+    reported as the bucket midpoint, so it is kept to within 2 ** -sub_bucket_bits of itself (1/64, about 1.6%, by
+    default) over any range, in a few hundred buckets at most.
+    """
+
+    def __init__(self, sub_bucket_bits=6):
+        self.sub_bucket_bits = sub_bucket_bits
+        self.counts = dict()
+        self.total = 0
+        self.sum = 0
+        self.max = 0
+
+    def record(self, value):
+        magnitude = max(value.bit_length() - self.sub_bucket_bits, 0)
+        key = (magnitude << self.sub_bucket_bits) + (value >> magnitude)
+        self.counts[key] = self.counts.get(key, 0) + 1
+        self.total += 1
+        self.sum += value
+        if value > self.max:
+            self.max = value
+
+    def get_value(self, key):
+        # midpoint of the bucket, exact below 2 ** sub_bucket_bits
+        magnitude, sub = key >> self.sub_bucket_bits, key & ((1 << self.sub_bucket_bits) - 1)
+        return float((sub << magnitude) + ((1 << magnitude) >> 1))
+
+    def quantile(self, q):
+        if self.total == 0:
+            return 0.
+        target = q * self.total
+        seen = 0
+        for key in sorted(self.counts):
+            seen += self.counts[key]
+            if seen >= target:
+                return min(self.get_value(key), self.max)
+        return float(self.max)
+
+
+class StageTimer:
+    """
+    Named stage timings of one request or batch: `with timer('parse'):` adds the elapsed nanoseconds of the
+    block to the stage. Stages do not nest.
+    """
+
+    def __init__(self):
+        self.stages = dict()
+        self.name = None
+        self.start = 0
+
+    def __call__(self, name):
+        self.name = name
+        return self
+
+    def __enter__(self):
+        self.start = time.perf_counter_ns()
+        return self
+
+    def __exit__(self, *args):
+        self.stages[self.name] = self.stages.get(self.name, 0) + time.perf_counter_ns() - self.start
+        return False
+
+    def get_ms(self):
+        return {k: v / 1e6 for k, v in self.stages.items()}
+
+
+class NullTimer:
+    # stand-in for StageTimer when a caller does not time its stages
+
+    def __call__(self, name):
+        return self
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        return False
+
+
+null_timer = NullTimer()
+
+
+class Metrics:
+    """
+    Stage latency histograms and counters of a BatchPredictor. observe() takes one finished batch; render() gives
+    the text of GET /metrics, in the Prometheus text format.
+    """
+
+    quantiles = [0.5, 0.9, 0.99, 0.999]
+
+    def __init__(self, prefix='rapidx'):
+        self.prefix = prefix
+        self.lock = threading.Lock()
+        self.stages = dict()
+        self.counters = {'requests': 0, 'errors': 0, 'batches': 0}
+        self.batch_size = CountHistogram()
+
+    def observe(self, timer, batch_size, num_errors):
+        with self.lock:
+            for name, duration in timer.stages.items():
+                if name not in self.stages:
+                    self.stages[name] = LatencyHistogram()
+                self.stages[name].record(duration)
+            self.counters['requests'] += batch_size
+            self.counters['errors'] += num_errors
+            self.counters['batches'] += 1
+            self.batch_size.add(batch_size)
+
+    def stats(self):
+        with self.lock:
+            stages = {name: {'count': h.total, 'mean_ms': h.sum / h.total / 1e6 if h.total > 0 else 0.,
+                             'max_ms': h.max / 1e6,
+                             **{'p{:g}_ms'.format(q * 100): h.quantile(q) / 1e6 for q in self.quantiles}}
+                      for name, h in self.stages.items()}
+            return {'counters': dict(self.counters), 'batch_size': self.batch_size.stats(), 'stages': stages}
+
+    def render(self, extra_counters=None, histograms=None, labels=None):
+        """
+        extra_counters: {name: value} of counters kept elsewhere (e.g. the response cache), added as they are.
+        histograms: {name: CountHistogram} kept elsewhere (e.g. by a micro-batcher), rendered as histograms.
+        labels: {name: value} added to every sample, e.g. the worker of a pre-fork server.
+        """
+        labels = labels or dict()
+
+        def sample(name, value, sample_labels=()):
+            label_text = ','.join('{}="{}"'.format(k, v) for k, v in list(sample_labels) + list(labels.items()))
+            return '{}{} {}'.format(name, '{' + label_text + '}' if label_text else '', value)
+
+        lines = list()
+        with self.lock:
+            counters = dict(self.counters)
+            counters.update(extra_counters or dict())
+            for name, value in counters.items():
+                lines.append('# TYPE {}_{}_total counter'.format(self.prefix, name))
+                lines.append(sample('{}_{}_total'.format(self.prefix, name), value))
+
+            metric = '{}_stage_seconds'.format(self.prefix)
+            lines.append('# TYPE {} summary'.format(metric))
+            for name in sorted(self.stages):
+                h = self.stages[name]
+                for q in self.quantiles:
+                    lines.append(sample(metric, '{:.9f}'.format(h.quantile(q) / 1e9),
+                                        [('stage', name), ('quantile', '{:g}'.format(q))]))
+                lines.append(sample(metric + '_sum', '{:.9f}'.format(h.sum / 1e9), [('stage', name)]))
+                lines.append(sample(metric + '_count', h.total, [('stage', name)]))
+
+            metric = '{}_batch_size'.format(self.prefix)
+            lines.append('# TYPE {} summary'.format(metric))
+            lines.append(sample(metric + '_sum', self.batch_size.sum))
+            lines.append(sample(metric + '_count', self.batch_size.total))
+
+            for name, h in sorted((histograms or dict()).items()):
+                metric = '{}_{}'.format(self.prefix, name)
+                lines.append('# TYPE {} histogram'.format(metric))
+                # a copy, the owner may be adding to it on another thread
+                counts, seen = dict(h.counts), 0
+                for bucket in sorted(counts):
+                    seen += counts[bucket]
+                    lines.append(sample(metric + '_bucket', seen, [('le', max(2 * bucket - 1, 0))]))
+                lines.append(sample(metric + '_bucket', seen, [('le', '+Inf')]))
+                lines.append(sample(metric + '_sum', h.sum))
+                lines.append(sample(metric + '_count', seen))
+        return '\n'.join(lines) + '\n'
@@ -0,0 +1,165 @@
+import asyncio
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from service.v5.metrics import CountHistogram
+
+all_families = ('outcome_dl', 'outcome_xgb', 'event_xgb')
+
+
+class MicroBatcher:
+    """
+    asyncio front end of a BatchPredictor: concurrent submit() calls are queued and flushed as one
+    inference_batch when max_batch_size requests are waiting or max_wait seconds after the first one arrived,
+    whichever comes first. The batch runs on a single worker thread, so the event loop keeps accepting requests,
+    and each caller gets its own response back. Callers never wait on a scheduler that is gone: stop() fails every
+    queued and running request, and so does an exception in run().
+    """
+
+    def __init__(self, predictor, max_batch_size=32, max_wait=0.003):
+        self.predictor = predictor
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+        self.queue = None
+        self.task = None
+        # futures taken off the queue and not answered yet
+        self.pending = set()
+        self.executor = ThreadPoolExecutor(max_workers=1)
+        self.queue_depth = CountHistogram()
+        self.batch_size = CountHistogram()
+        self.num_batches = 0
+        self.num_requests = 0
+
+    async def start(self):
+        # also restarts a scheduler that failed
+        if self.task is None or self.task.done():
+            if self.task is not None and not self.task.cancelled():
+                # run() failed and its callers got the exception, retrieve it for the loop
+                self.task.exception()
+            if self.queue is None:
+                self.queue = asyncio.Queue()
+            self.task = asyncio.get_running_loop().create_task(self.run())
+
+    async def stop(self):
+        if self.task is not None:
+            self.task.cancel()
+            try:
+                await self.task
+            except asyncio.CancelledError:
+                pass
+            except Exception:
+                # run() failed, its callers already have the exception
+                pass
+            self.task = None
+        self.fail_pending(RuntimeError('The micro-batcher was stopped.'))
+
+    def fail_pending(self, exception):
+        while self.queue is not None and not self.queue.empty():
+            self.pending.add(self.queue.get_nowait()[2])
+        for future in self.pending:
+            if not future.done():
+                future.set_exception(exception)
+        self.pending.clear()
+
+    async def submit(self, query, families=all_families):
+        if self.task is None or self.task.done():
+            await self.start()
+        future = asyncio.get_running_loop().create_future()
+        self.queue_depth.add(self.queue.qsize())
+        await self.queue.put((query, tuple(families), future))
+        return await future
+
+    async def get(self, timeout=None):
+        item = await (self.queue.get() if timeout is None else asyncio.wait_for(self.queue.get(), timeout))
+        self.pending.add(item[2])
+        return item
+
+    async def collect(self):
+        batch = [await self.get()]
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + self.max_wait
+        while len(batch) < self.max_batch_size:
+            timeout = deadline - loop.time()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(await self.get(timeout))
+            except asyncio.TimeoutError:
+                break
+        return batch
+
+    def answer(self, items, responses=None, exception=None):
+        for i_idx, (_, _, future) in enumerate(items):
+            if not future.done():
+                if exception is not None:
+                    future.set_exception(exception)
+                else:
+                    future.set_result(responses[i_idx])
+            self.pending.discard(future)
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        try:
+            while True:
+                batch = await self.collect()
+                self.batch_size.add(len(batch))
+                self.num_batches += 1
+                self.num_requests += len(batch)
+
+                # requests for different endpoints are scored per family set
+                groups = dict()
+                for item in batch:
+                    groups.setdefault(item[1], list()).append(item)
+
+                for families, items in groups.items():
+                    try:
+                        responses = await loop.run_in_executor(self.executor, self.predictor.inference_batch,
+                                                               [query for query, _, _ in items], families)
+                    except Exception as e:
+                        self.answer(items, exception=e)
+                        continue
+                    self.answer(items, responses)
+        except Exception as e:
+            self.fail_pending(e)
+            raise
+
+    def stats(self):
+        return {'max_batch_size': self.max_batch_size, 'max_wait': self.max_wait,
+                'queue_size': self.queue.qsize() if self.queue is not None else 0,
+                'num_batches': self.num_batches, 'num_requests': self.num_requests,
+                'queue_depth': self.queue_depth.stats(), 'batch_size': self.batch_size.stats()}
+
+    def histograms(self):
+        # for Metrics.render: the queue depth seen by each request and the size of each batch
+        return {'micro_batch_queue_depth': self.queue_depth, 'micro_batch_size': self.batch_size}
+
+
+class ThreadedMicroBatcher:
+    """
+    A MicroBatcher on its own event loop thread, for threaded servers. submit() blocks the calling thread until
+    its response is ready; call() runs any other predictor work on the batcher's inference thread, so that the
+    predictor is only ever used by that one thread.
+    """
+
+    def __init__(self, predictor, max_batch_size=32, max_wait=0.003):
+        self.batcher = MicroBatcher(predictor, max_batch_size=max_batch_size, max_wait=max_wait)
+        self.loop = asyncio.new_event_loop()
+        self.thread = threading.Thread(target=self.loop.run_forever, daemon=True)
+        self.thread.start()
+        asyncio.run_coroutine_threadsafe(self.batcher.start(), self.loop).result()
+
+    def submit(self, query, families=all_families):
+        return asyncio.run_coroutine_threadsafe(self.batcher.submit(query, families), self.loop).result()
+
+    def call(self, fn, *args):
+        return self.batcher.executor.submit(fn, *args).result()
+
+    def stop(self):
+        asyncio.run_coroutine_threadsafe(self.batcher.stop(), self.loop).result()
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join()
+
+    def stats(self):
+        return self.batcher.stats()
+
+    def histograms(self):
+        return self.batcher.histograms()
@@ -0,0 +1,111 @@
+import os
+import json
+import numpy as np
+
+# Compact DL outcome package: a directory with
+#   manifest.json - format version, feature keys, class order, thresholds and a tensor table (name, offset, shape)
+#   weights.bin   - every tensor as flat little-endian float32, 64-byte aligned, memory-mapped at load time
+# Written by aiml/dumper/v5/dump_model_package_dl_data3.py. Loading needs numpy only (no pandas, torchvision or
+# the training data_loader), and the weights are shared read-only pages across server processes.
+
+package_format = 'rapidx-dl-package'
+package_format_version = 1
+manifest_name = 'manifest.json'
+weights_name = 'weights.bin'
+weights_dtype = '<f4'
+weights_alignment = 16  # in float32 elements
+
+# folded TroponinNet layers (see FoldedTroponinNet), each weight is stacked over members as (K, in, out)
+layer_names = ['fc0', 'fc1', 'cls']
+
+
+def write_package(package_path, tensors, manifest):
+    """
+    tensors: {name: float32 array}, manifest: json-serialisable dict, the tensor table is added here.
+    """
+    os.makedirs(package_path, exist_ok=True)
+
+    table = dict()
+    offset = 0
+    with open(os.path.join(package_path, weights_name), 'wb') as handle:
+        for name, tensor in tensors.items():
+            tensor = np.ascontiguousarray(tensor, dtype=weights_dtype)
+            padding = -offset % weights_alignment
+            handle.write(np.zeros(padding, dtype=weights_dtype).tobytes())
+            offset += padding
+            handle.write(tensor.tobytes())
+            table[name] = {'offset': offset, 'shape': list(tensor.shape)}
+            offset += tensor.size
+
+    manifest = dict(manifest)
+    manifest['format'] = package_format
+    manifest['format_version'] = package_format_version
+    manifest['dtype'] = weights_dtype
+    manifest['tensors'] = table
+    with open(os.path.join(package_path, manifest_name), 'w') as handle:
+        json.dump(manifest, handle, indent=2)
+
+
+def read_package(package_path):
+    with open(os.path.join(package_path, manifest_name), 'r') as handle:
+        manifest = json.load(handle)
+
+    if manifest.get('format') != package_format:
+        raise ValueError('Not a compact DL package: {}'.format(package_path))
+    if manifest['format_version'] > package_format_version:
+        raise ValueError('Unsupported package format version {} (supported up to {}): {}'.format(
+            manifest['format_version'], package_format_version, package_path))
+
+    blob = np.memmap(os.path.join(package_path, weights_name), dtype=manifest['dtype'], mode='r')
+    tensors = dict()
+    for name, entry in manifest['tensors'].items():
+        size = int(np.prod(entry['shape']))
+        tensors[name] = blob[entry['offset']:entry['offset'] + size].reshape(entry['shape'])
+
+    return manifest, tensors
+
+
+class CompactDLPackage:
+    """
+    Memory-mapped DL outcome ensemble. forward evaluates the folded TroponinNet members in numpy and returns,
+    like FusedTroponinEnsemble, the per-member softmax (K, N, C) and the member average (N, C).
+    """
+
+    def __init__(self, package_path):
+        self.package_path = package_path
+        self.manifest, self.tensors = read_package(package_path)
+
+        self.feature_keys = self.manifest['feature_keys']
+        self.ignore_value = self.manifest['ignore_value']
+        self.classes = self.manifest['classes']
+        self.class_idx = {c: i for i, c in enumerate(self.classes)}
+        self.num_members = self.manifest['num_members']
+
+        self.mean = self.tensors['feature_mean'].reshape(1, -1)
+        self.std = self.tensors['feature_std'].reshape(1, -1)
+        # normalised training rows for the explainer, optional
+        self.background = self.tensors.get('shap_background')
+
+        # [{method: (K,)} for l1, l2]
+        self.thresholds = [{m: np.array(t) for m, t in self.manifest['thresholds'][l].items()}
+                           for l in ['l1', 'l2']]
+
+    def __len__(self):
+        return self.num_members
+
+    def forward(self, input_feature):
+        x = np.asarray(input_feature, dtype=np.float32).reshape(len(input_feature), -1)
+        for name in layer_names[:-1]:
+            x = np.maximum(np.matmul(x, self.tensors[name + '_weight']) + self.tensors[name + '_bias'], 0)
+        logits = np.matmul(x, self.tensors['cls_weight']) + self.tensors['cls_bias']
+
+        logits = logits - logits.max(axis=2, keepdims=True)
+        probs = np.exp(logits)
+        probs /= probs.sum(axis=2, keepdims=True)
+        return probs, probs.mean(axis=0)
+
+    __call__ = forward
+
+
+def load_dl_package(package_path):
+    return CompactDLPackage(package_path)
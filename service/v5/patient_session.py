@@ -0,0 +1,276 @@
+import copy
+import uuid
+import multiprocessing
+import numpy as np
+from multiprocessing.managers import BaseManager
+from service.v5.batch_predictor import parse_query, parse_troponins, parse_control_variables, \
+    get_control_message, get_static_matrix, build_feature_record, max_ntrop, query_matcher
+from service.v5.response_cache import ResponseCache
+
+luke_names = ['avgtrop', 'avgspd', 'maxtrop', 'mintrop', 'maxvel', 'minvel', 'divtrop', 'difftrop', 'diffvel',
+              'logtrop0']
+
+
+class LukeAggregates:
+    """
+    Running form of aiml.utils.get_luke_trop_features over the kept series (first six troponins within 24 hours,
+    in time order). A troponin arriving after the last kept one is folded into the running sums and extrema; any
+    other arrival replays the kept series, which gives the same values as the batch computation.
+    """
+
+    def __init__(self):
+        self.kept = list()
+        self.trop_sum = 0.
+        self.trop_count = 0
+        self.trop_max = np.nan
+        self.trop_min = np.nan
+        self.speed_sum = 0.
+        self.vel_count = 0
+        self.vel_max = np.nan
+        self.vel_min = np.nan
+
+    def append(self, t, trop):
+        trop = np.maximum(trop, 3.0)
+        log_trop = np.log(trop)
+        with np.errstate(all='ignore'):
+            if len(self.kept) > 0:
+                t_last, _, log_trop_last = self.kept[-1]
+                vel = (log_trop - log_trop_last) / (t - t_last)
+                if not np.isnan(vel):
+                    self.speed_sum += np.abs(vel)
+                    self.vel_count += 1
+                    self.vel_max = np.fmax(self.vel_max, vel)
+                    self.vel_min = np.fmin(self.vel_min, vel)
+            if not np.isnan(log_trop):
+                self.trop_sum += log_trop
+                self.trop_count += 1
+                self.trop_max = np.fmax(self.trop_max, log_trop)
+                self.trop_min = np.fmin(self.trop_min, log_trop)
+        self.kept.append((t, trop, log_trop))
+
+    def add(self, series, t, trop):
+        """
+        series: the full session series after the arrival of (t, trop) as its last element.
+        """
+        if t > 1:
+            return
+        if len(self.kept) < max_ntrop and (len(self.kept) == 0 or t >= self.kept[-1][0]):
+            self.append(t, trop)
+        elif not (len(self.kept) == max_ntrop and t >= self.kept[-1][0]):
+            self.rebuild(series)
+
+    def rebuild(self, series):
+        self.__init__()
+        # stable time order with nans last, as in get_series_arrays
+        valid = [(t, v) for t, v in series if not t > 1]
+        order = np.argsort(np.array([t for t, _ in valid], dtype=float), kind='stable')
+        for idx in order[:max_ntrop]:
+            self.append(*valid[idx])
+
+    def get_trop_arrays(self):
+        trops = np.full([1, max_ntrop], np.nan)
+        time_hrs = np.full([1, max_ntrop], np.nan)
+        for t_idx, (t, trop, _) in enumerate(self.kept):
+            time_hrs[0, t_idx] = t
+            trops[0, t_idx] = trop
+        return trops, time_hrs
+
+    def get_features(self):
+        with np.errstate(all='ignore'):
+            avgtrop = self.trop_sum / self.trop_count if self.trop_count > 0 else np.nan
+            avgspd = self.speed_sum / self.vel_count if self.vel_count > 0 else np.nan
+            logtrop0 = self.kept[0][2] if len(self.kept) > 0 else np.nan
+            return np.array([[avgtrop, avgspd, self.trop_max, self.trop_min, self.vel_max, self.vel_min,
+                              self.trop_max / self.trop_min, self.trop_max - self.trop_min,
+                              self.vel_max - self.vel_min, logtrop0]])
+
+
+class PatientSession:
+    """
+    One encounter: the parsed static features (logged, as a one-row matrix), the troponin series by index and its
+    running luke aggregates. Each update only rebuilds the troponin columns and re-runs the model families.
+    """
+
+    def __init__(self, query, check_inputs=None):
+        self.control_variables, self.features, _ = parse_query(query)
+        # the control variables given so far, for the control message of /predict
+        self.control_keys = {k for k in query if k in self.control_variables}
+        troponins = parse_troponins(query)
+        self.warning_message = None
+        if check_inputs is not None:
+            self.warning_message = check_inputs(self.features, list(troponins.values()))
+        self.static_features = get_static_matrix([self.features])
+        self.series = dict()
+        self.luke = LukeAggregates()
+        self.update_troponins(troponins)
+
+    def update_troponins(self, troponins):
+        replaced = any(i in self.series for i in troponins)
+        for i, (t, v) in troponins.items():
+            self.series[i] = (t, v)
+        if replaced:
+            self.luke.rebuild(list(self.series.values()))
+            return
+        series = list(self.series.values())
+        for n, (t, v) in enumerate(troponins.values()):
+            self.luke.add(series[:len(series) - len(troponins) + n + 1], t, v)
+
+    def update(self, query, check_control_variables=None, check_inputs=None):
+        unknown = [k for k in query if k not in self.control_variables and not query_matcher.is_troponin(k)]
+        if len(unknown) > 0:
+            raise ValueError('Session updates only accept troponins and control variables: [{}].'.format(
+                ', '.join(unknown)))
+
+        # validate everything before the session state changes
+        control_variables = parse_control_variables(query, dict(self.control_variables))
+        if check_control_variables is not None:
+            check_control_variables(control_variables)
+        troponins = parse_troponins(query)
+        if check_inputs is not None:
+            series = dict(self.series)
+            series.update(troponins)
+            self.warning_message = check_inputs(dict(self.features), list(series.values()))
+
+        self.control_variables = control_variables
+        self.control_keys.update(k for k in query if k in control_variables)
+        self.update_troponins(troponins)
+
+    def get_record(self):
+        trops, time_hrs = self.luke.get_trop_arrays()
+        return build_feature_record(trops, time_hrs, self.luke.get_features(), luke_names, self.static_features)
+
+
+class SessionRegistry(ResponseCache):
+    """
+    ResponseCache of (version, session) entries. An update is put back with replace, which only succeeds if no
+    other update was put in between, so concurrent updates of one session (from threads or pre-fork workers)
+    are never lost.
+    """
+
+    def replace(self, key, version, value):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None or entry[1][0] != version:
+                return False
+            self.entries[key] = (self.clock(), (version + 1, value))
+            self.entries.move_to_end(key)
+            return True
+
+
+class SessionStore:
+    """
+    Memory-bounded session registry: at most max_sessions sessions, least recently used evicted first, and idle
+    sessions expire after ttl seconds.
+    """
+
+    def __init__(self, predictor, max_sessions=10000, ttl=6 * 60 * 60., sessions=None):
+        # sessions: a shared registry, see SessionManager, instead of one of this process
+        self.predictor = predictor
+        self.sessions = sessions if sessions is not None else SessionRegistry(max_size=max_sessions, ttl=ttl)
+
+    def score(self, session, families=('outcome_dl', 'outcome_xgb', 'event_xgb')):
+        record = session.get_record()
+        outputs = {f: getattr(self.predictor, f).inference(record) for f in families}
+        response = self.predictor.get_response(outputs, session.control_variables, session.features, families)
+        if session.warning_message is not None:
+            response['warning_message'] = session.warning_message
+        control_message = get_control_message(session.control_keys)
+        if control_message is not None:
+            response['control_message'] = control_message
+        return response
+
+    def create(self, query):
+        session = PatientSession(query, check_inputs=self.predictor.check_inputs)
+        self.predictor.check_control_variables(session.control_variables)
+        session_id = uuid.uuid4().hex
+        self.sessions.put(session_id, (0, session))
+        return session_id, self.score(session)
+
+    def update(self, session_id, query):
+        # the update is applied to a copy and retried on the newer version if another one was put in between
+        while True:
+            entry = self.sessions.get(session_id)
+            if entry is None:
+                raise KeyError(session_id)
+            version, session = entry
+            session = copy.deepcopy(session)
+            session.update(query, check_control_variables=self.predictor.check_control_variables,
+                           check_inputs=self.predictor.check_inputs)
+            if self.sessions.replace(session_id, version, session):
+                return self.score(session)
+
+    def delete(self, session_id):
+        entry = self.sessions.pop(session_id)
+        return None if entry is None else entry[1]
+
+    def stats(self):
+        return self.sessions.stats()
+
+
+def create_session_post(store, post_data):
+    """
+    Handler body for POST /session: post_data is a /predict payload, the response adds the session_id.
+    """
+    if not isinstance(post_data, dict):
+        return {'error_message': 'Queries must be JSON objects: {}.'.format(post_data)}
+    try:
+        session_id, response = store.create(post_data)
+    except (TypeError, ValueError) as e:
+        return {'error_message': str(e)}
+    response['session_id'] = session_id
+    return response
+
+
+def update_session_patch(store, session_id, post_data):
+    """
+    Handler body for PATCH /session/<session_id>: post_data holds new or corrected trop{i}/time_trop{i} pairs
+    and optionally control variables; the response is the re-scored /predict response.
+    """
+    if not isinstance(post_data, dict):
+        return {'error_message': 'Queries must be JSON objects: {}.'.format(post_data)}
+    try:
+        response = store.update(session_id, post_data)
+    except KeyError:
+        return {'error_message': 'Unknown or expired session: {}.'.format(session_id)}
+    except (TypeError, ValueError) as e:
+        return {'error_message': str(e)}
+    response['session_id'] = session_id
+    return response
+
+
+def delete_session(store, session_id):
+    # handler body for DELETE /session/<session_id>
+    return {'session_id': session_id, 'deleted': store.delete(session_id) is not None}
+
+
+shared_sessions = list()
+
+
+def get_shared_sessions(max_sessions, ttl):
+    # runs in the manager process, every worker gets the same registry
+    if len(shared_sessions) == 0:
+        shared_sessions.append(SessionRegistry(max_size=max_sessions, ttl=ttl))
+    return shared_sessions[0]
+
+
+class SessionManager(BaseManager):
+    """
+    Serves one session registry to all pre-fork workers, so that any worker can update a session another one
+    created. Sessions are pickled to and from the manager process on every get and put.
+    """
+
+
+SessionManager.register('get_sessions', callable=get_shared_sessions)
+
+
+def start_session_manager():
+    # before the workers fork; they connect to manager.address with connect_sessions
+    manager = SessionManager(ctx=multiprocessing.get_context('fork'))
+    manager.start()
+    return manager
+
+
+def connect_sessions(address, max_sessions, ttl):
+    manager = SessionManager(address=address)
+    manager.connect()
+    return manager.get_sessions(max_sessions, ttl)
@@ -0,0 +1,325 @@
+import os
+import gc
+import json
+import time
+import signal
+import threading
+import traceback
+import socket
+import argparse
+import numpy as np
+import torch
+from http.server import HTTPServer, ThreadingHTTPServer, BaseHTTPRequestHandler
+from service.v5.batch_predictor import BatchPredictor, endpoint_families, predict_batch_post, \
+    parse_variables_post
+from service.v5.encodings import json_content_type, columnar_content_type, get_encoding, encode_json, \
+    encode_columnar
+from service.v5.micro_batcher import ThreadedMicroBatcher
+from service.v5.patient_session import SessionStore, create_session_post, update_session_patch, delete_session, \
+    start_session_manager, connect_sessions
+
+# Pre-fork serving: the parent loads the model packages once, freezes them and forks workers that share the
+# weight pages copy-on-write. Each worker gets its own torch thread budget and accepts on the shared socket.
+
+
+def freeze_module(module):
+    for t in list(module.parameters()) + list(module.buffers()):
+        t.requires_grad_(False)
+        t.share_memory_()
+
+
+def freeze_arrays(obj):
+    for v in vars(obj).values():
+        if isinstance(v, np.ndarray) and not isinstance(v, np.memmap) and v.flags.owndata:
+            v.setflags(write=False)
+
+
+def freeze_predictor(predictor):
+    """
+    Moves the torch weights to shared memory and makes the numpy weight arrays read-only, so a worker can never
+    write to (and thereby copy) a weight page.
+    """
+    dl = predictor.outcome_dl
+    freeze_arrays(dl)
+    if dl.nets is not None:
+        for net in dl.nets:
+            freeze_module(net.eval())
+    if isinstance(dl.ensemble, torch.nn.Module):
+        freeze_module(dl.ensemble)
+    for family in [predictor.outcome_xgb, predictor.event_xgb]:
+        if family.ensemble is not None:
+            freeze_arrays(family.ensemble)
+
+    # objects that survive the fork are never collected again, so the collector does not touch their pages
+    gc.collect()
+    gc.freeze()
+    return predictor
+
+
+session_prefix = '/session/'
+
+
+def internal_error(method, path, e):
+    # the traceback goes to the worker log, the client gets a quote free JSON 500
+    print('{} {} failed:'.format(method, path))
+    traceback.print_exc()
+    return {'error_message': 'Internal server error: {}.'.format(type(e).__name__)}, 500
+
+
+def handle_post(predictor, path, post_data, sessions=None):
+    # (response, status code) of a decoded POST body, shared by PredictHandler and in-process callers
+    try:
+        return route_post(predictor, path, post_data, sessions)
+    except Exception as e:
+        return internal_error('POST', path, e)
+
+
+def route_post(predictor, path, post_data, sessions=None):
+    if path == '/session' and sessions is not None:
+        return create_session_post(sessions, post_data), 200
+    if path == '/predict/batch':
+        return predict_batch_post(predictor, post_data), 200
+    if path == '/tools/parse_variables':
+        return parse_variables_post(post_data), 200
+    if path in endpoint_families:
+        return predictor.inference_single(post_data, families=endpoint_families[path]), 200
+    return {'error_message': 'Unknown endpoint: {}'.format(path)}, 404
+
+
+def handle_session(sessions, method, path, post_data=None):
+    # (response, status code) of PATCH and DELETE /session/<session_id>
+    if sessions is None or not path.startswith(session_prefix):
+        return {'error_message': 'Unknown endpoint: {}'.format(path)}, 404
+    session_id = path[len(session_prefix):]
+    try:
+        if method == 'PATCH':
+            return update_session_patch(sessions, session_id, post_data), 200
+        return delete_session(sessions, session_id), 200
+    except Exception as e:
+        return internal_error(method, path, e)
+
+
+def encode_response(path, response, code, encoding):
+    """
+    (body, content type) of a handle_post result. The prediction endpoints answer in the columnar encoding when
+    asked, a single call as a batch of one; errors of the whole request and /tools/parse_variables are always JSON.
+    """
+    if encoding == 'columnar' and code == 200 and 'error_message' not in response:
+        if path == '/predict/batch':
+            return encode_columnar(response['responses'], {'batch_size': response['batch_size']}), \
+                columnar_content_type
+        if path in endpoint_families:
+            return encode_columnar([response]), columnar_content_type
+    return encode_json(response), json_content_type
+
+
+class PredictHandler(BaseHTTPRequestHandler):
+    """
+    POST /predict, /predict/outcome/dl, /predict/outcome/xgb, /predict/event/xgb, /predict/batch and
+    /tools/parse_variables, served from the BatchPredictor on self.server.predictor, as JSON or, for
+    Accept: application/vnd.rapidx.columnar, in the columnar encoding of service/v5/encodings.py. GET /metrics gives
+    the stage latencies and counters of the worker that answers it only, labelled with self.server.metric_labels
+    (worker="<pid>" under run_prefork). POST /session, PATCH and DELETE
+    /session/<session_id> serve the patient sessions of service/v5/patient_session.py from self.server.sessions.
+    With self.server.batcher, the single prediction calls of concurrent handler threads are scored together, see
+    service/v5/micro_batcher.py, and GET /metrics adds its queue depth and batch size histograms.
+    """
+
+    def reply(self, response, code=200):
+        self.write(encode_json(response), json_content_type, code)
+
+    def write(self, body, content_type, code=200):
+        self.send_response(code)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def dispatch(self, fn, *args):
+        # with micro-batching the handlers run on threads, and the predictor only on the batcher's inference thread
+        if self.server.batcher is None:
+            return fn(*args)
+        return self.server.batcher.call(fn, *args)
+
+    def do_GET(self):
+        if self.path == '/metrics':
+            histograms = None if self.server.batcher is None else self.server.batcher.histograms()
+            text = self.dispatch(self.server.predictor.metrics_text, histograms, self.server.metric_labels)
+            self.write(text.encode('utf-8'), 'text/plain; version=0.0.4')
+            return
+        self.write('GET request for {}'.format(self.path).encode('utf-8'), 'text/plain')
+
+    def read_body(self):
+        # (True, the decoded JSON body), or (False, None) after answering 400
+        try:
+            return True, json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))))
+        except ValueError as e:
+            self.reply({'error_message': 'Invalid JSON body: {}'.format(e)}, code=400)
+            return False, None
+
+    def do_POST(self):
+        valid, post_data = self.read_body()
+        if not valid:
+            return
+        try:
+            if self.server.batcher is not None and self.path in endpoint_families:
+                response, code = self.server.batcher.submit(post_data, endpoint_families[self.path]), 200
+            else:
+                response, code = self.dispatch(handle_post, self.server.predictor, self.path, post_data,
+                                               self.server.sessions)
+            body, content_type = encode_response(self.path, response, code, get_encoding(self.headers.get('Accept')))
+        except Exception as e:
+            response, code = internal_error('POST', self.path, e)
+            body, content_type = encode_json(response), json_content_type
+        self.write(body, content_type, code=code)
+
+    def do_PATCH(self):
+        valid, post_data = self.read_body()
+        if not valid:
+            return
+        try:
+            response, code = self.dispatch(handle_session, self.server.sessions, 'PATCH', self.path, post_data)
+        except Exception as e:
+            response, code = internal_error('PATCH', self.path, e)
+        self.reply(response, code)
+
+    def do_DELETE(self):
+        try:
+            response, code = self.dispatch(handle_session, self.server.sessions, 'DELETE', self.path)
+        except Exception as e:
+            response, code = internal_error('DELETE', self.path, e)
+        self.reply(response, code)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def serve_worker(listen_socket, predictor, handler_class, threads_per_worker, session_args=None, micro_batch=None):
+    """
+    session_args: (manager address, max_sessions, ttl) of the shared session registry, None without sessions.
+    micro_batch: (max_batch_size, max_wait) to serve requests on threads through a micro-batcher, None to serve
+    them one at a time.
+    """
+    torch.set_num_threads(threads_per_worker)
+    server_class = HTTPServer if micro_batch is None else ThreadingHTTPServer
+    server = server_class(listen_socket.getsockname()[:2], handler_class, bind_and_activate=False)
+    server.socket.close()
+    server.socket = listen_socket
+    server.predictor = predictor
+    server.batcher = None if micro_batch is None else ThreadedMicroBatcher(predictor, *micro_batch)
+    server.sessions = None
+    if session_args is not None:
+        server.sessions = SessionStore(predictor, sessions=connect_sessions(*session_args))
+    server.metric_labels = {'worker': os.getpid()}
+
+    # SIGTERM stops accepting, lets the requests in progress finish and exits; shutdown() waits for serve_forever
+    # to return, so it cannot run on this thread
+    signal.signal(signal.SIGTERM, lambda *_: threading.Thread(target=server.shutdown, daemon=True).start())
+    try:
+        server.serve_forever()
+        # joins the handler threads of a threaded server
+        server.server_close()
+        if server.batcher is not None:
+            server.batcher.stop()
+    finally:
+        os._exit(0)
+
+
+def run_prefork(predictor, host='0.0.0.0', port=3710, num_workers=None, threads_per_worker=1,
+                handler_class=PredictHandler, max_sessions=10000, session_ttl=6 * 60 * 60., micro_batch_size=0,
+                micro_batch_wait=0.003):
+    """
+    Forks num_workers (default: cores // threads_per_worker) workers on one listening socket and restarts any
+    worker that exits, until the parent receives SIGINT or SIGTERM. The workers share one registry of at most
+    max_sessions patient sessions, served by a manager process; max_sessions 0 disables the /session endpoints.
+    micro_batch_size > 1 makes every worker threaded, scoring the concurrent single prediction calls it accepts in
+    batches of up to micro_batch_size, collected for at most micro_batch_wait seconds.
+    """
+    if num_workers is None:
+        num_workers = max(1, (os.cpu_count() or 1) // threads_per_worker)
+
+    session_manager, session_args = None, None
+    if max_sessions > 0:
+        session_manager = start_session_manager()
+        session_args = (session_manager.address, max_sessions, session_ttl)
+    micro_batch = (micro_batch_size, micro_batch_wait) if micro_batch_size > 1 else None
+
+    listen_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    listen_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    listen_socket.bind((host, port))
+    listen_socket.listen(128 * num_workers)
+
+    freeze_predictor(predictor)
+
+    def fork_worker():
+        pid = os.fork()
+        if pid == 0:
+            serve_worker(listen_socket, predictor, handler_class, threads_per_worker, session_args, micro_batch)
+        return pid
+
+    workers = {fork_worker() for _ in range(num_workers)}
+    print('serving on {}:{} with {} workers x {} threads'.format(host, port, num_workers, threads_per_worker))
+
+    stopping = list()
+    signal.signal(signal.SIGTERM, lambda *_: stopping.append(True))
+    try:
+        while not stopping:
+            try:
+                pid, _ = os.waitpid(-1, os.WNOHANG)
+            except ChildProcessError:
+                pid = 0
+            if pid in workers:
+                print('worker {} exited, restarting'.format(pid))
+                workers.remove(pid)
+                workers.add(fork_worker())
+            time.sleep(0.1)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        for pid in workers:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+        for pid in workers:
+            try:
+                os.waitpid(pid, 0)
+            except ChildProcessError:
+                pass
+        listen_socket.close()
+        if session_manager is not None:
+            session_manager.shutdown()
+
+
+def main(args):
+    # keep the parent single-threaded, an OpenMP pool started before fork() is not usable in the children
+    torch.set_num_threads(1)
+    predictor = BatchPredictor(model_path=args.model_path, dl_runtime=args.dl_runtime,
+                               xgb_runtime=args.xgb_runtime, cache_size=args.cache_size,
+                               explain_samples=args.explain_samples)
+    run_prefork(predictor, host=args.host, port=args.port, num_workers=args.num_workers,
+                threads_per_worker=args.threads_per_worker, max_sessions=args.max_sessions,
+                session_ttl=args.session_ttl, micro_batch_size=args.micro_batch_size,
+                micro_batch_wait=args.micro_batch_wait)
+    return 0
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--host', type=str, default='0.0.0.0')
+    parser.add_argument('--port', type=int, default=3710)
+    parser.add_argument('--num_workers', type=int, default=None)
+    parser.add_argument('--threads_per_worker', type=int, default=1)
+    parser.add_argument('--model_path', type=str, default=None)
+    parser.add_argument('--dl_runtime', type=str, default='fused')
+    parser.add_argument('--xgb_runtime', type=str, default='compiled')
+    parser.add_argument('--cache_size', type=int, default=4096)
+    parser.add_argument('--explain_samples', type=int, default=64)
+    parser.add_argument('--max_sessions', type=int, default=10000, help='0 disables the /session endpoints')
+    parser.add_argument('--session_ttl', type=float, default=6 * 60 * 60., help='seconds')
+    parser.add_argument('--micro_batch_size', type=int, default=0, help='> 1 batches concurrent calls per worker')
+    parser.add_argument('--micro_batch_wait', type=float, default=0.003, help='seconds')
+
+    args = parser.parse_args()
+    print(args)
+    main(args)
@@ -0,0 +1,80 @@
+import re
+import numpy as np
+
+digits = '0123456789'
+
+
+def to_float(key, value):
+    # messages are quote free, clients read them back with ' replaced by "
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        raise ValueError('Input {} must be a number: {}.'.format(key, value))
+
+
+class QueryMatcher:
+    """
+    Query keys -> feature slots, built once: the fixed names are looked up in one dict (numeric slots, string
+    features and control variables) and the indexed troponin families are recognised by a single compiled
+    pattern joining trop_regex and time_trop_regex. match() is one pass over the payload.
+    """
+
+    def __init__(self, numeric_keys, string_keys, control_keys, trop_regex, time_trop_regex):
+        self.numeric_keys = list(numeric_keys)
+        # control variables take precedence over feature names
+        self.kinds = dict()
+        self.kinds.update({k: ('numeric', i) for i, k in enumerate(self.numeric_keys)})
+        self.kinds.update({k: ('string', None) for k in string_keys})
+        self.kinds.update({k: ('control', None) for k in control_keys})
+        self.expected_keys = self.numeric_keys + list(string_keys)
+        self.trop_pattern = re.compile('(?P<trop>{})|(?P<time_trop>{})'.format(trop_regex, time_trop_regex))
+
+    def is_troponin(self, key):
+        return key not in self.kinds and self.trop_pattern.match(key) is not None
+
+    def match(self, query):
+        """
+        Returns (values, slots, strings, trops, time_trops, unused): the float vector over the numeric slots (nan
+        where not given), the given slot indices, the string features, the troponin values and times by index
+        (times as sent), and the keys that match nothing. Control variables are neither matched nor unused.
+        """
+        values = np.full(len(self.numeric_keys), np.nan)
+        slots, strings, trops, time_trops, unused = [], dict(), dict(), dict(), []
+        for k, v in query.items():
+            kind, slot = self.kinds.get(k, (None, None))
+            if kind == 'numeric':
+                values[slot] = to_float(k, v)
+                slots.append(slot)
+            elif kind == 'string':
+                if isinstance(v, (list, dict)):
+                    raise ValueError('Input {} must be a string: {}.'.format(k, v))
+                strings[k] = v
+            elif kind is None:
+                m = self.trop_pattern.match(k)
+                if m is None:
+                    unused.append(k)
+                elif m.group('trop') is not None:
+                    trops[k[len(k.rstrip(digits)):]] = to_float(k, v)
+                else:
+                    time_trops[k[len(k.rstrip(digits)):]] = to_float(k, v)
+        return values, slots, strings, trops, time_trops, unused
+
+    def summarise(self, query, matched):
+        """
+        The key classification of a query from its match() result: the matched keys with their typed values, the
+        expected feature keys missing from the query and the query keys that are not used.
+        """
+        values, slots, strings, _, _, unused = matched
+        values = values.tolist()
+        matched_query_dict = {self.numeric_keys[s]: values[s] for s in slots}
+        matched_query_dict.update(strings)
+        # the keys that are neither fixed names nor unused are the troponins, already cast by match()
+        unused_keys = set(unused)
+        matched_query_dict.update({k: float(v) for k, v in query.items()
+                                   if k not in self.kinds and k not in unused_keys})
+        return {'matched_query_dict': matched_query_dict,
+                'unmatched_query_keys': [k for k in self.expected_keys if k not in query],
+                'unused_query_keys': unused}
+
+    def classify(self, query):
+        return self.summarise(query, self.match(query))
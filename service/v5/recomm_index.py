@@ -0,0 +1,125 @@
+import csv
+import numpy as np
+
+# Compiled form of the recommendation tables (rapidx_recommendations_v4.csv, outcome_conversion.csv and
+# lhn_classification.csv). The tables are parsed once: the conversion becomes a (p3 x dl class) lookup table, every
+# rule condition an interval, and the LHN names a dictionary of text columns. A batch is then matched against all
+# rules in one vectorised comparison, without any per-request CSV or string parsing.
+
+# dl classes in the p5_pred_dl order of the responses
+dl_classes = ['normal', 'chronic', 'acute', 't2mi', 't1mi']
+rule_keys = ['outcome', 'event_dmi30d', 'relation', 'heart_score']
+default_lhn = 'default_lhn'
+default_lhn_class = 'default_warning'
+
+# longest operators first, so that '>=' is not read as '>'
+condition_ops = ['>=', '<=', '==', '>', '<']
+
+
+def parse_condition(condition):
+    """
+    '>=0', '<=3', '==1', ... -> (low, high, low_inclusive, high_inclusive)
+    """
+    condition = condition.strip()
+    for op in condition_ops:
+        if condition.startswith(op):
+            value = float(condition[len(op):])
+            break
+    else:
+        raise ValueError('Unknown recommendation condition: {}'.format(condition))
+
+    if op == '>=':
+        return value, np.inf, True, False
+    if op == '>':
+        return value, np.inf, False, False
+    if op == '<=':
+        return -np.inf, value, False, True
+    if op == '<':
+        return -np.inf, value, False, False
+    return value, value, True, True
+
+
+def read_csv(path):
+    with open(path, 'r', newline='', encoding='utf-8') as handle:
+        reader = csv.DictReader(handle)
+        return reader.fieldnames, list(reader)
+
+
+class ConditionTable:
+    """
+    One interval per rule, evaluated for (N,) values against all R rules at once -> (N, R).
+    """
+
+    def __init__(self, conditions):
+        low, high, low_inclusive, high_inclusive = zip(*[parse_condition(c) for c in conditions])
+        self.low = np.array(low)
+        self.high = np.array(high)
+        self.low_inclusive = np.array(low_inclusive)
+        self.high_inclusive = np.array(high_inclusive)
+
+    def evaluate(self, values):
+        x = np.asarray(values, dtype=float)[:, None]
+        above = (x > self.low) | (self.low_inclusive & (x == self.low))
+        below = (x < self.high) | (self.high_inclusive & (x == self.high))
+        return above & below
+
+
+class RecommIndex:
+    """
+    Drop-in for RecommShellModel: inference_single has the same signature, inference_batch takes lists of the
+    same arguments and answers them together.
+    """
+
+    def __init__(self, recomm_path, conv_path, lhn_path):
+        fieldnames, rules = read_csv(recomm_path)
+        self.lhn_classes = [k for k in fieldnames if k not in rule_keys]
+        self.outcomes = sorted({r['outcome'] for r in rules})
+        outcome_idx = {o: i for i, o in enumerate(self.outcomes)}
+
+        # rules keep their file order, the first matching rule wins
+        self.rule_outcome = np.array([outcome_idx[r['outcome']] for r in rules])
+        self.rule_and = np.array([r['relation'].strip() == 'and' for r in rules])
+        self.event_conditions = ConditionTable([r['event_dmi30d'] for r in rules])
+        self.heart_conditions = ConditionTable([r['heart_score'] for r in rules])
+        # (R + 1, n_lhn_classes), the last row answers when no rule matches
+        self.texts = np.array([[r[c] for c in self.lhn_classes] for r in rules] + [[None] * len(self.lhn_classes)],
+                              dtype=object)
+
+        _, conversions = read_csv(conv_path)
+        self.conversion = np.full([3, len(dl_classes)], -1)
+        for c in conversions:
+            self.conversion[int(c['outcome_xgb']), dl_classes.index(c['outcome_dl'])] = \
+                outcome_idx.get(c['outcome'], -1)
+
+        _, lhns = read_csv(lhn_path)
+        class_idx = {c: i for i, c in enumerate(self.lhn_classes)}
+        self.lhn_class_idx = {r['lhn_name']: class_idx[r['classification']] for r in lhns}
+        self.default_class_idx = class_idx[default_lhn_class]
+
+    def get_class_idx(self, lhn):
+        return self.lhn_class_idx.get(lhn if lhn is not None else default_lhn, self.default_class_idx)
+
+    def lookup(self, p3_pred_xgb, p5_pred_dl, event_above_1pc, heart_score, lhn_class_idx):
+        """
+        All arguments are (N,) arrays; returns the (N,) recommendation texts.
+        """
+        outcome = self.conversion[np.asarray(p3_pred_xgb, dtype=int), np.asarray(p5_pred_dl, dtype=int)]
+        event = self.event_conditions.evaluate(event_above_1pc)
+        heart = self.heart_conditions.evaluate(heart_score)
+        matched = (outcome[:, None] == self.rule_outcome) & np.where(self.rule_and, event & heart, event | heart)
+        rule = np.where(matched.any(axis=1), matched.argmax(axis=1), len(self.rule_outcome))
+        return self.texts[rule, np.asarray(lhn_class_idx, dtype=int)]
+
+    def inference_batch(self, features, control_variables, response_outcome_dl, response_outcome_xgb,
+                        response_event):
+        texts = self.lookup(p3_pred_xgb=[r['p3_pred_xgb'] for r in response_outcome_xgb],
+                            p5_pred_dl=[r['p5_pred_dl'] for r in response_outcome_dl],
+                            event_above_1pc=[r['event_dmi30d_above_1pc_pred_xgb'] for r in response_event],
+                            heart_score=[float(f.get('heart_score', 0)) for f in features],
+                            lhn_class_idx=[self.get_class_idx(f.get('lhn')) for f in features])
+        return [{'recomm_text': t} for t in texts]
+
+    def inference_single(self, features, control_variables, response_outcome_dl, response_outcome_xgb,
+                         response_event):
+        return self.inference_batch([features], [control_variables], [response_outcome_dl],
+                                    [response_outcome_xgb], [response_event])[0]
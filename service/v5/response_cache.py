@@ -0,0 +1,77 @@
+import json
+import time
+import hashlib
+import threading
+from collections import OrderedDict
+
+
+def get_cache_key(features, series):
+    """
+    Canonical hash of a parsed query's model inputs: the numeric features (key order does not matter) and the
+    troponin series as given. Control variables, lhn and heart_score are left out as they only change the
+    threshold and recommendation stage, which is recomputed on every request.
+    """
+    canonical = [sorted([k, repr(v)] for k, v in features.items()), [[repr(t), repr(v)] for t, v in series]]
+    return hashlib.sha256(json.dumps(canonical).encode('utf-8')).hexdigest()
+
+
+class ResponseCache:
+    """
+    Bounded LRU cache with a time-to-live. max_size <= 0 disables it; ttl is in seconds, None for no expiry.
+    """
+
+    def __init__(self, max_size=4096, ttl=300., clock=time.monotonic):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.clock = clock
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    def get(self, key):
+        if self.max_size <= 0:
+            return None
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and self.ttl is not None and self.clock() - entry[0] > self.ttl:
+                del self.entries[key]
+                self.expirations += 1
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+    def put(self, key, value):
+        if self.max_size <= 0:
+            return
+        with self.lock:
+            self.entries[key] = (self.clock(), value)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+                self.evictions += 1
+
+    def pop(self, key):
+        with self.lock:
+            entry = self.entries.pop(key, None)
+        return None if entry is None else entry[1]
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+    def stats(self):
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {'size': len(self.entries), 'max_size': self.max_size, 'ttl': self.ttl,
+                    'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions,
+                    'expirations': self.expirations, 'hit_rate': self.hits / lookups if lookups > 0 else 0.}
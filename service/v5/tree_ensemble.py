@@ -0,0 +1,163 @@
+import json
+import numpy as np
+import xgboost as xgb
+
+# Flattened XGBoost ensembles: every tree of every bootstrap model is laid out in one set of contiguous node arrays,
+# so a batch of rows is scored by all trees of all models in max_depth vectorised steps, without per-booster calls
+# or DMatrix construction.
+
+# objective -> transform from the summed margin, as Booster.predict does it
+objective_transforms = {
+    'binary:logistic': lambda margin: 1. / (1. + np.exp(-margin)),
+    'reg:logistic': lambda margin: 1. / (1. + np.exp(-margin)),
+    'binary:logitraw': lambda margin: margin,
+    'reg:squarederror': lambda margin: margin,
+}
+
+
+def concatenate(arrays, dtype):
+    return np.concatenate(arrays).astype(dtype) if len(arrays) > 0 else np.zeros(0, dtype=dtype)
+
+
+def get_booster(model):
+    if isinstance(model, xgb.XGBModel):
+        return model.get_booster()
+    return model
+
+
+def get_num_trees(model, num_trees):
+    # XGBModel.predict_proba stops at best_iteration when the model was trained with early stopping
+    if isinstance(model, xgb.XGBModel):
+        try:
+            return min(num_trees, model.best_iteration + 1)
+        except AttributeError:
+            pass
+    return num_trees
+
+
+def parse_base_score(value):
+    # '0.5' in older releases, '[5E-1]' since the vector intercept
+    return float(str(value).strip('[]'))
+
+
+class TreeEnsemble:
+    """
+    Compiled form of a list of binary XGBoost models (Booster or XGBModel), e.g. the 50 bootstrap models of one
+    family. Node arrays (feature, threshold, left, right, default_left, value) are indexed by absolute node id,
+    tree_roots holds each tree's root and model_starts the first tree of each model, trees being grouped by model.
+
+    predict takes the (N, F) feature matrix in feature_names order (NaN = missing) and returns (n_models, N).
+    """
+
+    def __init__(self, models):
+        self.num_models = len(models)
+        boosters = [get_booster(m) for m in models]
+
+        self.feature_names = list()
+        feature_idx = dict()
+        for booster in boosters:
+            for f in booster.feature_names:
+                if f not in feature_idx:
+                    feature_idx[f] = len(self.feature_names)
+                    self.feature_names.append(f)
+
+        feature, threshold, left, right, default_left, value = [list() for _ in range(6)]
+        tree_roots, model_starts, base_margins, self.transforms = list(), list(), list(), list()
+        num_nodes = 0
+        for model, booster in zip(models, boosters):
+            learner = json.loads(booster.save_raw('json'))['learner']
+            objective = learner['objective']['name']
+            if objective not in objective_transforms:
+                raise ValueError('Unsupported XGBoost objective for tree compilation: {}'.format(objective))
+            if learner['gradient_booster']['name'] != 'gbtree':
+                raise ValueError('Only gbtree boosters can be compiled: {}'.format(
+                    learner['gradient_booster']['name']))
+            self.transforms.append(objective)
+
+            base_score = parse_base_score(learner['learner_model_param']['base_score'])
+            if objective in ['binary:logistic', 'reg:logistic']:
+                base_score = np.log(base_score / (1. - base_score))
+            base_margins.append(base_score)
+
+            # booster-local feature index -> ensemble column
+            local_idx = np.array([feature_idx[f] for f in booster.feature_names], dtype=np.int32)
+
+            trees = learner['gradient_booster']['model']['trees']
+            model_starts.append(len(tree_roots))
+            for tree in trees[:get_num_trees(model, len(trees))]:
+                if any(tree['split_type']):
+                    raise ValueError('Categorical splits are not supported by the tree compiler.')
+                t_left = np.array(tree['left_children'], dtype=np.int32)
+                is_leaf = t_left == -1
+
+                feature.append(np.where(is_leaf, -1, local_idx[np.array(tree['split_indices'])]))
+                threshold.append(np.where(is_leaf, np.inf, tree['split_conditions']))
+                left.append(np.where(is_leaf, 0, t_left) + num_nodes)
+                right.append(np.where(is_leaf, 0, tree['right_children']) + num_nodes)
+                default_left.append(np.array(tree['default_left'], dtype=bool))
+                # leaf values are stored in split_conditions
+                value.append(np.where(is_leaf, tree['split_conditions'], 0))
+
+                tree_roots.append(num_nodes)
+                num_nodes += len(t_left)
+
+        self.feature = concatenate(feature, np.int32)
+        self.threshold = concatenate(threshold, np.float32)
+        self.left = concatenate(left, np.int32)
+        self.right = concatenate(right, np.int32)
+        self.default_left = concatenate(default_left, bool)
+        self.value = concatenate(value, np.float32)
+        self.tree_roots = np.array(tree_roots, dtype=np.int32)
+        self.model_starts = np.array(model_starts, dtype=np.int64)
+        # models without trees (e.g. trained for zero rounds) only predict their base margin
+        self.has_trees = np.diff(np.r_[self.model_starts, len(self.tree_roots)]) > 0
+        self.base_margins = np.array(base_margins, dtype=np.float32)
+        # leaves are their own children, so the traversal can run a fixed number of steps
+        is_leaf = self.feature == -1
+        self.left[is_leaf] = np.flatnonzero(is_leaf)
+        self.right[is_leaf] = np.flatnonzero(is_leaf)
+        self.feature[is_leaf] = 0
+        self.is_leaf = is_leaf
+        self.max_depth = self.get_max_depth()
+
+    def __len__(self):
+        return self.num_models
+
+    def get_max_depth(self):
+        depth = 0
+        frontier = self.tree_roots[~self.is_leaf[self.tree_roots]]
+        while len(frontier) > 0:
+            depth += 1
+            frontier = np.concatenate([self.left[frontier], self.right[frontier]])
+            frontier = frontier[~self.is_leaf[frontier]]
+        return depth
+
+    def get_leaves(self, x):
+        x = np.asarray(x, dtype=np.float32)
+        rows = np.arange(len(x))[:, None]
+        node = np.broadcast_to(self.tree_roots, (len(x), len(self.tree_roots)))
+        for _ in range(self.max_depth):
+            fvalue = x[rows, self.feature[node]]
+            go_left = np.where(np.isnan(fvalue), self.default_left[node], fvalue < self.threshold[node])
+            node = np.where(go_left, self.left[node], self.right[node])
+        return node
+
+    def predict_margin(self, x):
+        leaf_values = self.value[self.get_leaves(x)]
+        margins = np.zeros((len(leaf_values), self.num_models), dtype=np.float32)
+        # reduceat sums up to the next start, and gives the start's own value for an empty model
+        if self.has_trees.any():
+            margins[:, self.has_trees] = np.add.reduceat(leaf_values, self.model_starts[self.has_trees], axis=1,
+                                                         dtype=np.float32)
+        return (margins + self.base_margins).T
+
+    def predict(self, x):
+        margins = self.predict_margin(x).astype(float)
+        return np.stack([objective_transforms[t](m) for t, m in zip(self.transforms, margins)])
+
+    def predict_frame(self, df):
+        return self.predict(df[self.feature_names].values.astype(np.float32))
+
+
+def compile_models(models):
+    return TreeEnsemble(models)
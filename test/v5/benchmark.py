@@ -0,0 +1,260 @@
+import json
+import time
+import socket
+import argparse
+import threading
+import numpy as np
+import requests
+from concurrent.futures import ThreadPoolExecutor
+from service.v5.encodings import columnar_content_type, decode_columnar, columnar_to_rows
+
+# Load generator for the v5 service, driven by the payloads of tester.py. Run from test/v5 like the tester:
+#   python benchmark.py --port 3710 --concurrency 8 --num_requests 2000
+#   python benchmark.py --in_process --model_path ... --rate 200 --duration 30 --output run.json
+# Without --rate the load is closed loop (each of --concurrency clients sends its next request when the last one
+# returns); with --rate requests arrive open loop as a Poisson process and latency is measured from the scheduled
+# arrival, so time spent queueing behind a saturated server is counted. --encoding columnar asks for the columnar
+# response encoding and includes decoding it in the latency.
+
+day_milliseconds = 24 * 60 * 60 * 1000
+
+all_endpoints = ['/predict', '/predict/outcome/dl', '/predict/outcome/xgb', '/predict/event/xgb', '/predict/batch']
+
+
+def case_payloads():
+    # the rows of test_cases.csv as sent by test_post_case1
+    from test_cases import test_cases
+    payloads = list()
+    for c_idx, case in enumerate(test_cases):
+        data = {k: v for k, v in case.items() if not (isinstance(v, float) and np.isnan(v))}
+        data['idx'] = c_idx
+        for k in data:
+            if 'time_trop' in k:
+                data[k] *= day_milliseconds
+        payloads.append(data)
+    return payloads
+
+
+def omitted_payloads(rng, num_payloads=50, ratio=0.5):
+    # test_randomly_omitted_post_case1: test_case1 with a random half of the features
+    from test_cases import test_case1 as test_case
+    from service.v4.protocol import features_names
+    payloads = list()
+    for _ in range(num_payloads):
+        random_keys = [features_names[i] for i in rng.permutation(len(features_names))][:int(len(features_names) * ratio)]
+        data = {k: test_case[k] for k in test_case if k in random_keys}
+        data['idx'] = 0
+        for k in data:
+            if 'time_trop' in k:
+                data[k] *= day_milliseconds
+        payloads.append(data)
+    return payloads
+
+
+def age_payloads():
+    # test_age_only_varied_post, the ages below 18 are rejected
+    return [{'gender': 1, 'age': age} for age in range(10, 90, 10)]
+
+
+def get_payloads(suites, rng):
+    payloads = list()
+    for suite in suites:
+        if suite == 'cases':
+            payloads += case_payloads()
+        elif suite == 'omitted':
+            payloads += omitted_payloads(rng)
+        elif suite == 'age':
+            payloads += age_payloads()
+        else:
+            raise ValueError('Unknown payload suite: {}'.format(suite))
+    return payloads
+
+
+def decode_response(body, content_type):
+    # the response as a dict, a columnar body as {'responses': rows, **fields}
+    if content_type == columnar_content_type:
+        decoded = decode_columnar(body)
+        return dict(decoded['fields'], responses=columnar_to_rows(decoded))
+    return json.loads(body)
+
+
+def get_requests(payloads, endpoints, num_requests, batch_size, rng):
+    # (endpoint, body) pairs, endpoints in turn and payloads drawn at random
+    reqs = list()
+    for r_idx in range(num_requests):
+        endpoint = endpoints[r_idx % len(endpoints)]
+        if endpoint == '/predict/batch':
+            body = {'queries': [payloads[i] for i in rng.randint(len(payloads), size=batch_size)]}
+        else:
+            body = payloads[rng.randint(len(payloads))]
+        reqs.append((endpoint, body))
+    return reqs
+
+
+class HTTPTarget:
+
+    def __init__(self, host, port, encoding='json', timeout=30.):
+        self.url = 'http://{}:{}'.format(host, port)
+        self.headers = {'Content-Type': 'application/json'}
+        if encoding == 'columnar':
+            self.headers['Accept'] = columnar_content_type
+        self.timeout = timeout
+        self.local = threading.local()
+
+    def post(self, endpoint, body):
+        # returns (transport ok, response dict), one keep-alive session per client thread
+        if not hasattr(self.local, 'session'):
+            self.local.session = requests.Session()
+        result = self.local.session.post(self.url + endpoint, data=json.dumps(body), headers=self.headers,
+                                         timeout=self.timeout)
+        return result.ok, decode_response(result.content, result.headers.get('Content-Type'))
+
+
+class InProcessTarget:
+    """
+    The pre-fork app without the network: bodies are decoded, handled by handle_post and encoded exactly as
+    PredictHandler serves them, on a BatchPredictor in this process. The predictor is not thread-safe, so like a
+    single pre-fork worker it handles one request at a time; the client threads queue on a lock.
+    """
+
+    def __init__(self, predictor, encoding='json'):
+        from service.v5.prefork import handle_post, encode_response
+        self.handle_post = handle_post
+        self.encode_response = encode_response
+        self.predictor = predictor
+        self.encoding = encoding
+        self.lock = threading.Lock()
+
+    def post(self, endpoint, body):
+        body = json.loads(json.dumps(body))
+        with self.lock:
+            response, code = self.handle_post(self.predictor, endpoint, body)
+        encoded, content_type = self.encode_response(endpoint, response, code, self.encoding)
+        return code == 200, decode_response(encoded, content_type)
+
+
+def call(target, endpoint, body, arrival=None):
+    # (endpoint, latency in seconds, transport ok, error_message returned), latency from arrival if scheduled
+    if arrival is not None:
+        delay = arrival - time.perf_counter()
+        if delay > 0:
+            time.sleep(delay)
+    start = time.perf_counter() if arrival is None else arrival
+    try:
+        ok, response = target.post(endpoint, body)
+    except Exception:
+        # any failure of the request counts as failed, it must not end the run
+        ok, response = False, dict()
+    rejected = 'error_message' in response or any('error_message' in r for r in response.get('responses', []))
+    return endpoint, time.perf_counter() - start, ok, rejected
+
+
+def run_load(target, reqs, concurrency, rate=None, seed=0):
+    # returns the call results in request order and the wall time of the run
+    arrivals = [None] * len(reqs)
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        start = time.perf_counter()
+        if rate is not None:
+            gaps = np.random.RandomState(seed).exponential(1. / rate, size=len(reqs))
+            arrivals = (start + 0.01 + np.cumsum(gaps)).tolist()
+        results = list(pool.map(lambda a: call(target, *a), [(e, b, t) for (e, b), t in zip(reqs, arrivals)]))
+    return results, time.perf_counter() - start
+
+
+def summarise(results, wall_time):
+    summary = dict()
+    for endpoint in sorted(set(r[0] for r in results)) + ['all']:
+        rows = [r for r in results if endpoint in ['all', r[0]]]
+        latency = np.array([r[1] for r in rows]) * 1000
+        summary[endpoint] = {
+            'count': len(rows), 'failures': sum(not r[2] for r in rows), 'rejected': sum(r[3] for r in rows),
+            'throughput_rps': len(rows) / wall_time,
+            'latency_ms': {'mean': float(latency.mean()), 'p50': float(np.percentile(latency, 50)),
+                           'p95': float(np.percentile(latency, 95)), 'p99': float(np.percentile(latency, 99)),
+                           'max': float(latency.max())}}
+    return summary
+
+
+def print_summary(summary, baseline=None):
+    print('{:<22}{:>8}{:>8}{:>10}{:>10}{:>10}{:>10}{:>10}'.format(
+        'endpoint', 'count', 'failed', 'rps', 'p50 ms', 'p95 ms', 'p99 ms', 'max ms'))
+    for endpoint, s in summary.items():
+        l = s['latency_ms']
+        print('{:<22}{:>8}{:>8}{:>10.1f}{:>10.2f}{:>10.2f}{:>10.2f}{:>10.2f}'.format(
+            endpoint, s['count'], s['failures'], s['throughput_rps'], l['p50'], l['p95'], l['p99'], l['max']))
+        if baseline is not None and endpoint in baseline:
+            b = baseline[endpoint]
+            print('{:<22}{:>8}{:>8}{:>10.2f}{:>10.2f}{:>10.2f}{:>10.2f}{:>10.2f}'.format(
+                '  vs baseline', '', '', s['throughput_rps'] / b['throughput_rps'],
+                *[l[k] / b['latency_ms'][k] for k in ['p50', 'p95', 'p99', 'max']]))
+
+
+def main(args):
+    rng = np.random.RandomState(args.seed)
+    endpoints = args.endpoints.split(',')
+    for endpoint in endpoints:
+        if endpoint not in all_endpoints:
+            raise ValueError('Unknown endpoint: {}'.format(endpoint))
+    if args.encoding not in ['json', 'columnar']:
+        raise ValueError('Unknown encoding: {}'.format(args.encoding))
+    payloads = get_payloads(args.suites.split(','), rng)
+
+    if args.in_process:
+        from service.v5.batch_predictor import BatchPredictor
+        target = InProcessTarget(BatchPredictor(model_path=args.model_path, dl_runtime=args.dl_runtime,
+                                                xgb_runtime=args.xgb_runtime, cache_size=args.cache_size,
+                                                explain_samples=args.explain_samples), args.encoding)
+    else:
+        target = HTTPTarget(args.host, args.port, args.encoding)
+
+    num_requests = args.num_requests
+    if args.rate is not None and args.duration is not None:
+        num_requests = int(args.rate * args.duration)
+
+    if args.warmup > 0:
+        run_load(target, get_requests(payloads, endpoints, args.warmup, args.batch_size, rng), args.concurrency)
+    results, wall_time = run_load(target, get_requests(payloads, endpoints, num_requests, args.batch_size, rng),
+                                  args.concurrency, rate=args.rate, seed=args.seed)
+    summary = summarise(results, wall_time)
+
+    baseline = None
+    if args.baseline is not None:
+        with open(args.baseline, 'r') as handle:
+            baseline = json.load(handle)['endpoints']
+    print_summary(summary, baseline)
+
+    if args.output is not None:
+        run = {'config': vars(args), 'hostname': socket.gethostname(),
+               'time': time.strftime('%Y-%m-%dT%H:%M:%S'), 'wall_time_s': wall_time, 'endpoints': summary}
+        with open(args.output, 'w') as handle:
+            json.dump(run, handle, indent=2)
+        print('written to {}'.format(args.output))
+    return 0
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--host', type=str, default='localhost')
+    parser.add_argument('--port', type=int, default=3710)
+    parser.add_argument('--in_process', action='store_true')
+    parser.add_argument('--model_path', type=str, default=None)
+    parser.add_argument('--dl_runtime', type=str, default='fused')
+    parser.add_argument('--xgb_runtime', type=str, default='compiled')
+    parser.add_argument('--cache_size', type=int, default=0)
+    parser.add_argument('--explain_samples', type=int, default=64)
+    parser.add_argument('--encoding', type=str, default='json', help='json or columnar')
+    parser.add_argument('--suites', type=str, default='cases,omitted,age')
+    parser.add_argument('--endpoints', type=str, default='/predict')
+    parser.add_argument('--batch_size', type=int, default=16)
+    parser.add_argument('--concurrency', type=int, default=4)
+    parser.add_argument('--num_requests', type=int, default=1000)
+    parser.add_argument('--rate', type=float, default=None, help='open loop arrivals per second')
+    parser.add_argument('--duration', type=float, default=None, help='seconds, with --rate')
+    parser.add_argument('--warmup', type=int, default=50)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', type=str, default=None)
+    parser.add_argument('--baseline', type=str, default=None, help='an earlier --output to compare against')
+
+    args = parser.parse_args()
+    print(args)
+    main(args)
@@ -0,0 +1,154 @@
+import os
+import json
+import time
+import argparse
+import multiprocessing
+import numpy as np
+import pandas as pd
+import torch
+from concurrent.futures import ProcessPoolExecutor
+from service.v5.batch_predictor import BatchPredictor
+from service.v5.prefork import freeze_predictor
+from aiml.data.feature_store import read_boot
+
+# Development vs deployment consistency over every out-of-bag case, in process: the test_development_deployment_
+# consistency_* checks of tester.py without the server and the 10 case limit. The raw (data_v3.csv) and processed
+# (data_raw_trop6_phys_0.csv or the feature store) frames are read once and joined on idPatient; the cases go
+# through BatchPredictor.inference_batch in batches on forked workers, and the seed 0 probabilities are compared with
+# the ones saved in sample.npy by the development code. Run from test/v5 like the tester:
+#   python consistency_checker.py --num_workers 8 --output consistency.json
+
+checks = {
+    'outcome_xgb': {'model_folder': 'xgb_adjudicatorDiagnosis_cv_ecg_v5.1.2',
+                    'saved_keys': ['y1_prob', 'y2_prob'], 'response_keys': ['l1_prob_xgb', 'l2_prob_xgb']},
+    'event_xgb': {'model_folder': 'xgb_sklearn_event_dmi30d_cv_none_v5.1.2',
+                  'saved_keys': ['y1_prob'], 'response_keys': ['event_dmi30d_prob_xgb']},
+    'outcome_dl': {'model_folder': 'outcome_data3_lm1_lr5e-3_use_ecg_True_b128_v5.1.1',
+                   'saved_keys': ['y1_prob', 'y2_prob'], 'response_keys': ['l1_prob_dl', 'l2_prob_dl']},
+}
+
+predictor = None
+
+
+def load_frames(cache_root):
+    # the processed frame the models were developed on and the raw rows, first row per patient as in tester.py
+    df_processed = read_boot(cache_root, 'data_raw_trop6_phys', 0)
+    df_raw = pd.read_csv(os.path.join(cache_root, 'data_v3.csv'), low_memory=False)
+    df_raw = df_raw.drop_duplicates('idPatient', keep='first').set_index('idPatient', drop=False)
+    return df_processed, df_raw
+
+
+def get_cases(df_processed, df_raw, saved_data):
+    """
+    (positions in sample.npy, patient ids, /predict queries) of the out-of-bag cases from data3 and data_ecg.
+    """
+    df = df_processed.iloc[saved_data['outbag_idxs']].reset_index(drop=True)
+    positions = np.flatnonzero(df['dataset'].isin(['data3', 'data_ecg']).values)
+    patient_ids = df['idPatient'].values[positions]
+    raw = df_raw.loc[patient_ids]
+    # every non-empty raw value as a string, the payload test_development_deployment_consistency_* sends
+    queries = [{k: str(v) for k, v in row.items() if not pd.isna(v)} for row in raw.to_dict('records')]
+    return positions, patient_ids, queries
+
+
+def score_batch(queries, family, response_keys):
+    # seed 0 probabilities (len(queries), len(response_keys)), NaN for rejected queries
+    scores = np.full((len(queries), len(response_keys)), np.nan)
+    for q_idx, response in enumerate(predictor.inference_batch(queries, families=(family,))):
+        if 'error_message' not in response:
+            scores[q_idx] = [response[k][0] for k in response_keys]
+    return scores
+
+
+def score_cases(queries, family, response_keys, batch_size, pool):
+    batches = [queries[b_idx:b_idx + batch_size] for b_idx in range(0, len(queries), batch_size)]
+    if pool is None:
+        scores = [score_batch(b, family, response_keys) for b in batches]
+    else:
+        scores = list(pool.map(score_batch, batches, [family] * len(batches), [response_keys] * len(batches)))
+    return np.concatenate(scores) if len(scores) > 0 else np.zeros((0, len(response_keys)))
+
+
+def compare(saved_data, positions, patient_ids, scores, check):
+    report = {'num_cases': len(positions), 'num_errors': int(np.isnan(scores[:, 0]).sum())}
+    for k_idx, (saved_key, response_key) in enumerate(zip(check['saved_keys'], check['response_keys'])):
+        delta = np.abs(np.asarray(saved_data[saved_key])[positions] - scores[:, k_idx])
+        scored = ~np.isnan(delta)
+        worst = int(np.argmax(np.where(scored, delta, -1))) if scored.any() else None
+        report[response_key] = {'max_abs_delta': float(delta[scored].max()) if scored.any() else 0.,
+                                'mean_abs_delta': float(delta[scored].mean()) if scored.any() else 0.,
+                                'worst_idPatient': None if worst is None else str(patient_ids[worst])}
+    return report
+
+
+def run_checks(cache_root, names, batch_size=256, num_workers=1):
+    """
+    {model: report} of the checks in names, with the BatchPredictor already loaded into predictor.
+    """
+    df_processed, df_raw = load_frames(cache_root)
+    pool = None
+    if num_workers > 1:
+        freeze_predictor(predictor)
+        pool = ProcessPoolExecutor(max_workers=num_workers, mp_context=multiprocessing.get_context('fork'))
+
+    reports = dict()
+    try:
+        for name in names:
+            check = checks[name]
+            start = time.perf_counter()
+            saved_data = np.load(os.path.join(cache_root, check['model_folder'], 'sample.npy'),
+                                 allow_pickle=True).item()
+            positions, patient_ids, queries = get_cases(df_processed, df_raw, saved_data)
+            scores = score_cases(queries, name, check['response_keys'], batch_size, pool)
+            reports[name] = compare(saved_data, positions, patient_ids, scores, check)
+            reports[name]['seconds'] = time.perf_counter() - start
+    finally:
+        if pool is not None:
+            pool.shutdown()
+    return reports
+
+
+def main(args):
+    global predictor
+    from path_utils import cache_root_d3
+    names = args.checks.split(',')
+    for name in names:
+        if name not in checks:
+            raise ValueError('Unknown check: {}'.format(name))
+
+    torch.set_num_threads(1)
+    predictor = BatchPredictor(model_path=args.model_path, dl_runtime=args.dl_runtime, xgb_runtime=args.xgb_runtime,
+                               cache_size=0, explain_samples=0)
+    reports = run_checks(args.cache_root or cache_root_d3, names, args.batch_size, args.num_workers)
+    print(json.dumps(reports, indent=2))
+    if args.output is not None:
+        with open(args.output, 'w') as handle:
+            json.dump(reports, handle, indent=2)
+
+    for name, report in reports.items():
+        # a rejected case is not compared at all, so it must fail the check as well
+        if report['num_errors'] > 0:
+            raise ValueError('{} rejected {} of {} out-of-bag cases.'.format(name, report['num_errors'],
+                                                                           report['num_cases']))
+        for key in checks[name]['response_keys']:
+            if report[key]['max_abs_delta'] > args.tol:
+                raise ValueError('{} deviates from development: {:.3e} > {:.3e} (idPatient {})'.format(
+                    key, report[key]['max_abs_delta'], args.tol, report[key]['worst_idPatient']))
+    return 0
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--checks', type=str, default='outcome_xgb,event_xgb,outcome_dl')
+    parser.add_argument('--cache_root', type=str, default=None)
+    parser.add_argument('--model_path', type=str, default=None)
+    parser.add_argument('--dl_runtime', type=str, default='fused')
+    parser.add_argument('--xgb_runtime', type=str, default='compiled')
+    parser.add_argument('--batch_size', type=int, default=256)
+    parser.add_argument('--num_workers', type=int, default=1)
+    parser.add_argument('--tol', type=float, default=1e-6)
+    parser.add_argument('--output', type=str, default=None)
+
+    args = parser.parse_args()
+    print(args)
+    main(args)
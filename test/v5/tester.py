@@ -8,6 +8,7 @@ import json
 from service.v4.protocol import features_names
 from path_utils import cache_root_de
 from service.v5.protocol import get_config
+from aiml.data.feature_store import read_boot
 
 day_milliseconds = 24 * 60 * 60 * 1000
 
@@ -34,11 +35,27 @@ class TestPosts(unittest.TestCase):
         self.send_post_event = lambda data: requests.post('{}:{}/predict/event/xgb'.format(host, port),
                                                           data=json.dumps(data),
                                                           headers={'Content-Type': 'application/json'})
+        self.send_post_batch = lambda data: requests.post('{}:{}/predict/batch'.format(host, port),
+                                                          data=json.dumps(data),
+                                                          headers={'Content-Type': 'application/json'})
         self.send_post_variable = lambda data: requests.post('{}:{}/tools/parse_variables'.format(host, port),
                                                              data=json.dumps(data),
                                                              headers={'Content-Type': 'application/json'})
         self.send_get = lambda data: requests.get('{}:{}/'.format(host, port), data=json.dumps(data),
                                                   headers={'Content-Type': 'application/json'})
+        self.send_get_metrics = lambda: requests.get('{}:{}/metrics'.format(host, port))
+        self.send_post_session = lambda data: requests.post('{}:{}/session'.format(host, port),
+                                                            data=json.dumps(data),
+                                                            headers={'Content-Type': 'application/json'})
+        self.send_patch_session = lambda session_id, data: requests.patch(
+            '{}:{}/session/{}'.format(host, port, session_id), data=json.dumps(data),
+            headers={'Content-Type': 'application/json'})
+        self.send_delete_session = lambda session_id: requests.delete('{}:{}/session/{}'.format(host, port,
+                                                                                               session_id))
+        self.send_post_batch_columnar = lambda data: requests.post('{}:{}/predict/batch'.format(host, port),
+                                                                   data=json.dumps(data),
+                                                                   headers={'Content-Type': 'application/json',
+                                                                            'Accept': 'application/vnd.rapidx.columnar'})
 
     def test_connection(self):
         data = {'test': 'GET'}
@@ -112,6 +129,28 @@ class TestPosts(unittest.TestCase):
 
         self.assertEqual(set(response_dict['unused_query_keys']) == set(unused_keys), True)
 
+    def test_parse_variables_post(self):
+        data = {'age': '40', 'gender': '1', 'lhn': 'salhn', 'trop3': '12', 'time_trop3': '3600000',
+                'model_idx': '0', 'avgtrop': '3', 'quantized_trop_0-2': '1', 'idx': 0}
+        result = self.send_post_variable(data)
+        self.assertEqual(result.ok, True)
+        response_dict = json.loads(result.text.replace("'", '"'))
+        self.assertEqual(response_dict['matched_query_dict'], {'age': 40., 'gender': 1., 'lhn': 'salhn', 'trop3': 12.,
+                                                               'time_trop3': 3600000.})
+        self.assertEqual(set(response_dict['unused_query_keys']), {'avgtrop', 'quantized_trop_0-2', 'idx'})
+        self.assertEqual('age' not in response_dict['unmatched_query_keys'], True)
+        self.assertEqual('angiogram' in response_dict['unmatched_query_keys'], True)
+
+        # the same classification comes with the prediction
+        result = self.send_post(data)
+        response_dict_predict = json.loads(result.text.replace("'", '"'))
+        for k in ['matched_query_dict', 'unmatched_query_keys', 'unused_query_keys']:
+            self.assertEqual(response_dict_predict[k], response_dict[k])
+
+        result = self.send_post_variable({'age': 'forty'})
+        response_dict = json.loads(result.text.replace("'", '"'))
+        self.assertEqual('error_message' in response_dict, True)
+
     def test_randomly_omitted_post_case1(self):
         from test_cases import test_case1 as test_case
         # self.assertEqual(np.all([fn in test_case for fn in features_names]), True)
@@ -782,6 +821,175 @@ class TestPosts(unittest.TestCase):
                          result['recomm_text'], True)
         # self.assertEqual(result['recomm_prob'], 0.36)
 
+    def test_recommend_index_function(self):
+        from service.v5.recomm_shell import RecommShellModel
+        from service.v5.recomm_index import RecommIndex
+        from path_utils import model_root
+        paths = dict(recomm_path=os.path.join(model_root, 'v5', 'rapidx_recommendations_v4.csv'),
+                     conv_path=os.path.join(model_root, 'v5', 'outcome_conversion.csv'),
+                     lhn_path=os.path.join(model_root, 'v5', 'lhn_classification.csv'))
+        r = RecommShellModel(**paths)
+        index = RecommIndex(**paths)
+
+        # every outcome, event and lhn class around the heart score boundary, with the same answers as the shell
+        features, outcome_dl, outcome_xgb, event_xgb = list(), list(), list(), list()
+        for lhn in ['salhn', 'lclhn', 'debug_lhn', 'default_lhn', 'unknown_lhn']:
+            for heart_score in [0, 2.9, 3, 3.1, 10]:
+                for p5_pred_dl in range(5):
+                    for p3_pred_xgb in range(3):
+                        for event in [0, 1]:
+                            features.append({'lhn': lhn, 'heart_score': heart_score})
+                            outcome_dl.append({'p5_pred_dl': p5_pred_dl})
+                            outcome_xgb.append({'p3_pred_xgb': p3_pred_xgb})
+                            event_xgb.append({'event_dmi30d_above_1pc_pred_xgb': event})
+        control_variables = [dict() for _ in features]
+        results = index.inference_batch(features=features, control_variables=control_variables,
+                                        response_outcome_dl=outcome_dl, response_outcome_xgb=outcome_xgb,
+                                        response_event=event_xgb)
+        for i, result in enumerate(results):
+            expected = r.inference_single(features=features[i], control_variables=control_variables[i],
+                                          response_outcome_dl=outcome_dl[i], response_outcome_xgb=outcome_xgb[i],
+                                          response_event=event_xgb[i])
+            self.assertEqual(result['recomm_text'], expected['recomm_text'])
+
+        result = index.inference_single(features={'lhn': 'debug_lhn', 'heart_score': 3},
+                                        control_variables=dict(), response_outcome_dl={'p5_pred_dl': 0},
+                                        response_outcome_xgb={'p3_pred_xgb': 0},
+                                        response_event={'event_dmi30d_above_1pc_pred_xgb': 0})
+        self.assertEqual(result['recomm_text'], 'Normal_<=0.01and<=3')
+
+        # the recommendation ignores the versions asked for, as the shell does
+        control_variables = {'recomm_outcome_model_type_dl': 'dl', 'recomm_outcome_version_dl': 'v3',
+                             'recomm_outcome_model_type_xgb': 'xgb', 'recomm_outcome_version_xgb': 'v3',
+                             'recomm_event_model_type': 'xgb', 'recomm_event_version': 'v4'}
+        args = dict(features={'lhn': 'debug_lhn', 'heart_score': 3}, response_outcome_dl={'p5_pred_dl': 0},
+                    response_outcome_xgb={'p3_pred_xgb': 0},
+                    response_event={'event_dmi30d_above_1pc_pred_xgb': 0})
+        self.assertEqual(index.inference_single(control_variables=control_variables, **args)['recomm_text'],
+                         r.inference_single(control_variables=control_variables, **args)['recomm_text'])
+
+    def test_quantized_runtime_function(self):
+        import pickle
+        import torch
+        from aiml.pytorch.outcome_data3.model import get_fused_ensemble, get_quantized_ensemble
+        from path_utils import model_root
+        with open(os.path.join(model_root, 'v5', 'outcome_models_dl_data3.pickle'), 'rb') as handle:
+            nets = [net.eval() for net, _ in pickle.load(handle)['models']]
+        quantized = get_quantized_ensemble(nets)
+
+        # normalised features are roughly N(0, 1), missing ones are 0
+        generator = torch.Generator().manual_seed(0)
+        x = torch.randn(1024, int(sum(nets[0].feature_len.values())), generator=generator)
+        x[torch.rand(x.shape, generator=generator) < 0.3] = 0
+        with torch.no_grad():
+            expected, expected_mean = get_fused_ensemble(nets)(x)
+            probs, probs_mean = quantized(x)
+            single_probs, _ = quantized(x[:1])
+        self.assertLess((probs - expected).abs().max().item(), 0.02)
+        self.assertLess((probs_mean - expected_mean).abs().max().item(), 0.02)
+        # activations are quantised per batch, so a row scored alone only agrees to the quantisation error
+        self.assertLess((single_probs - probs[:, :1]).abs().max().item(), 0.02)
+
+    def test_tree_ensemble_function(self):
+        import pickle
+        import xgboost as xgb
+        from path_utils import model_root
+        from service.v5.tree_ensemble import compile_models
+        from service.v5.batch_predictor import booster_predict
+        with open(os.path.join(model_root, 'v5', 'outcome_models_xgb_data3.pickle'), 'rb') as handle:
+            outcome_models = [m for pair in pickle.load(handle)['models'] for m, _ in pair]
+        with open(os.path.join(model_root, 'v5', 'event_dmi30d_models_data3.pickle'), 'rb') as handle:
+            event_models = [m for m, _ in pickle.load(handle)['models']]
+
+        # the compiled ensembles score every dumped bootstrap model as xgboost does, to float32 precision
+        rng = np.random.RandomState(0)
+        for models in [outcome_models, event_models]:
+            ensemble = compile_models(models)
+            x = rng.normal(0, 3, (500, len(ensemble.feature_names))).astype(np.float32)
+            # values on the split thresholds, and missing values
+            thresholds = ensemble.threshold[np.isfinite(ensemble.threshold)]
+            x[:100] = rng.choice(thresholds, x[:100].shape)
+            x[rng.rand(*x.shape) < 0.2] = np.nan
+            df = pd.DataFrame(x, columns=ensemble.feature_names)
+            expected = np.stack([booster_predict(m, df) for m in models])
+            np.testing.assert_allclose(ensemble.predict(x), expected, rtol=0, atol=1e-5)
+
+        # a model without trees predicts its base score and leaves the sums of the others alone
+        booster = event_models[0].get_booster() if isinstance(event_models[0], xgb.XGBModel) else event_models[0]
+        empty = xgb.train({'objective': 'binary:logistic', 'base_score': 0.3},
+                          xgb.DMatrix(df[booster.feature_names].iloc[:10], label=np.arange(10) % 2),
+                          num_boost_round=0)
+        ensemble = compile_models([empty, event_models[0], empty, event_models[1], empty])
+        probs = ensemble.predict(x)
+        np.testing.assert_allclose(probs[[0, 2, 4]], 0.3, rtol=0, atol=1e-6)
+        np.testing.assert_allclose(probs[[1, 3]], expected[:2], rtol=0, atol=1e-5)
+
+    def test_bulk_score_function(self):
+        import argparse
+        import tempfile
+        from path_utils import model_root
+        from service.v5 import bulk_score
+        queries = pd.DataFrame({'idPatient': np.arange(7), 'age': [70, 60, 10, 50, 40, 80, 30],
+                                'gender': [1, 0, 1, 0, 1, 0, 1], 'trop1': [30, 5, 5, np.nan, 100, 3, 8],
+                                'time_trop1': [3600000, 3600000, 3600000, np.nan, 3600000, 3600000, 3600000]})
+
+        with tempfile.TemporaryDirectory() as folder:
+            input_path = os.path.join(folder, 'input.csv')
+            queries.to_csv(input_path, index=False)
+            args = argparse.Namespace(input=input_path, output=os.path.join(folder, 'scores'), output_format='csv',
+                                      chunk_size=3, batch_size=2, num_workers=2, threads_per_worker=1,
+                                      id_columns='idPatient', drop_keys=bulk_score.default_drop_keys,
+                                      model_path=os.path.join(model_root, 'v5'), dl_runtime='fused',
+                                      xgb_runtime='compiled')
+            bulk_score.main(args)
+            part_paths = [os.path.join(args.output, 'part-{:05d}.csv'.format(c_idx)) for c_idx in range(3)]
+            scores = pd.concat([pd.read_csv(p) for p in part_paths], ignore_index=True)
+            self.assertEqual(scores['idPatient'].tolist(), queries['idPatient'].tolist())
+            self.assertEqual(scores['error_message'].notna().tolist(), [False, False, True, False, False, False, False])
+
+            # the same outputs as the batch predictor
+            expected = bulk_score.predictor.inference_batch(bulk_score.get_queries(queries))
+            for row, response in zip(scores.to_dict('records'), expected):
+                for k, v in bulk_score.flatten_response(response, args.drop_keys.split(',')).items():
+                    if isinstance(v, float):
+                        self.assertAlmostEqual(row[k], v, places=6)
+                    else:
+                        self.assertEqual(row[k], v)
+
+            # a rerun only scores the missing chunk, and must cut the input the same way
+            with open(part_paths[2], 'r') as handle:
+                last_part = handle.read()
+            os.remove(part_paths[2])
+            os.utime(part_paths[0], (0, 0))
+            bulk_score.main(args)
+            self.assertEqual(os.stat(part_paths[0]).st_mtime, 0)
+            with open(part_paths[2], 'r') as handle:
+                self.assertEqual(handle.read(), last_part)
+            args.chunk_size = 4
+            self.assertRaises(ValueError, bulk_score.main, args)
+            args.chunk_size = 3
+            args.drop_keys = ''
+            self.assertRaises(ValueError, bulk_score.main, args)
+
+            # a chunk that cannot be written fails alone and is scored on the rerun
+            args = argparse.Namespace(**dict(vars(args), output=os.path.join(folder, 'failed'),
+                                             drop_keys=bulk_score.default_drop_keys))
+            part_paths = [os.path.join(args.output, 'part-{:05d}.csv'.format(c_idx)) for c_idx in range(3)]
+            os.makedirs(part_paths[1] + '.tmp')
+            self.assertEqual(bulk_score.main(args), 1)
+            self.assertEqual([os.path.exists(p) for p in part_paths], [True, False, True])
+            os.rmdir(part_paths[1] + '.tmp')
+            self.assertEqual(bulk_score.main(args), 0)
+            self.assertEqual(pd.read_csv(part_paths[1])['idPatient'].tolist(), [3, 4, 5])
+
+            # responses with keys outside the manifest columns fail their chunk instead of losing the values
+            queries['model_idx'] = [np.nan, np.nan, np.nan, 0, np.nan, np.nan, np.nan]
+            queries.to_csv(input_path, index=False)
+            args = argparse.Namespace(**dict(vars(args), output=os.path.join(folder, 'model_idx')))
+            part_paths = [os.path.join(args.output, 'part-{:05d}.csv'.format(c_idx)) for c_idx in range(3)]
+            self.assertEqual(bulk_score.main(args), 1)
+            self.assertEqual([os.path.exists(p) for p in part_paths], [True, False, True])
+
     def test_threshold_change_function(self):
         data = {'age': 30, 'gender': 0, 'outcome_model_thld_method_xgb': 'default', 'model_idx': 0}
         data = {k: str(v) for k, v in data.items()}
@@ -852,6 +1060,632 @@ class TestPosts(unittest.TestCase):
         self.assertEqual('error_message' not in response_dict, True)
         self.assertEqual(response_dict['outcome_threshold_method_dl'], 'default')
 
+    def test_threshold_variants_function(self):
+        data = {'age': 70, 'gender': 1, 'trop0': 30, 'time_trop0': 3600000, 'return_threshold_variants': 'True'}
+        for model_idx in [-1, 0]:
+            data['model_idx'] = model_idx
+            result = self.send_post({k: str(v) for k, v in data.items()})
+            self.assertEqual(result.ok, True)
+            response_dict = json.loads(result.text.replace("'", '"'))
+            self.assertEqual('error_message' not in response_dict, True)
+            self.assertEqual(set(response_dict['threshold_variants']), {'roc', 'tpr', 'default', 'pr'})
+
+            for method, variant in response_dict['threshold_variants'].items():
+                single = {k: v for k, v in data.items() if k != 'return_threshold_variants'}
+                single.update({'outcome_model_thld_method_dl': method, 'outcome_model_thld_method_xgb': method,
+                               'event_model_thld_method_xgb': method})
+                result = self.send_post({k: str(v) for k, v in single.items()})
+                single_dict = json.loads(result.text.replace("'", '"'))
+                for k in ['l1_thld_dl', 'l2_pred_dl', 'p3_pred_dl', 'l1_thld_xgb', 'p3_pred_xgb',
+                          'event_dmi30d_pred_xgb', 'recomm_text']:
+                    self.assertEqual(variant[k], single_dict[k])
+
+        result = self.send_post({'age': '30', 'return_threshold_variants': 'maybe'})
+        response_dict = json.loads(result.text.replace("'", '"'))
+        self.assertEqual('error_message' in response_dict, True)
+
+    def test_batch_post(self):
+        controls = {'recomm_outcome_model_type_dl': 'dl', 'recomm_outcome_version_dl': 'v5',
+                    'recomm_outcome_model_type_xgb': 'xgb', 'recomm_outcome_version_xgb': 'v5',
+                    'recomm_event_model_type': 'xgb', 'recomm_event_version': 'v5',
+                    'event_model_thld_method_xgb': 'roc', 'outcome_model_thld_method_xgb': 'tpr',
+                    'outcome_model_thld_method_dl': 'default', 'model_idx': 0}
+        queries = [dict({"age": 70, "gender": 1, "angiogram": 1,
+                         "trop1": 30, "time_trop1": 3600000, "trop2": 200, "time_trop2": 7200000}, **controls),
+                   {"age": 60, "gender": 0, "angiogram": 0,
+                    "trop1": 5, "time_trop1": 3600000, "trop2": 10, "time_trop2": 7200000},
+                   {'age': 30, 'gender': 0, 'model_idx': 99},
+                   {'age': 30, 'gender': 0, 'model_idx': None},
+                   {'age': 30, 'gender': 0, 'model_idx': [1]},
+                   {'age': 30, 'gender': 0, 'recomm_outcome_model_type_dl': 'foo'},
+                   {'age': 30, 'gender': 0, 'lhn': [1]},
+                   [1, 2],
+                   1]
+        expected_errors = [False, False, True, True, True, True, True, True, True]
+
+        result = self.send_post_batch({'queries': queries})
+        self.assertEqual(result.ok, True)
+        response_dict = json.loads(result.text.replace("'", '"'))
+        self.assertEqual(response_dict['batch_size'], len(queries))
+        self.assertEqual(len(response_dict['responses']), len(queries))
+
+        # a bad row only fails itself, and rejected rows carry no control message
+        for response, expected_error in zip(response_dict['responses'], expected_errors):
+            self.assertEqual('error_message' in response, expected_error)
+            if expected_error:
+                self.assertEqual('control_message' in response, False)
+                self.assertEqual('l1_prob_dl' in response, False)
+
+        # every control variable given: one model, the requested threshold methods, no control message
+        response = response_dict['responses'][0]
+        self.assertEqual('control_message' in response, False)
+        self.assertEqual(isinstance(response['l1_prob_dl'], float), True)
+        self.assertEqual(response['outcome_threshold_method_dl'], 'default')
+        self.assertEqual(response['outcome_threshold_method_xgb'], 'tpr')
+        self.assertEqual(response['event_dmi30d_threshold_method'], 'roc')
+        self.assertEqual('recomm_text' in response, True)
+        self.assertEqual(response['matched_query_dict']['trop1'], 30)
+
+        # no control variables given: every seed, the default methods and a control message
+        response = response_dict['responses'][1]
+        self.assertEqual('control_message' in response, True)
+        self.assertEqual(isinstance(response['l1_prob_dl'], list), True)
+        self.assertEqual(response['outcome_threshold_method_dl'], 'tpr')
+        self.assertEqual('recomm_text' in response, True)
+
+        # malformed batch bodies and queries
+        for data in [queries[0], [1, 2], {'queries': 1}]:
+            result = self.send_post_batch(data)
+            self.assertEqual(result.ok, True)
+            response_dict = json.loads(result.text.replace("'", '"'))
+            self.assertEqual('error_message' in response_dict, True)
+        for data in [[1, 2], {'age': 30, 'gender': 0, 'model_idx': None}]:
+            result = self.send_post(data)
+            self.assertEqual(result.ok, True)
+            response_dict = json.loads(result.text.replace("'", '"'))
+            self.assertEqual('error_message' in response_dict, True)
+
+    def test_session_post(self):
+        query = {'age': 70, 'gender': 1, 'angiogram': 1, 'trop0': 30, 'time_trop0': 3600000}
+        result = self.send_post_session(query)
+        self.assertEqual(result.ok, True)
+        response_dict = json.loads(result.text.replace("'", '"'))
+        self.assertEqual('error_message' not in response_dict, True)
+        self.assertEqual('control_message' in response_dict, True)
+        session_id = response_dict['session_id']
+
+        # every update scores the session like a /predict of the whole payload so far
+        for patch in [{'trop1': 200, 'time_trop1': 7200000},
+                      {'trop2': 150, 'time_trop2': 3 * 3600000, 'outcome_model_thld_method_xgb': 'roc'},
+                      {'trop0': 40, 'time_trop0': 1800000}]:
+            result = self.send_patch_session(session_id, patch)
+            self.assertEqual(result.ok, True)
+            response_dict = json.loads(result.text.replace("'", '"'))
+            self.assertEqual(response_dict['session_id'], session_id)
+            query.update(patch)
+            predict_dict = json.loads(self.send_post(query).text.replace("'", '"'))
+            for k in ['l1_prob_dl', 'l2_prob_dl', 'l1_prob_xgb', 'l2_prob_xgb', 'event_dmi30d_prob_xgb']:
+                np.testing.assert_almost_equal(response_dict[k], predict_dict[k], decimal=6)
+            for k in ['p3_pred_dl', 'p3_pred_xgb', 'outcome_threshold_method_xgb', 'recomm_text', 'control_message']:
+                self.assertEqual(response_dict[k], predict_dict[k])
+
+        # only troponins and control variables can be updated
+        response_dict = json.loads(self.send_patch_session(session_id, {'age': 50}).text.replace("'", '"'))
+        self.assertEqual('error_message' in response_dict, True)
+        response_dict = json.loads(self.send_patch_session(session_id, [1]).text.replace("'", '"'))
+        self.assertEqual('error_message' in response_dict, True)
+
+        result = self.send_delete_session(session_id)
+        self.assertEqual(result.ok, True)
+        self.assertEqual(json.loads(result.text.replace("'", '"'))['deleted'], True)
+        response_dict = json.loads(self.send_patch_session(session_id, {'trop3': 20, 'time_trop3': 14400000}).text
+                                   .replace("'", '"'))
+        self.assertEqual('error_message' in response_dict, True)
+
+        # a rejected payload opens no session
+        response_dict = json.loads(self.send_post_session({'age': 17, 'gender': 0}).text.replace("'", '"'))
+        self.assertEqual('error_message' in response_dict, True)
+        self.assertEqual('session_id' in response_dict, False)
+
+    def test_session_concurrent_patch(self):
+        # concurrent updates of one session, possibly answered by different workers, all keep their troponins
+        from concurrent.futures import ThreadPoolExecutor
+        query = {'age': 70, 'gender': 1, 'angiogram': 1, 'trop0': 30, 'time_trop0': 3600000}
+        session_id = json.loads(self.send_post_session(query).text.replace("'", '"'))['session_id']
+        patches = [{'trop{}'.format(i): 20 + 10 * i, 'time_trop{}'.format(i): (i + 1) * 3600000}
+                   for i in range(1, 6)]
+        with ThreadPoolExecutor(len(patches)) as executor:
+            results = list(executor.map(lambda patch: self.send_patch_session(session_id, patch), patches))
+        for result in results:
+            self.assertEqual(result.ok, True)
+            self.assertEqual('error_message' in json.loads(result.text.replace("'", '"')), False)
+        for patch in patches:
+            query.update(patch)
+        response_dict = json.loads(self.send_patch_session(session_id, dict()).text.replace("'", '"'))
+        predict_dict = json.loads(self.send_post(query).text.replace("'", '"'))
+        for k in ['l1_prob_dl', 'l2_prob_dl', 'l1_prob_xgb', 'l2_prob_xgb', 'event_dmi30d_prob_xgb']:
+            np.testing.assert_almost_equal(response_dict[k], predict_dict[k], decimal=6)
+        self.send_delete_session(session_id)
+
+        # an update read before another one was put back is not put back over it
+        from service.v5.patient_session import SessionRegistry
+        registry = SessionRegistry(max_size=10, ttl=None)
+        registry.put('a', (0, 'created'))
+        version, _ = registry.get('a')
+        self.assertEqual(registry.replace('a', version, 'first'), True)
+        self.assertEqual(registry.replace('a', version, 'second'), False)
+        self.assertEqual(registry.get('a'), (version + 1, 'first'))
+        self.assertEqual(registry.replace('b', 0, 'unknown'), False)
+
+    def test_batch_bounds_post(self):
+        # the bound checks of test_bounds, validated together in one batch
+        queries = [{'age': 17.99, 'gender': 0},
+                   {'age': 115.01, 'gender': 0},
+                   {'age': 18, 'gender': 1, 'heart_score': 0},
+                   {'age': 40, 'gender': 2},
+                   {'age': 114, 'gender': 1, 'phys_bnp': 49},
+                   {'age': 50, 'gender': 0, 'trop1': -0.01, 'time_trop1': 0.4 * day_milliseconds},
+                   {'age': 50, 'gender': 0, 'trop1': 2.99, 'time_trop1': 0.4 * day_milliseconds},
+                   {'age': 50, 'gender': 0, 'trop11': 20, 'time_trop11': 2 * day_milliseconds},
+                   {'age': 50, 'gender': 0, 'trop1': 20, 'time_trop1': 0.5 * day_milliseconds,
+                    'trop11': 20, 'time_trop11': 2 * day_milliseconds}]
+        expected_errors = [True, False, True, True, False, True, False, True, False]
+
+        result = self.send_post_batch({'queries': queries})
+        self.assertEqual(result.ok, True)
+        responses = json.loads(result.text.replace("'", '"'))['responses']
+        for query, response, expected_error in zip(queries, responses, expected_errors):
+            self.assertEqual('error_message' in response, expected_error)
+            self.assertEqual('warning_message' in response, not expected_error)
+            single_response = json.loads(self.send_post(query).text.replace("'", '"'))
+            self.assertEqual(response.get('error_message'), single_response.get('error_message'))
+            self.assertEqual(response.get('warning_message'), single_response.get('warning_message'))
+
+    def test_metrics_get(self):
+        data = {'age': 70, 'gender': 1, 'trop0': 30, 'time_trop0': 3600000, 'return_stage_timings': 'true'}
+        result = self.send_post(data)
+        self.assertEqual(result.ok, True)
+        response_dict = json.loads(result.text.replace("'", '"'))
+        self.assertEqual(response_dict['stage_timings']['batch_size'], 1)
+        self.assertEqual(set(response_dict['stage_timings']['stage_ms']) >=
+                         {'parse', 'validate', 'thresholds', 'recommendation'}, True)
+
+        data.pop('return_stage_timings')
+        response_dict = json.loads(self.send_post(data).text.replace("'", '"'))
+        self.assertEqual('stage_timings' in response_dict, False)
+
+        # under pre-fork every sample is labelled with the worker that answered, which may not have served these two
+        import re
+        for _ in range(20):
+            result = self.send_get_metrics()
+            self.assertEqual(result.ok, True)
+            samples = [line.rsplit(' ', 1) for line in result.text.splitlines() if not line.startswith('#')]
+            workers = {w for name, _ in samples for w in re.findall(r'worker="(\d+)"', name)}
+            self.assertEqual(len(workers) <= 1, True)
+            metrics = {re.sub(r'\{\}', '', re.sub(r',?worker="\d+"', '', name)): value for name, value in samples}
+            if int(metrics['rapidx_requests_total']) >= 2:
+                break
+            self.send_post(data)
+        self.assertEqual(int(metrics['rapidx_requests_total']) >= 2, True)
+        self.assertEqual('rapidx_stage_seconds{stage="parse",quantile="0.99"}' in metrics, True)
+        for name in ['cache_hits', 'cache_misses', 'cache_evictions', 'cache_expirations']:
+            self.assertEqual(int(metrics['rapidx_{}_total'.format(name)]) >= 0, True)
+
+    def test_latency_histogram_function(self):
+        from service.v5.metrics import LatencyHistogram
+        # quantiles are bucket midpoints within 2 ** -sub_bucket_bits of the recorded value
+        for value in list(range(1, 2000)) + [int(v) for v in np.random.randint(1, 10 ** 10, 1000)]:
+            histogram = LatencyHistogram(sub_bucket_bits=6)
+            histogram.record(value)
+            histogram.max = 10 ** 12
+            self.assertLessEqual(abs(histogram.quantile(1.) - value), value * 2 ** -6)
+
+    def test_explanation_post(self):
+        data = {'age': 70, 'gender': 1, 'trop0': 30, 'time_trop0': 3600000, 'return_explanation': 'true'}
+        result = self.send_post(data)
+        self.assertEqual(result.ok, True)
+        response_dict = json.loads(result.text.replace("'", '"'))
+        if 'error_message' in response_dict:
+            self.skipTest(response_dict['error_message'])
+
+        # the attributions add up to the ensemble probability, up to the sampling error
+        for l in ['l1', 'l2']:
+            total = sum(response_dict['shap_{}_dl'.format(l)].values()) + response_dict['shap_base_{}_dl'.format(l)]
+            self.assertAlmostEqual(total, np.mean(response_dict['{}_prob_dl'.format(l)]), delta=0.05)
+
+        # the same features get the same attributions, also inside a batch
+        result = self.send_post_batch({'queries': [{'age': 50, 'gender': 0}, data]})
+        batch_dict = json.loads(result.text.replace("'", '"'))['responses'][1]
+        np.testing.assert_almost_equal(list(batch_dict['shap_l1_dl'].values()),
+                                       list(response_dict['shap_l1_dl'].values()), decimal=6)
+
+        data.pop('return_explanation')
+        response_dict = json.loads(self.send_post(data).text.replace("'", '"'))
+        self.assertEqual('shap_l1_dl' in response_dict, False)
+
+    def test_columnar_batch_post(self):
+        from service.v5.encodings import decode_columnar, columnar_to_rows
+        queries = [{'age': 70, 'gender': 1, 'trop1': 30, 'time_trop1': 3600000},
+                   {'age': 'seventy', 'gender': 1},
+                   {'age': 50, 'gender': 0, 'outcome_model_thld_method_xgb': 'tpr'}]
+
+        result = self.send_post_batch({'queries': queries})
+        self.assertEqual(result.headers['Content-Type'], 'application/json')
+        expected = result.json()['responses']
+
+        result = self.send_post_batch_columnar({'queries': queries})
+        self.assertEqual(result.ok, True)
+        self.assertEqual(result.headers['Content-Type'], 'application/vnd.rapidx.columnar')
+        decoded = decode_columnar(result.content)
+        self.assertEqual(decoded['fields']['batch_size'], len(queries))
+        self.assertEqual(decoded['columns']['l1_prob_dl'].shape, (len(queries), len(expected[0]['l1_prob_dl'])))
+
+        # the same rows as the JSON responses, at float32 precision
+        for row, expected_row in zip(columnar_to_rows(decoded), expected):
+            self.assertEqual(set(row), set(expected_row))
+            for k in row:
+                if 'prob' in k or 'thld' in k:
+                    np.testing.assert_almost_equal(row[k], expected_row[k], decimal=6)
+                else:
+                    self.assertEqual(row[k], expected_row[k])
+
+        # a malformed batch body stays a JSON error
+        result = self.send_post_batch_columnar({'query': queries})
+        self.assertEqual(result.headers['Content-Type'], 'application/json')
+        self.assertEqual('error_message' in result.json(), True)
+
+    def test_columnar_encoding_function(self):
+        from service.v5.encodings import get_encoding, encode_json, encode_columnar, decode_columnar, \
+            columnar_to_rows
+        self.assertEqual(get_encoding(None), 'json')
+        self.assertEqual(get_encoding('application/vnd.rapidx.columnar'), 'columnar')
+        self.assertEqual(get_encoding('application/vnd.rapidx.columnar;q=0.5, application/json'), 'json')
+        self.assertEqual(get_encoding('text/html'), 'json')
+        self.assertEqual(encode_json({'p': [0.5, float('nan')]}), b'{"p":[0.5,null]}')
+
+        rows = [{'l1_prob': [0.25, 0.5], 'pred': 1, 'method': 'tpr', 'shap': {'age': 0.125, 'gender': -0.5},
+                 'keys': ['trop0'], 'empty': []},
+                {'error_message': 'Input age must be a number: x.'},
+                {'l1_prob': [0.75, 1.], 'pred': 0, 'method': 'default', 'shap': {'age': 0., 'gender': 0.5},
+                 'keys': [], 'empty': [], 'base': 0.5}]
+        body = encode_columnar(rows, {'batch_size': 3})
+        decoded = decode_columnar(body)
+        self.assertEqual(decoded['num_rows'], 3)
+        self.assertEqual(decoded['fields'], {'batch_size': 3})
+        self.assertEqual({k: v['kind'] for k, v in decoded['schema'].items()},
+                         {'l1_prob': 'vector', 'pred': 'int', 'method': 'string', 'shap': 'matrix', 'keys': 'json',
+                          'empty': 'json', 'error_message': 'string', 'base': 'float'})
+        # only probabilities are narrowed to float32
+        self.assertEqual({k: v['dtype'] for k, v in decoded['schema'].items() if k in ['l1_prob', 'shap', 'base']},
+                         {'l1_prob': '<f4', 'shap': '<f8', 'base': '<f8'})
+        np.testing.assert_equal(decoded['columns']['l1_prob'], [[0.25, 0.5], [np.nan, np.nan], [0.75, 1.]])
+        self.assertEqual(columnar_to_rows(decoded), rows)
+
+        # values equal to the old missing markers are kept, and large numbers keep their precision
+        rows = [{'pred': -1, 'method': '', 'thld': float('nan'), 'keys': None, 'time_trop0': 43200001.,
+                 'idx': 2 ** 40 + 1},
+                {},
+                {'pred': 3, 'method': 'roc', 'thld': 0.1 + 0.2, 'keys': [1], 'time_trop0': 1.5, 'idx': 0}]
+        decoded_rows = columnar_to_rows(decode_columnar(encode_columnar(rows)))
+        self.assertEqual([set(r) for r in decoded_rows], [set(r) for r in rows])
+        self.assertTrue(np.isnan(decoded_rows[0].pop('thld')))
+        self.assertEqual(decoded_rows, [{k: v for k, v in r.items() if k != 'thld' or r is not rows[0]}
+                                        for r in rows])
+
+    def test_prefill_vector_function(self):
+        from service.v5.protocol import prefiller
+        from service.v5.input_schema import PrefillVector
+        prefill_value_dict = configs['prefill']['all']
+        df = pd.DataFrame(np.random.rand(100, len(prefill_value_dict) + 1),
+                          columns=list(prefill_value_dict) + ['not_prefilled'])
+        df = df.mask(df < 0.3)
+        pd.testing.assert_frame_equal(PrefillVector(df.columns, prefill_value_dict).apply_frame(df),
+                                      prefiller(df, prefill_value_dict=prefill_value_dict))
+
+    def test_feature_store_function(self):
+        # a boot read from the store is the frame pd.read_csv gives of its data_raw_*_{boot}.csv copy
+        import tempfile
+        from aiml.data import feature_store
+        rng = np.random.RandomState(0)
+        df = pd.DataFrame({'idPatient': np.arange(8), 'age': rng.normal(60, 10, 8).round(1),
+                           'phys_crp': [1.5, np.nan, 2, 3, np.nan, 4, 5, 6],
+                           'priorami': ['TRUE', 'FALSE', 'TRUE', 'TRUE', 'FALSE', 'FALSE', 'TRUE', 'FALSE'],
+                           'ecg_a': ['true', 'false', 'true', None, 'false', 'true', 'true', 'false'],
+                           'angiogram': [True, False, True, True, False, False, True, True],
+                           'dataset': ['data2', 'data3', 'data_ecg', 'data2', 'data3', None, 'data2', 'data_ecg'],
+                           'heart_score': ['1', '2', None, '4', '5', '6', '7', '8'],
+                           'set': 'train'})
+        splits = rng.randint(0, 3, (2, len(df)))
+        with tempfile.TemporaryDirectory() as folder:
+            master_csv = 'data_raw_trop6_phys'
+            store_path = feature_store.get_store_path(folder, master_csv)
+            feature_store.write_store(df, store_path)
+            feature_store.write_splits(store_path, splits)
+            df.to_csv(os.path.join(folder, master_csv + '.csv'), index=False)
+            for boot_no in range(len(splits)):
+                df_boot = df.copy()
+                df_boot['set{}'.format(boot_no)] = feature_store.decode_splits(splits[boot_no])
+                boot_csv = os.path.join(folder, master_csv + '_{}.csv'.format(boot_no))
+                df_boot.to_csv(boot_csv, index=False)
+                expected = pd.read_csv(boot_csv, low_memory=False)
+
+                df_store = feature_store.read_boot(folder, master_csv, boot_no)
+                pd.testing.assert_frame_equal(df_store, expected)
+                pd.testing.assert_series_equal(feature_store.read_set(folder, master_csv, boot_no),
+                                               expected['set{}'.format(boot_no)])
+                pd.testing.assert_frame_equal(feature_store.read_boot(folder, master_csv, boot_no,
+                                                                      columns=['age', 'set{}'.format(boot_no)]),
+                                              expected[['age', 'set{}'.format(boot_no)]])
+
+                # frames are changed in place downstream, the store is not
+                df_store.fillna(-1e10, inplace=True)
+                df_store.loc[0, 'age'] = 0
+                pd.testing.assert_frame_equal(feature_store.read_boot(folder, master_csv, boot_no), expected)
+
+            # deploy mode (no boot) reads the master CSV, as before the store
+            self.assertEqual(feature_store.get_boot_path(folder, master_csv),
+                             os.path.join(folder, master_csv + '.csv'))
+            self.assertEqual(feature_store.get_boot_path(folder, master_csv, 0), store_path)
+
+    def test_input_bounds_function(self):
+        # without a bounds section in the config the defaults apply, and logged physiology must be positive
+        from service.v5.input_schema import InputSchema, default_bounds, get_bounds
+        if 'bounds' not in configs:
+            self.assertEqual(get_bounds(), get_bounds(default_bounds))
+        logged_phys = [k for k in configs['features']['phys']['data2'] if k not in configs['features']['phys_no_log']]
+        schema = InputSchema(['age'] + logged_phys, bounds=default_bounds)
+        self.assertEqual(len(schema.feature_rules.messages),
+                         len(default_bounds['age']) + sum(len(default_bounds.get(k, [None])) for k in logged_phys))
+        x = np.array([[50.] + [0.] * len(logged_phys), [50.] + [60.] * len(logged_phys)])
+        x, errors, warnings = schema.validate(x, np.array([[10.], [10.]]), np.array([[0.1], [0.1]]))
+        self.assertTrue(np.isnan(x[0, 1:]).all())
+        self.assertFalse(np.isnan(x[1]).any())
+        self.assertFalse(errors.any())
+
+    def test_pretensorised_loader_function(self):
+        # the pretensorised batches of every training loader equal the per-sample collate_fn batches
+        import io
+        import tempfile
+        import importlib
+        import contextlib
+        import torch
+        target_info = {'use_ecg': True, 'regression_cols': [], 'binary_cls_cols': [],
+                       'cls_cols_dict': {'adjudicatorDiagnosis': 5}}
+        rng = np.random.RandomState(0)
+        for name in ['outcome_data3', 'outcome_data_ecg', 'revasc']:
+            protocol = importlib.import_module('aiml.pytorch.{}.protocol'.format(name))
+            data_loader = importlib.import_module('aiml.pytorch.{}.data_loader'.format(name))
+            kwargs = {'outcome_data3': {'prefill_feature': False, 'data_cohort': 'f'},
+                      'outcome_data_ecg': {'prefill_feature': False}, 'revasc': dict()}[name]
+            if name == 'outcome_data3':
+                keys = protocol.get_phys_keys() + protocol.get_bio_keys() + protocol.get_luke_trop_keys() + \
+                    protocol.get_binary_keys(use_ecg=True)
+            else:
+                keys = protocol.get_phys_keys() + protocol.get_bio_keys() + protocol.get_luke_trop_keys() + \
+                    protocol.get_binary_keys() + protocol.get_trop_keys() + \
+                    ['time_{}'.format(k) for k in protocol.get_trop_keys()]
+            keys = list(dict.fromkeys(keys))
+
+            df = pd.DataFrame(rng.normal(3, 2, (500, len(keys))), columns=keys)
+            df = df.mask(df > 6)
+            df['adjudicatorDiagnosis'] = rng.choice(['Normal', 'Chronic', 'Acute', 'T1MI', 'T2MI', None], len(df))
+            df['set0'] = rng.choice(['train', 'val'], len(df), p=[0.8, 0.2])
+
+            with tempfile.TemporaryDirectory() as folder:
+                csv_path = os.path.join(folder, 'data.csv')
+                df.to_csv(csv_path, index=False)
+                pd.DataFrame([df[keys].mean(), df[keys].std()], index=['mean', 'std']).to_csv(
+                    os.path.join(folder, 'data_stats.csv'))
+                np.save(os.path.join(folder, 'data_onehot_encoding.npy'), dict())
+
+                # the training path (random crop, shuffled) and the evaluation path
+                for use_random_crop, shuffle in [(True, True), (True, False), (False, True), (False, False)]:
+                    epochs = dict()
+                    for pretensorise in [False, True]:
+                        with contextlib.redirect_stdout(io.StringIO()):
+                            loader = data_loader.get_loader_from_dataset(
+                                csv_path=csv_path, target_info=target_info, target_translator=None, batch_size=64,
+                                transform=None, set_key='set0', set_scope={'train'}, use_random_crop=use_random_crop,
+                                shuffle=shuffle, num_workers=0, drop_last=shuffle, pretensorise=pretensorise,
+                                **kwargs)
+                        torch.manual_seed(5)
+                        np.random.seed(5)
+                        epochs[pretensorise] = [[(x.clone(), y.clone()) for x, y in loader] for _ in range(2)]
+
+                    for epoch, expected_epoch in zip(epochs[True], epochs[False]):
+                        self.assertEqual(len(epoch), len(expected_epoch))
+                        self.assertGreater(len(epoch), 1)
+                        for (x, y), (expected_x, expected_y) in zip(epoch, expected_epoch):
+                            self.assertEqual(x.dtype, expected_x.dtype)
+                            self.assertTrue(torch.equal(x, expected_x), (name, use_random_crop, shuffle))
+                            self.assertTrue(torch.equal(y, expected_y), (name, use_random_crop, shuffle))
+
+    def test_batched_troponin_net_function(self):
+        # a few training steps of the batched replicas equal those of separate TroponinNets
+        import io
+        import contextlib
+        import torch
+        from aiml.pytorch.outcome_data3.model import get_network, get_batched_network
+        from aiml.pytorch.outcome_data3.train_boots import get_batched_info
+        from aiml.pytorch.train_utils import loss_maker, target_maker
+        target_info = {'use_ecg': True, 'regression_cols': [], 'binary_cls_cols': [],
+                       'cls_cols_dict': {'adjudicatorDiagnosis': 5}, 'luke_multiplier': 1, 'data_cohort': 'f'}
+        ignore_value = -1e10
+        seeds = [3, 7, 11]
+        default_dtype = torch.get_default_dtype()
+        torch.set_default_dtype(torch.float64)
+        try:
+            with contextlib.redirect_stdout(io.StringIO()):
+                batched = get_batched_network(target_info, seeds)
+                nets = list()
+                for seed in seeds:
+                    torch.manual_seed(seed)
+                    nets.append(get_network(target_info))
+            # dropout masks are drawn differently, the comparison runs without them
+            batched.dropout = 0.
+            for net in nets:
+                for module in net.modules():
+                    if isinstance(module, torch.nn.Dropout):
+                        module.p = 0.
+
+            num_features = int(sum(nets[0].feature_len.values()))
+            x = torch.randn(len(seeds), 64, num_features, 1, 1)
+            targets = torch.nn.functional.one_hot(torch.randint(0, 5, (len(seeds), 64)), 5).float()
+            targets[:, :3] = ignore_value
+            batched_optimizer = torch.optim.SGD(batched.parameters(), lr=0.1, weight_decay=5e-4, momentum=0.9)
+            optimizers = [torch.optim.SGD(net.parameters(), lr=0.1, weight_decay=5e-4, momentum=0.9) for net in nets]
+            batched.train()
+            for net in nets:
+                net.train()
+            for _ in range(3):
+                _, _, cls_logits = batched(x)
+                batched_loss = get_batched_info(cls_logits, [targets], target_info, ignore_value)[0][
+                    'loss_adjudicatorDiagnosis']
+                losses = list()
+                for r_idx, net in enumerate(nets):
+                    outputs = net(x[r_idx])
+                    losses.append(loss_maker(*outputs, *target_maker(targets[r_idx], target_info), target_info,
+                                             ignore_value)['loss_adjudicatorDiagnosis'])
+                np.testing.assert_allclose(batched_loss.detach().view(-1).numpy(),
+                                           torch.stack(losses).detach().view(-1).numpy(), rtol=1e-12)
+
+                batched_optimizer.zero_grad()
+                batched_loss.sum().backward()
+                batched_optimizer.step()
+                for optimizer, loss in zip(optimizers, losses):
+                    optimizer.zero_grad()
+                    loss.sum().backward()
+                    optimizer.step()
+
+            # parameters and batch norm running statistics
+            for state_dict, net in zip(batched.get_state_dicts(nets[0].state_dict()), nets):
+                self.assertEqual(list(state_dict), list(net.state_dict()))
+                for key, value in net.state_dict().items():
+                    np.testing.assert_allclose(state_dict[key].double().numpy(), value.double().numpy(),
+                                               rtol=1e-10, atol=1e-12, err_msg=key)
+        finally:
+            torch.set_default_dtype(default_dtype)
+
+    def test_internal_error_function(self):
+        from service.v5.prefork import handle_post, handle_session
+
+        class BrokenPredictor:
+            def inference_batch(self, queries, families=None):
+                raise KeyError('outcome_dl')
+
+        class BrokenSessions:
+            def delete(self, session_id):
+                raise OSError('manager gone')
+
+        error = {'error_message': 'Internal server error: KeyError.'}
+        self.assertEqual(handle_post(BrokenPredictor(), '/predict/batch', {'queries': [{}]}), (error, 500))
+        self.assertEqual(handle_session(BrokenSessions(), 'DELETE', '/session/abc'),
+                         ({'error_message': 'Internal server error: OSError.'}, 500))
+        self.assertEqual(handle_post(BrokenPredictor(), '/nope', {})[1], 404)
+
+        # a JSON null body is answered like any other non-object query
+        response = requests.post('http://localhost:{}/predict'.format(TestPosts.port), data='null',
+                                 headers={'Content-Type': 'application/json'})
+        self.assertEqual(response.status_code, 200)
+        self.assertIn('error_message', response.json())
+
+    def test_worker_sigterm_function(self):
+        # a pre-fork worker told to stop finishes the request in progress before it exits
+        import time
+        import signal
+        import socket
+        import threading
+        from service.v5.prefork import PredictHandler, serve_worker
+
+        class SlowHandler(PredictHandler):
+            def do_POST(self):
+                self.rfile.read(int(self.headers.get('Content-Length', 0)))
+                time.sleep(1)
+                self.reply({'done': True})
+
+        listen_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        listen_socket.bind(('localhost', 0))
+        listen_socket.listen(8)
+        pid = os.fork()
+        if pid == 0:
+            serve_worker(listen_socket, None, SlowHandler, 1)
+        url = 'http://localhost:{}/predict'.format(listen_socket.getsockname()[1])
+        listen_socket.close()
+
+        results = list()
+        thread = threading.Thread(target=lambda: results.append(requests.post(url, json={})))
+        thread.start()
+        time.sleep(0.3)
+        os.kill(pid, signal.SIGTERM)
+        thread.join(10)
+        _, status = os.waitpid(pid, 0)
+        self.assertEqual([r.json() for r in results], [{'done': True}])
+        self.assertEqual(os.WIFEXITED(status) and os.WEXITSTATUS(status) == 0, True)
+
+    def test_micro_batcher_function(self):
+        import threading
+        from concurrent.futures import ThreadPoolExecutor
+        from http.server import ThreadingHTTPServer
+        from service.v5.micro_batcher import ThreadedMicroBatcher
+        from service.v5.batch_predictor import BatchPredictor
+        from service.v5.metrics import Metrics
+        from service.v5.response_cache import ResponseCache
+        from service.v5.prefork import PredictHandler
+
+        class EchoPredictor:
+            metrics_text = BatchPredictor.metrics_text
+
+            def __init__(self):
+                self.release = threading.Event()
+                self.metrics = Metrics()
+                self.cache = ResponseCache()
+
+            def inference_batch(self, queries, families):
+                self.release.wait(5)
+                return [{'q': q, 'families': list(families)} for q in queries]
+
+        predictor = EchoPredictor()
+        predictor.release.set()
+        batcher = ThreadedMicroBatcher(predictor, max_batch_size=4, max_wait=0.01)
+        with ThreadPoolExecutor(max_workers=8) as pool:
+            responses = list(pool.map(lambda i: batcher.submit(i, ('outcome_xgb',)), range(8)))
+        self.assertEqual(responses, [{'q': i, 'families': ['outcome_xgb']} for i in range(8)])
+        self.assertEqual(batcher.call(len, [1, 2]), 2)
+
+        # GET /metrics of a micro-batching server has the queue depth and batch size histograms
+        server = ThreadingHTTPServer(('localhost', 0), PredictHandler)
+        server.predictor, server.batcher, server.sessions, server.metric_labels = predictor, batcher, None, None
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        result = requests.get('http://localhost:{}/metrics'.format(server.server_address[1]))
+        server.shutdown()
+        server.server_close()
+        metrics = dict(line.rsplit(' ', 1) for line in result.text.splitlines() if not line.startswith('#'))
+        self.assertEqual(metrics['rapidx_micro_batch_size_count'], str(batcher.stats()['num_batches']))
+        self.assertEqual(metrics['rapidx_micro_batch_size_sum'], '8')
+        self.assertEqual(metrics['rapidx_micro_batch_size_bucket{le="+Inf"}'], metrics['rapidx_micro_batch_size_count'])
+        self.assertEqual(metrics['rapidx_micro_batch_queue_depth_count'], '8')
+
+        # a failing scheduler fails its callers, the next submit restarts it
+        with self.assertRaises(TypeError):
+            batcher.submit(0, [['unhashable']])
+        self.assertEqual(batcher.submit(1, ('event_xgb',)), {'q': 1, 'families': ['event_xgb']})
+
+        # stop() fails the running and the queued requests
+        predictor.release.clear()
+        pool = ThreadPoolExecutor(max_workers=3)
+        futures = [pool.submit(batcher.submit, 0)]
+        while batcher.stats()['num_requests'] < 11:
+            threading.Event().wait(0.01)
+        futures += [pool.submit(batcher.submit, i) for i in range(1, 3)]
+        while batcher.stats()['queue_size'] < 2:
+            threading.Event().wait(0.01)
+        batcher.stop()
+        predictor.release.set()
+        for future in futures:
+            with self.assertRaises(RuntimeError):
+                future.result(5)
+        pool.shutdown()
+
     def test_development_deployment_consistency_outcome_xgb(self):
         from path_utils import cache_root_d3 as cache_root
 
@@ -869,11 +1703,12 @@ class TestPosts(unittest.TestCase):
         # df_outbag = saved_data['df_outbag']
         outbag_idxs = saved_data['outbag_idxs']
 
-        df = pd.read_csv(os.path.join(cache_root, 'data_raw_trop6_phys_0.csv'), low_memory=False)
+        df = read_boot(cache_root, 'data_raw_trop6_phys', 0)
         # df = df_outbag
         df = df.iloc[outbag_idxs]
         df = df.reset_index(drop=True)
 
+        df_data3 = pd.read_csv(os.path.join(cache_root, 'data_v3.csv'))
         found_cases = 0
         for case_no, (r_idx, row) in enumerate(df.iterrows()):
             if not row['dataset'] in ['data3', 'data_ecg']:
@@ -883,7 +1718,6 @@ class TestPosts(unittest.TestCase):
                 break
             processed_data = df.iloc[case_no]
             processed_result = (saved_data['y1_prob'][case_no], saved_data['y2_prob'][case_no])
-            df_data3 = pd.read_csv(os.path.join(cache_root, 'data_v3.csv'))
             raw_data = dict(df_data3[df_data3['idPatient'] == processed_data['idPatient']].iloc[0])
             # self.assertEqual(processed_data['idPatient'], raw_data['idPatient'])
 
@@ -914,11 +1748,12 @@ class TestPosts(unittest.TestCase):
         # df_outbag = saved_data['df_outbag']
         outbag_idxs = saved_data['outbag_idxs']
 
-        df = pd.read_csv(os.path.join(cache_root, 'data_raw_trop6_phys_0.csv'), low_memory=False)
+        df = read_boot(cache_root, 'data_raw_trop6_phys', 0)
         # df = df_outbag
         df = df.iloc[outbag_idxs]
         df = df.reset_index(drop=True)
 
+        df_data3 = pd.read_csv(os.path.join(cache_root, 'data_v3.csv'))
         found_cases = 0
         for case_no, (r_idx, row) in enumerate(df.iterrows()):
             if not row['dataset'] in ['data3', 'data_ecg']:
@@ -928,7 +1763,6 @@ class TestPosts(unittest.TestCase):
                 break
             processed_data = df.iloc[case_no]
             processed_result = saved_data['y1_prob'][case_no]
-            df_data3 = pd.read_csv(os.path.join(cache_root, 'data_v3.csv'))
             raw_data = dict(df_data3[df_data3['idPatient'] == processed_data['idPatient']].iloc[0])
             # self.assertEqual(processed_data['idPatient'], raw_data['idPatient'])
 
@@ -954,11 +1788,12 @@ class TestPosts(unittest.TestCase):
         # df_outbag = saved_data['df_outbag']
         outbag_idxs = saved_data['outbag_idxs']
 
-        df = pd.read_csv(os.path.join(cache_root, 'data_raw_trop6_phys_0.csv'), low_memory=False)
+        df = read_boot(cache_root, 'data_raw_trop6_phys', 0)
         # df = df_outbag
         df = df.iloc[outbag_idxs]
         df = df.reset_index(drop=True)
 
+        df_data3 = pd.read_csv(os.path.join(cache_root, 'data_v3.csv'))
         found_cases = 0
         for case_no, (r_idx, row) in enumerate(df.iterrows()):
             if not row['dataset'] in ['data3', 'data_ecg']:
@@ -968,7 +1803,6 @@ class TestPosts(unittest.TestCase):
                 break
             processed_data = df.iloc[case_no]
             processed_result = (saved_data['y1_prob'][case_no], saved_data['y2_prob'][case_no])
-            df_data3 = pd.read_csv(os.path.join(cache_root, 'data_v3.csv'))
             raw_data = dict(df_data3[df_data3['idPatient'] == processed_data['idPatient']].iloc[0])
             # self.assertEqual(processed_data['idPatient'], raw_data['idPatient'])
 
@@ -982,6 +1816,18 @@ class TestPosts(unittest.TestCase):
 
             found_cases += 1
 
+    def test_development_deployment_consistency_function(self):
+        # every out-of-bag case of the three checks above, in process
+        import consistency_checker
+        from path_utils import cache_root_d3 as cache_root
+        from service.v5.batch_predictor import BatchPredictor
+        consistency_checker.predictor = BatchPredictor(cache_size=0, explain_samples=0)
+        reports = consistency_checker.run_checks(cache_root, list(consistency_checker.checks), num_workers=4)
+        for name, report in reports.items():
+            self.assertEqual(report['num_errors'], 0)
+            for key in consistency_checker.checks[name]['response_keys']:
+                self.assertLess(report[key]['max_abs_delta'], 1e-6)
+
 
 if __name__ == '__main__':
 